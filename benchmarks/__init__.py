@@ -0,0 +1,15 @@
+"""
+Package: benchmarks
+Performance benchmarks for the Orders Service
+"""
+import os
+
+
+def configure_environment():
+    """Lets the service be imported without a Postgres server
+
+    Must be called before the service package is imported. Settings that
+    are already present in the environment are left alone.
+    """
+    os.environ.setdefault("DATABASE_URI", "sqlite://")
+    os.environ.setdefault("DB_INIT_MODE", "skip")
@@ -0,0 +1,283 @@
+"""
+Load Test for the Orders Service
+
+Drives a realistic mix of requests against the service from several
+threads and reports the throughput and the p50/p95/p99 latency of every
+kind of request. It runs fully offline, either in-process through the
+Flask test client or over HTTP against a local server, e.g. gunicorn
+bound to SQLite or a local Postgres.
+
+Usage:
+    python -m benchmarks.loadtest                          # in-process, SQLite
+    DATABASE_URI=postgresql://... python -m benchmarks.loadtest
+    ORDER_STORAGE=memory python -m benchmarks.loadtest     # in-process, orders in memory
+    python -m benchmarks.loadtest --url http://localhost:8080 --concurrency 16
+
+In-process runs create the tables in DATABASE_URI, which defaults to a
+SQLite file in the temp directory. HTTP runs expect the server to be up.
+"""
+import os
+import sys
+import json
+import math
+import time
+import logging
+import random
+import tempfile
+import argparse
+import threading
+import http.client
+from urllib.parse import urlsplit
+from benchmarks import configure_environment
+
+os.environ.setdefault("DATABASE_URI", f"sqlite:///{os.path.join(tempfile.gettempdir(), 'orders-loadtest.db')}")
+configure_environment()
+
+BASE_PATH = "/api/orders"
+
+# The relative frequency of each kind of request
+REQUEST_MIX = {
+    "create_order": 15,
+    "get_order": 35,
+    "list_orders_filtered": 20,
+    "add_item": 10,
+    "update_item": 10,
+    "cancel_order": 5,
+    "list_items": 5,
+}
+
+# Responses that are a normal outcome of the request and not an error,
+# e.g. cancelling an order that was already cancelled by another thread
+EXPECTED_STATUS = {
+    "create_order": {201},
+    "add_item": {201},
+    "cancel_order": {200, 409},
+}
+
+
+######################################################################
+#  C L I E N T S
+######################################################################
+class TestClient:
+    """Sends requests to the app in-process through the Flask test client"""
+
+    def __init__(self):
+        from service import app  # pylint: disable=import-outside-toplevel
+        self.client = app.test_client()
+
+    def request(self, method: str, path: str, body=None):
+        """Returns the status and JSON body of the response"""
+        response = self.client.open(path, method=method, json=body)
+        return response.status_code, response.get_json(silent=True)
+
+
+class HttpClient:
+    """Sends requests to a running server over a keep-alive connection"""
+
+    def __init__(self, url: str):
+        parts = urlsplit(url)
+        self.connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+
+    def request(self, method: str, path: str, body=None):
+        """Returns the status and JSON body of the response"""
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        payload = json.dumps(body) if body is not None else None
+        self.connection.request(method, path, body=payload, headers=headers)
+        response = self.connection.getresponse()
+        data = response.read()
+        return response.status, json.loads(data) if data else None
+
+
+######################################################################
+#  W O R K L O A D
+######################################################################
+class Workload:
+    """Picks requests at random and keeps track of what was created"""
+
+    def __init__(self, rng: random.Random, customers: int, products: int):
+        self.rng = rng
+        self.customers = customers
+        self.products = products
+        self.orders = []  # list.append and random.choice are thread-safe
+        self.items = []   # (order_id, item_id)
+
+    def new_item(self) -> dict:
+        """Returns the payload of a random order item"""
+        return {
+            "product_id": self.rng.randrange(self.products),
+            "quantity": self.rng.randint(1, 5),
+            "price": round(self.rng.uniform(1, 200), 2),
+        }
+
+    def new_order(self) -> dict:
+        """Returns the payload of a random order"""
+        return {
+            "customer_id": self.rng.randrange(self.customers),
+            "items": [self.new_item() for _ in range(self.rng.randint(1, 5))],
+        }
+
+    def remember(self, order: dict):
+        """Keeps the ids of a created order and its items for later requests"""
+        self.orders.append(order["id"])
+        self.items.extend((order["id"], item["id"]) for item in order.get("items", []))
+
+    def next_request(self):
+        """Returns the name, method, path and body of the next request"""
+        name = self.rng.choices(list(REQUEST_MIX), weights=list(REQUEST_MIX.values()))[0]
+        if name == "create_order" or not self.orders:
+            return "create_order", "POST", BASE_PATH, self.new_order()
+        order_id = self.rng.choice(self.orders)
+        if name == "get_order":
+            return name, "GET", f"{BASE_PATH}/{order_id}", None
+        if name == "list_orders_filtered":
+            query = self.rng.choice([
+                f"customer_id={self.rng.randrange(self.customers)}",
+                f"product_id={self.rng.randrange(self.products)}",
+                f"status={self.rng.choice(['CONFIRMED', 'CANCELLED'])}",
+            ])
+            return name, "GET", f"{BASE_PATH}?{query}", None
+        if name == "add_item":
+            return name, "POST", f"{BASE_PATH}/{order_id}/items", self.new_item()
+        if name == "update_item" and self.items:
+            order_id, item_id = self.rng.choice(self.items)
+            return name, "PUT", f"{BASE_PATH}/{order_id}/items/{item_id}", self.new_item()
+        if name == "cancel_order":
+            return name, "PUT", f"{BASE_PATH}/{order_id}/cancel", None
+        return "list_items", "GET", f"{BASE_PATH}/{order_id}/items", None
+
+
+######################################################################
+#  R U N N E R
+######################################################################
+def percentile(samples: list, fraction: float) -> float:
+    """Returns the nearest-rank percentile of sorted samples"""
+    if not samples:
+        return 0.0
+    index = max(0, min(len(samples) - 1, math.ceil(fraction * len(samples)) - 1))
+    return samples[index]
+
+
+def run_worker(make_client, workload: Workload, count: int, results: dict, lock: threading.Lock):
+    """Sends count requests and records their latency"""
+    client = make_client()
+    latencies = {}
+    errors = {}
+    for _ in range(count):
+        name, method, path, body = workload.next_request()
+        start = time.perf_counter()
+        status, data = client.request(method, path, body)
+        latencies.setdefault(name, []).append(time.perf_counter() - start)
+        if status not in EXPECTED_STATUS.get(name, {200}):
+            errors[name] = errors.get(name, 0) + 1
+        elif name == "create_order":
+            workload.remember(data)
+    with lock:
+        for name, samples in latencies.items():
+            results["latencies"].setdefault(name, []).extend(samples)
+        for name, error_count in errors.items():
+            results["errors"][name] = results["errors"].get(name, 0) + error_count
+
+
+def summarize(results: dict, elapsed: float) -> dict:
+    """Returns the throughput and latency percentiles of each kind of request"""
+    summary = {}
+    all_samples = []
+    for name, samples in sorted(results["latencies"].items()):
+        samples.sort()
+        all_samples.extend(samples)
+        summary[name] = {
+            "count": len(samples),
+            "errors": results["errors"].get(name, 0),
+            "rps": len(samples) / elapsed,
+            "p50_ms": percentile(samples, 0.50) * 1000,
+            "p95_ms": percentile(samples, 0.95) * 1000,
+            "p99_ms": percentile(samples, 0.99) * 1000,
+        }
+    all_samples.sort()
+    summary["total"] = {
+        "count": len(all_samples),
+        "errors": sum(results["errors"].values()),
+        "rps": len(all_samples) / elapsed,
+        "p50_ms": percentile(all_samples, 0.50) * 1000,
+        "p95_ms": percentile(all_samples, 0.95) * 1000,
+        "p99_ms": percentile(all_samples, 0.99) * 1000,
+    }
+    return summary
+
+
+def print_summary(summary: dict, elapsed: float):
+    """Prints the summary as a table"""
+    print(f"{'request':<22}{'count':>8}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, row in summary.items():
+        print(
+            f"{name:<22}{row['count']:>8}{row['errors']:>8}{row['rps']:>10.1f}"
+            f"{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}{row['p99_ms']:>10.2f}"
+        )
+    print(f"Elapsed: {elapsed:.2f} s")
+
+
+def prepare_app():
+    """Creates the tables for an in-process run"""
+    from service import app  # pylint: disable=import-outside-toplevel
+    from service.models import db  # pylint: disable=import-outside-toplevel
+    # Expected errors such as cancelling a cancelled order would drown the report
+    app.logger.setLevel(logging.CRITICAL)
+    db.create_all()
+
+
+def main(argv=None) -> int:
+    """Runs the load test and prints the results"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="base URL of a running server (default: in-process test client)")
+    parser.add_argument("--requests", type=int, default=2000, help="total number of requests (default %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=4, help="number of client threads (default %(default)s)")
+    parser.add_argument("--warmup", type=int, default=50, help="orders to create before measuring (default %(default)s)")
+    parser.add_argument("--customers", type=int, default=100, help="distinct customer ids (default %(default)s)")
+    parser.add_argument("--products", type=int, default=500, help="distinct product ids (default %(default)s)")
+    parser.add_argument("--seed", type=int, default=None, help="random seed for a repeatable request mix")
+    parser.add_argument("--json", metavar="FILE", help="also write the summary to FILE as JSON")
+    args = parser.parse_args(argv)
+
+    if args.url:
+        def make_client():
+            return HttpClient(args.url)
+    else:
+        prepare_app()
+        make_client = TestClient
+
+    workload = Workload(random.Random(args.seed), args.customers, args.products)
+    warmup_client = make_client()
+    for _ in range(args.warmup):
+        status, data = warmup_client.request("POST", BASE_PATH, workload.new_order())
+        if status != 201:
+            print(f"Could not create warmup order: {status} {data}")
+            return 1
+        workload.remember(data)
+
+    results = {"latencies": {}, "errors": {}}
+    lock = threading.Lock()
+    per_thread, remainder = divmod(args.requests, args.concurrency)
+    threads = [
+        threading.Thread(
+            target=run_worker,
+            args=(make_client, workload, per_thread + (1 if i < remainder else 0), results, lock),
+        )
+        for i in range(args.concurrency)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    summary = summarize(results, elapsed)
+    print_summary(summary, elapsed)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as json_file:
+            json.dump(summary, json_file, indent=2)
+    return 1 if summary["total"]["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,134 @@
+"""
+Microbenchmarks for the Orders Service
+
+Measures the CPU cost of the code that runs on every request without going
+through HTTP or the database: serializing, validating and deserializing the models,
+parsing the query string arguments and marshalling the responses, for
+orders of different sizes.
+
+Usage:
+    python -m benchmarks.microbench                     # print the results
+    python -m benchmarks.microbench --save FILE         # store a baseline
+    python -m benchmarks.microbench --compare FILE      # fail on regressions
+
+The runner exits with status 1 when a benchmark is slower than its
+baseline by more than --threshold (25% by default). Baselines are only
+meaningful on the machine that recorded them, so none is committed, and
+--compare only prints the results when FILE does not exist.
+"""
+import os
+import sys
+import json
+import timeit
+import argparse
+import platform
+from datetime import date
+from benchmarks import configure_environment
+
+configure_environment()
+
+# pylint: disable=wrong-import-position
+from flask_restx import marshal  # noqa: E402
+from service import app  # noqa: E402
+from service.models import Order, OrderItem, OrderStatus  # noqa: E402
+from service.routes import item_model, order_args, order_model, validate_order  # noqa: E402
+
+PAYLOAD_SIZES = (1, 10, 100, 500)
+DEFAULT_THRESHOLD = 0.25
+
+
+def make_order(item_count: int) -> Order:
+    """Builds an unsaved Order with the given number of items"""
+    today = date.today()
+    items = [
+        OrderItem(id=i, product_id=i, quantity=i + 1, price=9.99, order_id=1, created_on=today, updated_on=today)
+        for i in range(item_count)
+    ]
+    return Order(id=1, customer_id=42, status=OrderStatus.CONFIRMED, items=items, created_on=today, updated_on=today)
+
+
+def build_benchmarks() -> dict:
+    """Returns the benchmarks to run, keyed by name"""
+    benchmarks = {}
+    for size in PAYLOAD_SIZES:
+        order = make_order(size)
+        data = order.serialize()
+        benchmarks[f"order_serialize[{size}]"] = order.serialize
+        benchmarks[f"order_deserialize[{size}]"] = lambda data=data: Order().deserialize(data)
+        benchmarks[f"order_validate_deserialize[{size}]"] = (
+            lambda data=data: Order().deserialize(validate_order(data), validated=True)
+        )
+        benchmarks[f"order_marshal[{size}]"] = lambda data=data: marshal(data, order_model)
+
+    item = make_order(1).items[0]
+    item_data = item.serialize()
+    benchmarks["item_serialize"] = item.serialize
+    benchmarks["item_deserialize"] = lambda: OrderItem().deserialize(item_data)
+    benchmarks["item_marshal"] = lambda: marshal(item_data, item_model)
+
+    def parse_args():
+        with app.test_request_context("/api/orders?customer_id=5&status=SHIPPED&product_id=7"):
+            return order_args.parse_args()
+    benchmarks["order_args_parse"] = parse_args
+    return benchmarks
+
+
+def measure(func, repeat: int) -> float:
+    """Returns the best time of one call to func in seconds"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def compare(baseline: dict, results: dict, threshold: float) -> list:
+    """Returns a description of every result that regressed past the threshold"""
+    regressions = []
+    for name, seconds in results.items():
+        reference = baseline.get(name)
+        if reference and seconds > reference * (1 + threshold):
+            regressions.append(
+                f"{name}: {seconds * 1e6:.1f} us vs {reference * 1e6:.1f} us (+{(seconds / reference - 1):.0%})"
+            )
+    return regressions
+
+
+def main(argv=None) -> int:
+    """Runs the benchmarks and reports or checks the results"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--save", metavar="FILE", help="write the results to FILE as a JSON baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare the results with the baseline in FILE")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed slowdown as a fraction of the baseline (default %(default)s)")
+    parser.add_argument("--repeat", type=int, default=5, help="timing runs per benchmark (default %(default)s)")
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this text")
+    args = parser.parse_args(argv)
+    if args.compare and not os.path.exists(args.compare):
+        # Baselines are not committed since they only hold for the machine that saved them
+        print(f"No baseline at {args.compare}, skipping the comparison (save one with --save)")
+        args.compare = None
+
+    results = {}
+    for name, func in build_benchmarks().items():
+        if args.filter in name:
+            results[name] = measure(func, args.repeat)
+            print(f"{name:<34} {results[name] * 1e6:>12.1f} us")
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as baseline_file:
+            json.dump({"python": platform.python_version(), "results": results}, baseline_file, indent=2)
+        print(f"Baseline written to {args.save}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+        regressions = compare(baseline, results, args.threshold)
+        if regressions:
+            print(f"Regressions over {args.threshold:.0%}:")
+            print("\n".join(f"  {line}" for line in regressions))
+            return 1
+        print(f"No regressions over {args.threshold:.0%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
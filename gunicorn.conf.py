@@ -0,0 +1,167 @@
+"""
+Gunicorn configuration for the Orders Service
+
+Gunicorn reads this file from the working directory on startup. Every
+setting can be overridden with an environment variable so that the same
+image can be tuned per deployment. Unless they are set explicitly, the
+number of workers and threads is derived from the CPU quota of the
+container (cgroup v1 or v2), falling back to the number of usable CPUs.
+
+Environment variables:
+    PORT                        - port to listen on (default 8080)
+    GUNICORN_BIND               - full bind address, overrides PORT
+    GUNICORN_PRELOAD            - load the app in the master before forking workers
+                                  so they share its memory copy-on-write (default true)
+    GUNICORN_LOG_LEVEL          - gunicorn log level (default info)
+    GUNICORN_WORKER_CLASS       - sync, gthread or gevent (default gthread)
+    GUNICORN_WORKERS            - number of worker processes (default from CPU quota)
+    GUNICORN_THREADS            - threads per gthread worker (default 4)
+    GUNICORN_WORKER_CONNECTIONS - concurrent connections per gevent worker (default 100)
+    GUNICORN_KEEPALIVE          - seconds to keep idle connections open (default 5)
+    GUNICORN_TIMEOUT            - seconds before a silent worker is restarted (default 30)
+    GUNICORN_GRACEFUL_TIMEOUT   - seconds to finish requests on restart (default 30)
+    GUNICORN_MAX_REQUESTS       - recycle a worker after this many requests (default 1000, 0 = never)
+    GUNICORN_MAX_REQUESTS_JITTER - random spread added to max requests (default 100)
+    PROMETHEUS_MULTIPROC_DIR    - where workers share their metrics (default <tmp>/orders-metrics)
+"""
+import os
+import sys
+import glob
+import tempfile
+from importlib.util import find_spec
+
+WORKER_CLASSES = ("sync", "gthread", "gevent")
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    """Reads a true/false flag from the environment"""
+    return os.getenv(name, str(default)).lower() in ("1", "true", "yes", "on")
+
+
+def _env_int(name: str, default: int) -> int:
+    """Reads an integer from the environment"""
+    return int(os.getenv(name, str(default)))
+
+
+def cpu_quota() -> float:
+    """Returns the number of CPUs this container may use
+
+    Kubernetes CPU limits are enforced with a CFS quota, which is not
+    reflected by os.cpu_count(), so the cgroup files are read first.
+    """
+    try:  # cgroup v2
+        with open("/sys/fs/cgroup/cpu.max", encoding="utf-8") as cpu_max:
+            quota, period = cpu_max.read().split()
+        if quota != "max":
+            return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:  # cgroup v1
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", encoding="utf-8") as quota_file:
+            quota = int(quota_file.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us", encoding="utf-8") as period_file:
+            period = int(period_file.read())
+        if quota > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    if hasattr(os, "sched_getaffinity"):
+        return float(len(os.sched_getaffinity(0)))
+    return float(os.cpu_count() or 1)
+
+
+def default_workers(worker_class: str, cpus: float) -> int:
+    """Returns the number of workers to run for the given CPU quota
+
+    Sync workers block on I/O, so the usual 2 x CPU + 1 is used. Threaded
+    and green workers overlap I/O themselves and only need about one
+    process per CPU. Fractional quotas never get more than one worker.
+    """
+    if cpus < 1:
+        return 1
+    if worker_class == "sync":
+        return int(cpus * 2) + 1
+    return round(cpus)
+
+
+CPU_QUOTA = cpu_quota()
+
+bind = os.getenv("GUNICORN_BIND", f"0.0.0.0:{os.getenv('PORT', '8080')}")
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+preload_app = _env_bool("GUNICORN_PRELOAD", True)
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+if worker_class not in WORKER_CLASSES:
+    raise ValueError(f"GUNICORN_WORKER_CLASS must be one of {WORKER_CLASSES}, not '{worker_class}'")
+workers = _env_int("GUNICORN_WORKERS", default_workers(worker_class, CPU_QUOTA))
+threads = _env_int("GUNICORN_THREADS", 4) if worker_class == "gthread" else 1
+worker_connections = _env_int("GUNICORN_WORKER_CONNECTIONS", 100)
+
+keepalive = _env_int("GUNICORN_KEEPALIVE", 5)
+timeout = _env_int("GUNICORN_TIMEOUT", 30)
+graceful_timeout = _env_int("GUNICORN_GRACEFUL_TIMEOUT", 30)
+max_requests = _env_int("GUNICORN_MAX_REQUESTS", 1000)
+max_requests_jitter = _env_int("GUNICORN_MAX_REQUESTS_JITTER", 100)
+
+if worker_class == "gevent":
+    # Patch before the app is preloaded so that every socket and lock it
+    # creates is cooperative, and let psycopg2 yield to the gevent hub
+    # instead of blocking the whole worker while waiting on Postgres
+    from gevent import monkey
+    monkey.patch_all()
+    if find_spec("psycopg2"):
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+# Every status stream holds a thread of its worker until it ends, which
+# takes longer than a sync worker may stay silent, so sync workers serve
+# none and gthread workers keep half of their threads for other requests
+os.environ.setdefault("STATUS_STREAM_MAX_STREAMS", str({
+    "sync": 0, "gthread": threads // 2, "gevent": worker_connections // 2,
+}[worker_class]))
+
+# The metrics of every worker are written to this directory so that
+# /metrics reports totals for the whole server. Samples left behind by a
+# previous run are removed by on_starting() below.
+METRICS_DIR = os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "orders-metrics")
+)
+os.makedirs(METRICS_DIR, exist_ok=True)
+
+
+######################################################################
+# Server hooks
+######################################################################
+def on_starting(server):
+    """Removes the metrics samples of a previous run before the first workers start
+
+    This file is read again on every reload (HUP), when the samples of the
+    running workers must be kept, so the cleanup is left to this hook,
+    which only runs once when the master starts.
+    """
+    stale_files = glob.glob(os.path.join(METRICS_DIR, "*.db"))
+    for stale_file in stale_files:
+        os.remove(stale_file)
+    server.log.info("Removed %d stale metrics file(s) from %s", len(stale_files), METRICS_DIR)
+
+
+def when_ready(server):
+    """Logs the worker sizing that was chosen"""
+    server.log.info(
+        "CPU quota %.2f: running %d %s worker(s) with %d thread(s) each",
+        CPU_QUOTA, workers, worker_class, threads,
+    )
+
+
+def post_fork(server, worker):  # pylint: disable=unused-argument
+    """Drops any database connections inherited from the master process"""
+    models = sys.modules.get("service.models")
+    if models is not None:
+        models.dispose_engine()
+    worker.log.info("Worker %s ready, database pool reset", worker.pid)
+
+
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    """Lets the metrics collector know that the worker has gone away"""
+    from prometheus_client import multiprocess  # pylint: disable=import-outside-toplevel
+    multiprocess.mark_process_dead(worker.pid)
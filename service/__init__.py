@@ -5,10 +5,16 @@ This module creates and configures the Flask app and sets up the logging
 and SQL database
 """
 import sys
+import time
 from flask import Flask
 from flask_restx import Api
 from service import config
-from service.common import log_handlers
+from service.common import (
+    cache, change_feed, group_commit, log_handlers, memory_store, metrics, missing_ids, outbox, profiling,
+    query_stats, sharding, single_flight, status_stream
+)
+
+START_TIME = time.perf_counter()
 
 # Create Flask application
 app = Flask(__name__)
@@ -39,6 +45,16 @@ from service.common import error_handlers, cli_commands  # noqa: F401, E402
 
 # Set up logging for production
 log_handlers.init_logging(app, "gunicorn.error")
+metrics.init_metrics(app)
+query_stats.init_query_stats(app)
+profiling.init_profiling(app)
+outbox.init_outbox(app)
+change_feed.init_change_feed(app)
+status_stream.init_status_stream(app)
+group_commit.init_group_commit(app)
+cache.init_cache(app)
+single_flight.init_single_flight(app)
+missing_ids.init_missing_ids(app)
 
 app.logger.info(70 * "*")
 app.logger.info("  S E R V I C E   R U N N I N G  ".center(70, "*"))
@@ -46,9 +62,15 @@ app.logger.info(70 * "*")
 
 try:
     models.init_db(app)  # make our SQLAlchemy tables
+    sharding.init_sharding(app)
+    memory_store.init_storage(app)
 except Exception as error:  # pylint: disable=broad-except
     app.logger.critical("%s: Cannot continue", error)
     # gunicorn requires exit code 4 to stop spawning workers when they die
     sys.exit(4)
 
-app.logger.info("Service initialized!")
+app.logger.info(
+    "Service initialized in %.3f seconds (DB_INIT_MODE=%s)",
+    time.perf_counter() - START_TIME,
+    app.config["DB_INIT_MODE"],
+)
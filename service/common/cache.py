@@ -0,0 +1,282 @@
+"""
+Order Cache
+
+This module caches the serialized results of order reads in two tiers: a
+small LRU cache in every worker (L1) and a cache that is shared by all
+workers and pods (L2), usually a Redis server. Requests for the same order
+are spread across workers, so the shared tier is what gives a good hit
+rate, and the local tier saves the round trip for the hottest keys.
+
+Keys are versioned instead of deleted on writes. Every order has a version
+number in L2, and so do the order lists as a whole. A cached value is
+stored under the versions that were current when it was loaded, and every
+commit that changes orders increments their versions (see
+on_orders_committed), so that no worker can find an outdated value again.
+Reading the versions costs one small L2 lookup per request, even when the
+value itself is found in L1.
+
+When a hot key is missing, only one worker loads it from the database
+while the others wait up to ORDER_CACHE_LOCK_WAIT_MS for its result.
+
+Caches are chosen with ORDER_CACHE:
+    redis://localhost:6379/0 - shares the cache through a Redis server
+    memory://                - keeps the shared tier in memory, for tests
+                               and single process deployments
+"""
+import json
+import time
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit
+from flask import Flask, current_app
+from service.outbox_events import on_orders_committed
+from service.common.metrics import CACHE_LOOKUPS
+
+_MISSING = object()
+LIST_NAMESPACE = "orders"
+
+
+######################################################################
+#  L O C A L   T I E R
+######################################################################
+class LRUCache:
+    """A thread-safe least recently used cache with a time to live"""
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 60.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns the value of a key, or default if it is missing or expired"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] < time.monotonic():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        """Stores a value, evicting the least recently used one if full"""
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def discard(self, key):
+        """Removes a value if it is cached"""
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """Removes every value"""
+        with self.lock:
+            self.entries.clear()
+
+
+######################################################################
+#  S H A R E D   T I E R
+######################################################################
+class MemoryBackend:
+    """Keeps the shared tier in memory, a stand-in for a Redis server"""
+
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get_many(self, keys: list) -> list:
+        """Returns the values of the keys, None for the missing ones"""
+        now = time.monotonic()
+        with self.lock:
+            values = []
+            for key in keys:
+                value, expires = self.data.get(key, (None, None))
+                if expires is not None and expires < now:
+                    del self.data[key]
+                    value = None
+                values.append(value)
+            return values
+
+    def set(self, key: str, value: str, ttl: float):
+        """Stores a value for ttl seconds"""
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + ttl)
+
+    def add(self, key: str, value: str, ttl: float) -> bool:
+        """Stores a value only if the key is missing, returns whether it did"""
+        if self.get_many([key])[0] is not None:
+            return False
+        with self.lock:
+            if key in self.data:
+                return False
+            self.data[key] = (value, time.monotonic() + ttl)
+            return True
+
+    def delete(self, key: str):
+        """Removes a key"""
+        with self.lock:
+            self.data.pop(key, None)
+
+    def incr_many(self, keys: list):
+        """Increments counters that never expire"""
+        with self.lock:
+            for key in keys:
+                value, _ = self.data.get(key, (0, None))
+                self.data[key] = (int(value) + 1, None)
+
+
+class RedisBackend:
+    """Keeps the shared tier in a Redis server"""
+
+    def __init__(self, url: str, timeout: float = 0.5):
+        try:
+            import redis  # pylint: disable=import-outside-toplevel
+        except ImportError as error:
+            raise ValueError("ORDER_CACHE with redis:// needs the redis package to be installed") from error
+        self.client = redis.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+
+    def get_many(self, keys: list) -> list:
+        """Returns the values of the keys, None for the missing ones"""
+        return self.client.mget(keys)
+
+    def set(self, key: str, value: str, ttl: float):
+        """Stores a value for ttl seconds"""
+        self.client.set(key, value, px=int(ttl * 1000))
+
+    def add(self, key: str, value: str, ttl: float) -> bool:
+        """Stores a value only if the key is missing, returns whether it did"""
+        return bool(self.client.set(key, value, nx=True, px=int(ttl * 1000)))
+
+    def delete(self, key: str):
+        """Removes a key"""
+        self.client.delete(key)
+
+    def incr_many(self, keys: list):
+        """Increments counters that never expire, with a single round trip"""
+        pipeline = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.incr(key)
+        pipeline.execute()
+
+
+def make_backend(url: str):
+    """Returns the shared tier for a redis:// or memory:// URL"""
+    scheme = urlsplit(url).scheme
+    if scheme in ("redis", "rediss", "unix"):
+        return RedisBackend(url)
+    if scheme == "memory":
+        return MemoryBackend()
+    raise ValueError(f"Unsupported ORDER_CACHE '{url}', use redis:// or memory://")
+
+
+######################################################################
+#  T I E R E D   C A C H E
+######################################################################
+class TieredCache:
+    """Looks values up in the local tier, then the shared tier, then loads them"""
+
+    def __init__(self, backend, prefix: str = "orders:", ttl: float = 300.0, local_size: int = 10000,
+                 local_ttl: float = 60.0, lock_seconds: float = 5.0, lock_wait: float = 0.2):
+        # pylint: disable=too-many-arguments
+        self.backend = backend
+        self.prefix = prefix
+        self.ttl = ttl
+        self.local = LRUCache(local_size, local_ttl)
+        self.lock_seconds = lock_seconds
+        self.lock_wait = lock_wait
+
+    def get_or_load(self, namespace: str, key: str, loader):
+        """Returns the cached value of a key, or caches the result of loader()
+
+        The value is dropped as soon as the version of its namespace changes,
+        e.g. order:7 for an order or LIST_NAMESPACE for the order lists.
+        Nothing is cached when loader() returns None.
+        """
+        try:
+            version = self.backend.get_many([self._version_key(namespace)])[0]
+            full_key = f"{self.prefix}{key}@{int(version or 0)}"
+            value = self.local.get(full_key, _MISSING)
+            if value is not _MISSING:
+                CACHE_LOOKUPS.labels("local", "hit").inc()
+                return value
+            value = self._shared(full_key)
+        except Exception as error:  # pylint: disable=broad-except
+            # The cache is only an optimization, the database has the answer
+            current_app.logger.warning("Order cache unavailable: %s", error)
+            CACHE_LOOKUPS.labels("shared", "error").inc()
+            return loader()
+        if value is not _MISSING:
+            CACHE_LOOKUPS.labels("shared", "hit").inc()
+            return value
+        CACHE_LOOKUPS.labels("shared", "miss").inc()
+        return self._load(full_key, loader)
+
+    def invalidate(self, order_ids):
+        """Moves the orders and the order lists to new versions"""
+        keys = [self._version_key(f"order:{order_id}") for order_id in order_ids]
+        keys.append(self._version_key(LIST_NAMESPACE))
+        try:
+            self.backend.incr_many(keys)
+        except Exception as error:  # pylint: disable=broad-except
+            current_app.logger.error("Cannot invalidate the order cache: %s", error)
+
+    def _version_key(self, namespace: str) -> str:
+        return f"{self.prefix}version:{namespace}"
+
+    def _shared(self, full_key: str):
+        """Returns a value from the shared tier and keeps it locally, or _MISSING"""
+        data = self.backend.get_many([full_key])[0]
+        if data is None:
+            return _MISSING
+        value = json.loads(data)
+        self.local.set(full_key, value)
+        return value
+
+    def _load(self, full_key: str, loader):
+        """Loads a missing value, letting only one worker at a time hit the database"""
+        lock_key = f"{full_key}:lock"
+        try:
+            locked = self.backend.add(lock_key, "1", self.lock_seconds)
+        except Exception:  # pylint: disable=broad-except
+            locked = False
+        if not locked:
+            # Another worker is loading the value, wait for its result
+            deadline = time.monotonic() + self.lock_wait
+            while time.monotonic() < deadline:
+                time.sleep(0.01)
+                value = self._shared(full_key)
+                if value is not _MISSING:
+                    return value
+            return loader()
+        try:
+            value = loader()
+            if value is not None:
+                self.backend.set(full_key, json.dumps(value, separators=(",", ":")), self.ttl)
+                self.local.set(full_key, value)
+            return value
+        finally:
+            self.backend.delete(lock_key)
+
+
+def init_cache(app: Flask):
+    """Caches order reads if ORDER_CACHE is set"""
+    url = app.config.get("ORDER_CACHE")
+    if not url:
+        return None
+    cache = TieredCache(
+        make_backend(url),
+        app.config.get("ORDER_CACHE_PREFIX", "orders:"),
+        app.config.get("ORDER_CACHE_TTL_SECONDS", 300),
+        app.config.get("ORDER_CACHE_LOCAL_SIZE", 10000),
+        app.config.get("ORDER_CACHE_LOCAL_TTL_SECONDS", 60),
+        app.config.get("ORDER_CACHE_LOCK_SECONDS", 5),
+        app.config.get("ORDER_CACHE_LOCK_WAIT_MS", 200) / 1000,
+    )
+    on_orders_committed(cache.invalidate)
+    app.extensions["order_cache"] = cache
+    return cache
@@ -0,0 +1,139 @@
+"""
+Order Change Feed
+
+This module serves GET /orders/changes, which lets sync jobs pull only the
+orders that changed since they last asked, instead of downloading every
+order again. It reads the order_event table that every change of an order
+or an item is written to (see service.outbox_events), whose ids only ever
+increase and serve as the cursor.
+
+The orders that changed after a cursor are returned with their current
+state, and orders that were deleted as tombstones. Several changes of an
+order are folded into one, so a client that applies the changes in order
+ends up with the same orders as the database. A client starts by reading
+the current cursor, then downloads GET /orders once, and from then on only
+asks for the changes after the last cursor it was given.
+
+Event ids are taken when an event is inserted, not when it commits, so a
+transaction can commit an id after a higher one was already served. An id
+that is missing from the events is therefore taken to belong to such a
+transaction, and the feed stops before it, until the event after it is
+older than CHANGE_FEED_SAFETY_LAG_SECONDS; then the id is taken to belong
+to a transaction that rolled back. For the same reason the current cursor
+is the one before the events of the last CHANGE_FEED_SAFETY_LAG_SECONDS.
+Transactions that write events must be shorter than that, and the clocks
+of the workers must agree to well within it.
+
+A request may wait for changes (long polling). Waiters are woken up by
+every commit of this process that wrote events, and otherwise check the
+database every CHANGE_FEED_POLL_SECONDS for changes of other processes.
+"""
+import time
+import threading
+from datetime import datetime, timedelta
+from flask import Flask
+from service.models import db, Order
+from service.outbox_events import OrderEvent, on_events_committed
+
+
+class ChangeNotifier:
+    """Wakes up the requests that are waiting for changes"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.version = 0
+
+    def notify(self):
+        """Lets the waiting requests know that there are new changes"""
+        with self.condition:
+            self.version += 1
+            self.condition.notify_all()
+
+    def wait(self, version: int, timeout: float) -> bool:
+        """Waits until notify() was called after version was read, or for timeout seconds"""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.version != version, timeout)
+
+
+notifier = ChangeNotifier()
+
+
+class StaleCursorError(Exception):
+    """Raised when the changes after a cursor are no longer kept"""
+
+
+def current_cursor(lag: float = 5.0) -> int:
+    """Returns the cursor of the latest change that no transaction in flight can precede"""
+    recent = OrderEvent.first_written_after(datetime.utcnow() - timedelta(seconds=lag))
+    if recent is not None:
+        return recent - 1
+    newest = OrderEvent.cursor_range()[1]
+    return newest or 0
+
+
+def read_changes(cursor: int, limit: int, timeout: float = 0, poll_seconds: float = 1.0, lag: float = 5.0) -> dict:
+    """Returns the orders that changed after the cursor
+
+    If there are none, waits up to timeout seconds for the next change.
+    The result holds the changes, the cursor to continue from, and whether
+    more changes are waiting after them.
+    """
+    _check_cursor(cursor)
+    deadline = time.monotonic() + timeout
+    while True:
+        version = notifier.version
+        fetched = OrderEvent.changed_orders(cursor, limit)
+        rows = settled(fetched, cursor, lag)
+        remaining = deadline - time.monotonic()
+        if rows or remaining <= 0:
+            break
+        db.session.rollback()  # do not hold a transaction open while waiting
+        notifier.wait(version, min(remaining, poll_seconds))
+    if not rows:
+        return {"cursor": cursor, "has_more": False, "changes": []}
+    order_ids = list(dict.fromkeys(row.order_id for row in rows))
+    orders = {order.id: order for order in Order.find_many(order_ids)}
+    changes = []
+    for order_id in order_ids:
+        order = orders.get(order_id)
+        if order is None:
+            changes.append({"id": order_id, "op": "delete", "order": None})
+        else:
+            changes.append({"id": order_id, "op": "upsert", "order": order.serialize()})
+    return {"cursor": rows[-1].id, "has_more": len(rows) == limit, "changes": changes}
+
+
+def settled(rows: list, cursor: int, lag: float) -> list:
+    """Returns the rows before the first missing id that a transaction in flight may still commit
+
+    With sharded Orders the events commit before the changes of the other
+    shards, so only the events older than the lag are settled.
+    """
+    horizon = datetime.utcnow() - timedelta(seconds=lag)
+    sharded = Order.shards is not None
+    expected = cursor + 1
+    for index, row in enumerate(rows):
+        if (row.id != expected or sharded) and row.created_at > horizon:
+            return rows[:index]
+        expected = row.id + 1
+    return rows
+
+
+def _check_cursor(cursor: int):
+    """Raises a StaleCursorError if events after the cursor were purged
+
+    Ids lost to transactions that rolled back can make a very old cursor
+    look stale as well, which only costs the client a full read.
+    """
+    oldest = OrderEvent.cursor_range()[0]
+    if oldest is not None and cursor < oldest - 1:
+        raise StaleCursorError(
+            f"Changes after cursor {cursor} are no longer kept, read GET /orders again "
+            "and continue from a new cursor."
+        )
+
+
+def init_change_feed(app: Flask):
+    """Wakes up the waiting requests after every commit that changed orders"""
+    on_events_committed(notifier.notify)
+    app.extensions["change_notifier"] = notifier
@@ -1,8 +1,12 @@
 """
 Flask CLI Command Extensions
 """
+import time
+import threading
+import click
 from service import app
-from service.models import db
+from service.models import db, create_indexes, OrderStatus
+from service.common import data_generator, outbox
 
 
 ######################################################################
@@ -19,3 +23,117 @@ def db_create():
     db.drop_all()
     db.create_all()
     db.session.commit()
+
+
+######################################################################
+# Command to create any missing tables
+# Usage:
+#   flask db-init
+######################################################################
+@app.cli.command("db-init")
+def db_init():
+    """
+    Creates any missing tables and indexes without touching existing data.
+    Use this when the service is started with DB_INIT_MODE set to check or skip.
+    """
+    db.create_all()
+    create_indexes()
+    db.session.commit()
+
+
+######################################################################
+# Command to generate synthetic orders
+# Usage:
+#   flask orders-seed --orders 1000000 --workers 8
+######################################################################
+def _weights(convert):
+    """Returns a click callback that parses 'value:weight,...' options"""
+    def callback(ctx, param, value):  # pylint: disable=unused-argument
+        try:
+            return data_generator.parse_weights(value, convert)
+        except (KeyError, ValueError) as error:
+            raise click.BadParameter(f"expected value:weight pairs, {error}") from error
+    return callback
+
+
+@app.cli.command("orders-seed")
+@click.option("--orders", "count", type=click.IntRange(min=1), default=1000, show_default=True,
+              help="Number of orders to generate")
+@click.option("--customers", type=click.IntRange(min=1), default=10000, show_default=True,
+              help="Number of distinct customer ids")
+@click.option("--products", type=click.IntRange(min=1), default=5000, show_default=True,
+              help="Number of distinct product ids")
+@click.option("--items", "item_counts", default="0:5,1:35,2:25,3:15,5:12,10:6,25:2", show_default=True,
+              callback=_weights(int), help="Items per order as count:weight pairs")
+@click.option("--statuses", default="CONFIRMED:30,IN_PROGRESS:15,SHIPPED:20,DELIVERED:30,CANCELLED:5",
+              show_default=True, callback=_weights(lambda name: OrderStatus[name]),
+              help="Order statuses as STATUS:weight pairs")
+@click.option("--batch-size", type=click.IntRange(min=1), default=10000, show_default=True,
+              help="Orders written per transaction")
+@click.option("--workers", type=click.IntRange(min=1), default=4, show_default=True,
+              help="Batches written in parallel (always 1 on SQLite)")
+@click.option("--seed", "random_seed", type=int, default=None, help="Random seed for repeatable data")
+def orders_seed(count, customers, products, item_counts, statuses, batch_size, workers, random_seed):
+    # pylint: disable=too-many-arguments
+    """
+    Generates synthetic orders and items and bulk loads them into the
+    database. Existing data is kept.
+    """
+    # The bulk load writes to the database of SQLALCHEMY_DATABASE_URI with ids of its own
+    if app.config.get("ORDER_SHARDS"):
+        raise click.UsageError("orders-seed does not spread orders over ORDER_SHARDS, unset it to seed")
+    if app.config.get("ORDER_STORAGE", "sql") != "sql":
+        raise click.UsageError("orders-seed writes to the database, it cannot seed ORDER_STORAGE=memory")
+    generator = data_generator.OrderGenerator(customers, products, item_counts, statuses, random_seed)
+    lock = threading.Lock()
+    written = [0]
+
+    def progress(size):
+        with lock:
+            written[0] += size
+            click.echo(f"  {written[0]}/{count} orders written")
+
+    start = time.perf_counter()
+    item_total = data_generator.seed(generator, count, batch_size, workers, progress)
+    elapsed = time.perf_counter() - start
+    click.echo(
+        f"Seeded {count} orders and {item_total} items in {elapsed:.1f} s "
+        f"({(count + item_total) / elapsed:,.0f} rows/s)"
+    )
+
+
+######################################################################
+# Command to deliver the events of the order outbox
+# Usage:
+#   flask outbox-publish --sink file:///var/lib/orders/events.jsonl
+######################################################################
+@app.cli.command("outbox-publish")
+@click.option("--sink", default=lambda: app.config["OUTBOX_SINK"], show_default="OUTBOX_SINK",
+              help="Where to deliver the events, e.g. file:///path, unix:///path or tcp://host:port")
+@click.option("--once", is_flag=True, help="Deliver the events that are waiting and exit")
+def outbox_publish(sink, once):
+    """
+    Delivers the order events of the outbox to a sink, in batches of
+    OUTBOX_BATCH_SIZE, until it is interrupted.
+    """
+    if not sink:
+        raise click.UsageError("Set OUTBOX_SINK or pass --sink")
+    try:
+        events_sink = outbox.make_sink(sink)
+    except ValueError as error:
+        raise click.BadParameter(str(error), param_hint="--sink") from error
+    publisher = outbox.OutboxPublisher(
+        app,
+        events_sink,
+        app.config["OUTBOX_BATCH_SIZE"],
+        app.config["OUTBOX_POLL_SECONDS"],
+        app.config["OUTBOX_RETENTION_SECONDS"],
+    )
+    if once:
+        click.echo(f"Published {publisher.drain()} events")
+        return
+    click.echo(f"Publishing order events to {sink}, press Ctrl-C to stop")
+    try:
+        publisher.run()
+    except KeyboardInterrupt:
+        publisher.stop()
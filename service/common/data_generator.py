@@ -0,0 +1,146 @@
+"""
+Synthetic Data Generator
+
+This module generates large numbers of realistic orders and loads them
+into the database in batches. It is used by the `flask orders-seed`
+command to create enough volume to benchmark queries, indexes and
+pagination.
+
+Ids are assigned up front so that batches are independent of each other
+and can be written in parallel. On PostgreSQL every batch is streamed
+with COPY, on other databases it is written with multi-row INSERTs.
+"""
+import io
+import csv
+import random
+import threading
+from datetime import date, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import func, select, text
+from service.models import db, Order, OrderItem, OrderStatus
+
+ORDER_COLUMNS = ("id", "customer_id", "status", "created_on", "updated_on")
+ITEM_COLUMNS = ("id", "product_id", "quantity", "price", "order_id", "created_on", "updated_on")
+
+
+def parse_weights(value: str, convert=int) -> tuple:
+    """Parses 'value:weight,value:weight' into a tuple of values and weights"""
+    values, weights = [], []
+    for pair in value.split(","):
+        choice, _, weight = pair.partition(":")
+        values.append(convert(choice.strip()))
+        weights.append(float(weight) if weight else 1.0)
+    if any(weight < 0 for weight in weights) or not sum(weights):
+        raise ValueError("weights must be positive")
+    return values, weights
+
+
+class OrderGenerator:
+    """Generates batches of order and item rows with pre-assigned ids"""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, customers: int, products: int, item_counts: tuple, statuses: tuple, seed=None):
+        self.rng = random.Random(seed)
+        self.customers = customers
+        self.products = products
+        self.item_counts = item_counts
+        self.statuses = statuses
+        self.today = date.today()
+
+    def batch(self, first_order_id: int, first_item_id: int, size: int) -> tuple:
+        """Returns the order rows and item rows of a batch of orders"""
+        rng = self.rng
+        statuses = rng.choices(self.statuses[0], weights=self.statuses[1], k=size)
+        item_counts = rng.choices(self.item_counts[0], weights=self.item_counts[1], k=size)
+        orders, items = [], []
+        item_id = first_item_id
+        for offset in range(size):
+            order_id = first_order_id + offset
+            created_on = self.today - timedelta(days=rng.randrange(365))
+            updated_on = created_on + timedelta(days=rng.randrange((self.today - created_on).days + 1))
+            orders.append((order_id, rng.randrange(self.customers), statuses[offset], created_on, updated_on))
+            for _ in range(item_counts[offset]):
+                items.append((
+                    item_id, rng.randrange(self.products), rng.randint(1, 10),
+                    round(rng.uniform(0.5, 500), 2), order_id, created_on, updated_on,
+                ))
+                item_id += 1
+        return orders, items
+
+
+def next_ids() -> tuple:
+    """Returns the first free order id and item id"""
+    order_id = db.session.execute(select(func.max(Order.id))).scalar() or 0
+    item_id = db.session.execute(select(func.max(OrderItem.id))).scalar() or 0
+    db.session.commit()
+    return order_id + 1, item_id + 1
+
+
+def write_batch(engine, orders: list, items: list):
+    """Writes one batch of orders and their items in a single transaction"""
+    with engine.begin() as conn:
+        if engine.dialect.name == "postgresql":
+            cursor = conn.connection.cursor()
+            _copy(cursor, Order.__tablename__, ORDER_COLUMNS, orders)
+            _copy(cursor, OrderItem.__tablename__, ITEM_COLUMNS, items)
+            cursor.close()
+        else:
+            conn.execute(Order.__table__.insert(), [dict(zip(ORDER_COLUMNS, row)) for row in orders])
+            if items:
+                conn.execute(OrderItem.__table__.insert(), [dict(zip(ITEM_COLUMNS, row)) for row in items])
+
+
+def _copy(cursor, table: str, columns: tuple, rows: list):
+    """Streams rows into a PostgreSQL table with COPY"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(value.name if isinstance(value, OrderStatus) else value for value in row)
+    buffer.seek(0)
+    cursor.copy_expert(f'COPY "{table}" ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)', buffer)
+
+
+def reset_sequences(engine):
+    """Moves the id sequences past the ids that were assigned explicitly"""
+    if engine.dialect.name != "postgresql":
+        return  # other databases continue from the highest id on their own
+    with engine.begin() as conn:
+        for table in (Order.__tablename__, OrderItem.__tablename__):
+            quoted = f'"{table}"'  # order is a reserved word
+            conn.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{quoted}', 'id'), "
+                f"(SELECT COALESCE(MAX(id), 1) FROM {quoted}))"
+            ))
+
+
+def seed(generator: OrderGenerator, count: int, batch_size: int, workers: int, progress=None) -> int:
+    """Generates and writes count orders, returning the number of items
+
+    Batches are generated on this thread and written by a pool of worker
+    threads, each with its own connection. At most two batches per worker
+    are kept in memory at any time.
+    """
+    engine = db.engine
+    if engine.dialect.name == "sqlite":
+        workers = 1  # SQLite only allows one writer at a time
+    order_id, item_id = next_ids()
+    item_total = 0
+    in_flight = threading.BoundedSemaphore(workers * 2)
+    futures = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for start in range(0, count, batch_size):
+            size = min(batch_size, count - start)
+            orders, items = generator.batch(order_id, item_id, size)
+            order_id += size
+            item_id += len(items)
+            item_total += len(items)
+            in_flight.acquire()  # pylint: disable=consider-using-with
+            future = executor.submit(write_batch, engine, orders, items)
+            future.add_done_callback(lambda _: in_flight.release())
+            if progress:
+                future.add_done_callback(lambda _, written=size: progress(written))
+            futures.append(future)
+        for future in futures:
+            future.result()  # raise the first error, if any
+    reset_sequences(engine)
+    return item_total
@@ -33,5 +33,6 @@ def request_validation_error(error):
     return {
         'status_code': status.HTTP_400_BAD_REQUEST,
         'error': 'Bad Request',
-        'message': message
+        'message': message,
+        'errors': error.errors
     }, status.HTTP_400_BAD_REQUEST
@@ -0,0 +1,89 @@
+"""
+Group Commit of Order Items
+
+During flash sales thousands of items are added at the same time, and
+every POST /orders/{id}/items waits for a commit, i.e. a WAL flush on
+PostgreSQL, of its own. With ITEM_GROUP_COMMIT the items that are added
+by the requests of a worker within a few milliseconds are written with a
+single commit instead.
+
+The first request of a batch becomes its leader. It waits until the batch
+holds ITEM_GROUP_COMMIT_MAX_BATCH items or ITEM_GROUP_COMMIT_MAX_WAIT_MS
+have passed, and then writes the whole batch with its own session while
+the other requests wait for it. If the batch cannot be committed, every
+item is written on its own, so each request still gets its own result or
+error.
+"""
+import threading
+from flask import Flask, current_app
+from service.models import OrderItem
+
+
+class _Batch:
+    """The items that are committed together"""
+
+    def __init__(self):
+        self.items = []
+        self.errors = {}
+        self.full = threading.Event()
+        self.done = threading.Event()
+
+
+class GroupCommitter:
+    """Collects the items of concurrent requests into batches"""
+
+    def __init__(self, max_batch: int = 64, max_wait: float = 0.005):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        self.batch = None
+
+    def create(self, item: OrderItem):
+        """Creates an item together with the items of other requests
+
+        Returns once the item is committed, or raises the error that
+        prevented it from being created.
+        """
+        with self.lock:
+            batch = self.batch
+            leader = batch is None
+            if leader:
+                batch = self.batch = _Batch()
+            index = len(batch.items)
+            batch.items.append(item)
+            if len(batch.items) >= self.max_batch:
+                self.batch = None  # later requests start a new batch
+                batch.full.set()
+        if leader:
+            batch.full.wait(self.max_wait)
+            with self.lock:
+                if self.batch is batch:
+                    self.batch = None
+            self._commit(batch)
+        else:
+            batch.done.wait()
+        if index in batch.errors:
+            raise batch.errors[index]
+
+    @staticmethod
+    def _commit(batch: _Batch):
+        """Writes the items of a batch and wakes up the requests waiting for it"""
+        try:
+            batch.errors = OrderItem.create_batch(batch.items)
+            current_app.logger.debug("Group commit of %d items", len(batch.items))
+        except Exception as error:  # pylint: disable=broad-except
+            batch.errors = dict.fromkeys(range(len(batch.items)), error)
+        finally:
+            batch.done.set()
+
+
+def init_group_commit(app: Flask):
+    """Batches the commits of new Order Items if ITEM_GROUP_COMMIT is set"""
+    if not app.config.get("ITEM_GROUP_COMMIT"):
+        return None
+    committer = GroupCommitter(
+        app.config.get("ITEM_GROUP_COMMIT_MAX_BATCH", 64),
+        app.config.get("ITEM_GROUP_COMMIT_MAX_WAIT_MS", 5) / 1000,
+    )
+    app.extensions["item_group_commit"] = committer
+    return committer
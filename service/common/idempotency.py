@@ -0,0 +1,127 @@
+"""
+Idempotent Requests
+
+This module lets clients retry a POST safely by sending an
+Idempotency-Key header. The first request with a key is processed
+normally and its response is stored together with a hash of the request
+body and query string. A retry with the same key and body gets the stored response back
+without touching the order tables, which costs a single primary key
+lookup. Reusing a key for a different body, or while the first request
+is still being processed, is answered with 409 Conflict.
+
+A key is held for IDEMPOTENCY_LOCK_SECONDS while its request is being
+processed, so that a worker that dies halfway does not block retries for
+good, and the response is kept for IDEMPOTENCY_TTL_SECONDS. Expired keys
+are purged at most once a minute by each worker. Only successful
+responses are stored, a failed request can simply be retried.
+"""
+import json
+import time
+import hashlib
+import functools
+import threading
+from flask import current_app, request
+from flask_restx import abort
+from flask_restx.utils import unpack
+from sqlalchemy.exc import IntegrityError
+from service.models import db
+from service.idempotency_keys import IdempotencyKey
+from service.common import status
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+PURGE_INTERVAL = 60  # seconds
+
+_purge_lock = threading.Lock()
+_last_purge = 0.0
+
+
+def idempotent(func):
+    """Makes a POST method of a Resource replay its response for a repeated Idempotency-Key"""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if key is None:
+            return func(*args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            _abort(status.HTTP_400_BAD_REQUEST, f"{IDEMPOTENCY_HEADER} must be 1 to {MAX_KEY_LENGTH} characters.")
+        scope = f"{request.method} {request.path}"
+        digest = hashlib.sha256(request.get_data())
+        if request.query_string:
+            digest.update(b"?" + request.query_string)  # e.g. ?merge=true changes the request
+        request_hash = digest.hexdigest()
+        entry = IdempotencyKey.find(key, scope)
+        if entry is None:
+            entry = IdempotencyKey(
+                key=key,
+                scope=scope,
+                request_hash=request_hash,
+                expires_at=IdempotencyKey.expiry(current_app.config.get("IDEMPOTENCY_LOCK_SECONDS", 60)),
+            )
+            try:
+                entry.create()
+            except IntegrityError:
+                # Another request with the same key got there first
+                entry = IdempotencyKey.find(key, scope)
+            else:
+                return _process(entry, func, args, kwargs)
+        return _replay(entry, key, request_hash)
+
+    return wrapper
+
+
+def _process(entry: IdempotencyKey, func, args, kwargs):
+    """Runs the request and stores its response if it succeeded"""
+    try:
+        result = func(*args, **kwargs)
+    except Exception:
+        db.session.rollback()
+        entry.delete()
+        raise
+    data, code, headers = unpack(result)
+    if 200 <= code < 300:
+        entry.complete(
+            code,
+            json.dumps(data, separators=(",", ":")),
+            headers.get("Location"),
+            IdempotencyKey.expiry(current_app.config.get("IDEMPOTENCY_TTL_SECONDS", 86400)),
+        )
+        _purge_if_due()
+    else:
+        entry.delete()
+    return result
+
+
+def _replay(entry: IdempotencyKey, key: str, request_hash: str):
+    """Returns the stored response of a repeated request"""
+    if entry is None or entry.in_progress:
+        _abort(status.HTTP_409_CONFLICT, f"A request with {IDEMPOTENCY_HEADER} '{key}' is still in progress.")
+    if entry.request_hash != request_hash:
+        _abort(
+            status.HTTP_409_CONFLICT,
+            f"{IDEMPOTENCY_HEADER} '{key}' was already used for a different request.",
+        )
+    current_app.logger.info("Replaying the response for %s '%s'", IDEMPOTENCY_HEADER, key)
+    headers = {REPLAYED_HEADER: "true"}
+    if entry.location:
+        headers["Location"] = entry.location
+    return json.loads(entry.body), entry.status_code, headers
+
+
+def _purge_if_due():
+    """Deletes the expired keys if this worker has not done so recently"""
+    global _last_purge  # pylint: disable=global-statement
+    now = time.monotonic()
+    with _purge_lock:
+        if now - _last_purge < PURGE_INTERVAL:
+            return
+        _last_purge = now
+    IdempotencyKey.purge_expired()
+
+
+def _abort(error_code: int, message: str):
+    """Logs errors before aborting"""
+    current_app.logger.error(message)
+    abort(error_code, message)
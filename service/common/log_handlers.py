@@ -19,18 +19,149 @@ Log Handlers
 
 This module contains utility functions to set up logging
 consistently
+
+Log records of the app are put on a queue and written out by a
+background thread, so a request never waits for log I/O. Records can be
+formatted as compact JSON (LOG_FORMAT=json), and the INFO and DEBUG
+records of busy routes can be sampled per request with LOG_SAMPLING,
+e.g. "GET order_resource=0.01,GET order_collection=0.1".
 """
+import os
+import json
+import queue
+import atexit
+import random
 import logging
+from logging.handlers import QueueHandler, QueueListener
+from flask import has_request_context, request
+from service.common.metrics import endpoint_name
+
+TEXT_FORMAT = "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S %z"
+SAMPLED_KEY = "orders.log_sampled"
 
 
 def init_logging(app, logger_name: str):
-    """Set up logging for production"""
+    """Set up logging for production
+
+    Returns the LogPipeline that writes out the records, or None if the
+    records are handled right away because there are no handlers.
+    """
     app.logger.propagate = False
     gunicorn_logger = logging.getLogger(logger_name)
-    app.logger.handlers = gunicorn_logger.handlers
+    handlers = list(gunicorn_logger.handlers)
     app.logger.setLevel(gunicorn_logger.level)
     # Make all log formats consistent
-    formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z")
-    for handler in app.logger.handlers:
+    if app.config.get("LOG_FORMAT") == "json":
+        formatter = JsonFormatter(datefmt=DATE_FORMAT)
+    else:
+        formatter = logging.Formatter(TEXT_FORMAT, DATE_FORMAT)
+    for handler in handlers:
         handler.setFormatter(formatter)
+    pipeline = None
+    if handlers:
+        # Writing to the real handlers is left to a background thread
+        pipeline = LogPipeline(handlers)
+        pipeline.queue_handler.addFilter(RouteSampler(parse_sampling(app.config.get("LOG_SAMPLING", ""))))
+        app.logger.handlers = [pipeline.queue_handler]
+        pipeline.start()
+    else:
+        app.logger.handlers = handlers
     app.logger.info("Logging handler established")
+    return pipeline
+
+
+def parse_sampling(value: str) -> dict:
+    """Parses 'METHOD endpoint=rate,...' into a dictionary of sample rates"""
+    rates = {}
+    for entry in filter(None, (part.strip() for part in value.split(","))):
+        route, _, rate = entry.partition("=")
+        method, _, endpoint = route.strip().partition(" ")
+        rates[(method.upper(), endpoint.strip())] = float(rate)
+    return rates
+
+
+######################################################################
+#  L O G   P I P E L I N E
+######################################################################
+class LogPipeline:
+    """Moves log records from a queue to the real handlers on a thread
+
+    Threads do not survive a fork, so a process that was forked after
+    the pipeline was started (e.g. a preloaded gunicorn worker) gets a
+    new queue and a new listener thread of its own.
+    """
+
+    def __init__(self, handlers: list):
+        self.handlers = handlers
+        self.queue_handler = QueueHandler(queue.SimpleQueue())
+        self.listener = None
+
+    def start(self):
+        """Starts writing out queued records"""
+        self.listener = QueueListener(self.queue_handler.queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+        atexit.register(self.stop)
+        os.register_at_fork(after_in_child=self._restart_in_child)
+
+    def stop(self):
+        """Writes out the records that are still queued and stops the thread"""
+        if self.listener and self.listener._thread:  # pylint: disable=protected-access
+            self.listener.stop()
+
+    def _restart_in_child(self):
+        """Replaces the queue and thread that were lost by forking"""
+        self.queue_handler.queue = queue.SimpleQueue()
+        self.listener = QueueListener(self.queue_handler.queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+
+
+######################################################################
+#  F I L T E R S   A N D   F O R M A T T E R S
+######################################################################
+class RouteSampler(logging.Filter):
+    """Keeps the INFO and DEBUG records of only a sample of requests
+
+    The sampling decision is made once per request, so that a sampled
+    request keeps all of its records. Warnings and errors are always
+    kept. The method and endpoint of the request are added to the
+    records so that formatters on the listener thread can use them.
+    """
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if not has_request_context():
+            return True
+        record.method = request.method
+        record.endpoint = endpoint_name()
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get((record.method, record.endpoint))
+        if rate is None:
+            return True
+        # Kept with the request because g can outlive a single request
+        sampled = request.environ.get(SAMPLED_KEY)
+        if sampled is None:
+            sampled = request.environ[SAMPLED_KEY] = random.random() < rate
+        return sampled
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as compact single-line JSON objects"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+        for key in ("method", "endpoint"):
+            if hasattr(record, key):
+                entry[key] = getattr(record, key)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(",", ":"))
@@ -0,0 +1,386 @@
+"""
+In-Memory Storage of Orders
+
+With ORDER_STORAGE=memory the Orders and Order Items are kept in the
+dictionaries of a worker instead of the database, for edge deployments
+without a database server, benchmarks of the service itself, and tests
+that run in microseconds. Every worker has its own orders, which are gone
+when it stops, so run a single worker.
+
+Besides the orders by id, the store keeps secondary indexes of the ids of
+the orders by customer and by status, and an inverted index of the orders
+that contain a product, so that the filters of GET /orders only look at
+the orders that match them, and a query is counted without building a
+single Order.
+
+Only the Orders and Order Items are in memory. Idempotency keys are still
+stored with SQLAlchemy, e.g. with DATABASE_URI=sqlite://, and no Order
+Events are written, so the change feed stays empty. The listeners of the
+models, e.g. the order cache, are told about every change.
+"""
+import threading
+from datetime import date
+from flask import Flask
+from sqlalchemy.exc import IntegrityError
+from service.models import Order, OrderItem, OrderStatus
+from service.outbox_events import notify_committed
+from service.repository import Repository, use_repository
+
+STORAGES = ("sql", "memory")
+
+
+class MemoryQuery:
+    """A query of the Orders in a MemoryRepository, with the methods of a SQLAlchemy query that are used"""
+
+    def __init__(self, store, filters: dict, start: int = 0, stop: int = None):
+        self.store = store
+        self.filters = filters
+        self.start = start
+        self.stop = stop
+
+    def options(self, *options):  # pylint: disable=unused-argument
+        """Returns the query, loader options do not apply to Orders in memory"""
+        return self
+
+    def offset(self, offset: int):
+        """Returns the query without its first offset Orders"""
+        start = self.start + max(offset or 0, 0)
+        return MemoryQuery(self.store, self.filters, start, self.stop if self.stop is None else max(self.stop, start))
+
+    def limit(self, limit: int):
+        """Returns the query with at most limit Orders"""
+        stop = self.start + max(limit, 0)
+        return MemoryQuery(self.store, self.filters, self.start, stop if self.stop is None else min(self.stop, stop))
+
+    def count(self) -> int:
+        """Returns the number of Orders of the query"""
+        return len(self._ids())
+
+    def all(self) -> list:
+        """Returns the Orders of the query by id"""
+        return self.store.load_orders(self._ids())
+
+    def first(self):
+        """Returns the Order with the lowest id of the query, or None"""
+        orders = self.limit(1).all()
+        return orders[0] if orders else None
+
+    def __iter__(self):
+        return iter(self.all())
+
+    def _ids(self) -> list:
+        return self.store.select(**self.filters)[self.start:self.stop]
+
+
+class MemoryRepository(Repository):  # pylint: disable=too-many-instance-attributes
+    """
+    Class that stores the Orders and Order Items in dictionaries
+
+    The column values are stored rather than the instances, and every read
+    returns new instances, so that the changes that a request makes to an
+    Order are only seen by others once they are saved.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.orders = {}  # order id -> column values
+        self.items = {}  # item id -> column values
+        self.order_items = {}  # order id -> ids of its items
+        self.by_customer = {}  # customer id -> order ids
+        self.by_status = {}  # status -> order ids
+        self.by_product = {}  # product id -> order ids -> number of items of the product
+        self.last_ids = {Order: 0, OrderItem: 0}
+
+    ##################################################
+    # Orders
+    ##################################################
+
+    def create_order(self, order: Order):
+        with self.lock:
+            self._check_products(order.items)
+            order.id = self._next_id(Order)
+            self._store_order(order)
+            created = {(order.id, None)}
+            for item in order.items:
+                item.id = None
+                item.order_id = order.id
+                self._store_item(item)
+                created.add((order.id, item.id))
+        notify_committed({order.id}, created, [self._status_change(order)])
+
+    def update_order(self, order: Order):
+        with self.lock:
+            old = self.orders.get(order.id)
+            if old is None:
+                return
+            # Only the columns of the Order, its items may have changed since it was read
+            self._store_order(order)
+        changes = [self._status_change(order)] if old["status"] != order.status else []
+        notify_committed({order.id}, changes=changes)
+
+    def delete_order(self, order: Order):
+        with self.lock:
+            if order.id not in self.orders:
+                return
+            for item_id in list(self.order_items[order.id]):
+                self._remove_item(item_id)
+            self._index_order(self.orders.pop(order.id), False)
+            del self.order_items[order.id]
+        notify_committed({order.id})
+
+    def all_orders(self, options: tuple = ()) -> list:
+        return self.load_orders(self.select())
+
+    def find_order(self, order_id: int, options: tuple = ()):
+        with self.lock:
+            return self._order(order_id) if order_id in self.orders else None
+
+    def find_orders(self, order_ids: set) -> list:
+        return self.load_orders(order_ids)
+
+    def filter_orders(self, customer_id: int = None, status: OrderStatus = None, product_id: int = None):
+        return MemoryQuery(self, {"customer_id": customer_id, "status": status, "product_id": product_id})
+
+    def transition_orders(self, target: OrderStatus, allowed: tuple, order_ids: list = None, **filters) -> tuple:
+        changed, rejected, changes = [], {}, []
+        with self.lock:
+            if order_ids is None:
+                selected = self.select(**filters)
+            else:
+                selected = sorted(set(order_ids) & self.orders.keys())
+            for order_id in selected:
+                order = self._order(order_id, with_items=False)
+                if order.status not in allowed:
+                    rejected[order_id] = order.status
+                    continue
+                order.status = target
+                order.updated_on = date.today()
+                self._store_order(order)
+                changed.append(order_id)
+                changes.append(self._status_change(order))
+        notify_committed(set(changed), changes=changes)
+        return changed, rejected
+
+    def max_order_id(self) -> int:
+        with self.lock:
+            return max(self.orders, default=0)
+
+    def select(self, customer_id: int = None, status: OrderStatus = None, product_id: int = None) -> list:
+        """Returns the sorted ids of the Orders that match every filter, starting with the smallest index"""
+        with self.lock:
+            matches = []
+            if customer_id is not None:
+                matches.append(self.by_customer.get(customer_id, ()))
+            if status is not None:
+                matches.append(self.by_status.get(status, ()))
+            if product_id is not None:
+                matches.append(self.by_product.get(product_id, {}).keys())
+            if not matches:
+                return sorted(self.orders)
+            matches.sort(key=len)
+            return sorted(set(matches[0]).intersection(*matches[1:]))
+
+    def load_orders(self, order_ids) -> list:
+        """Returns the Orders with the given ids that exist, by id"""
+        with self.lock:
+            return [self._order(order_id) for order_id in sorted(order_ids) if order_id in self.orders]
+
+    ##################################################
+    # Order Items
+    ##################################################
+
+    def create_item(self, item: OrderItem):
+        with self.lock:
+            self._store_item(item)
+        notify_committed({item.order_id}, {(item.order_id, item.id)})
+
+    def create_items(self, items: list) -> dict:
+        # Like the SQL repository, the items are created one by one once one of them fails
+        errors = {}
+        with self.lock:
+            for index, item in enumerate(items):
+                item.id = None
+                try:
+                    self._store_item(item)
+                except IntegrityError as error:
+                    errors[index] = error
+        created = {(item.order_id, item.id) for index, item in enumerate(items) if index not in errors}
+        notify_committed({order_id for order_id, _ in created}, created)
+        return errors
+
+    def merge_item(self, values: dict) -> tuple:
+        order_id = values["order_id"]
+        with self.lock:
+            self._check_order(order_id)
+            item_id = min(
+                (item_id for item_id in self.order_items[order_id]
+                 if self.items[item_id]["product_id"] == values["product_id"]),
+                default=None,
+            )
+            if item_id is None:
+                item = OrderItem(**values)
+                self._store_item(item)
+            else:
+                item = OrderItem(**self.items[item_id])
+                item.quantity += values["quantity"]
+                item.updated_on = values["updated_on"]
+                self._store_item(item)
+        created = item_id is None
+        notify_committed({order_id}, {(order_id, item.id)} if created else None)
+        return item, created
+
+    def update_item(self, item: OrderItem):
+        with self.lock:
+            if item.id not in self.items:
+                return
+            self._store_item(item)
+        notify_committed({item.order_id})
+
+    def delete_item(self, item: OrderItem):
+        with self.lock:
+            if item.id not in self.items:
+                return
+            order_id = self._remove_item(item.id)
+        notify_committed({order_id})
+
+    def all_items(self) -> list:
+        with self.lock:
+            return [OrderItem(**self.items[item_id]) for item_id in sorted(self.items)]
+
+    def find_item(self, item_id: int):
+        with self.lock:
+            values = self.items.get(item_id)
+            return OrderItem(**values) if values else None
+
+    def find_order_item(self, order_id: int, item_id: int):
+        item = self.find_item(item_id)
+        return item if item is not None and item.order_id == order_id else None
+
+    def max_item_id(self) -> int:
+        with self.lock:
+            return max(self.items, default=0)
+
+    ##################################################
+    # Storage and indexes, with the lock held
+    ##################################################
+
+    def _next_id(self, model) -> int:
+        """Returns a new id, ids are never reused"""
+        self.last_ids[model] += 1
+        return self.last_ids[model]
+
+    def _order(self, order_id: int, with_items: bool = True) -> Order:
+        """Returns a new instance of a stored Order"""
+        order = Order(**self.orders[order_id])
+        if with_items:
+            order.items = [OrderItem(**self.items[item_id]) for item_id in sorted(self.order_items[order_id])]
+        return order
+
+    def _store_order(self, order: Order):
+        """Stores the column values of an Order, with the defaults of the database for the empty ones"""
+        if order.status is None:
+            order.status = OrderStatus.CONFIRMED
+        values = _column_values(order)
+        old = self.orders.get(order.id)
+        if old is not None:
+            self._index_order(old, False)
+        self.orders[order.id] = values
+        self.order_items.setdefault(order.id, set())
+        self._index_order(values, True)
+
+    def _index_order(self, values: dict, add: bool):
+        """Adds an Order to the indexes of its customer and status, or removes it"""
+        for index, key in ((self.by_customer, values["customer_id"]), (self.by_status, values["status"])):
+            if add:
+                index.setdefault(key, set()).add(values["id"])
+                continue
+            index[key].discard(values["id"])
+            if not index[key]:
+                del index[key]
+
+    def _check_order(self, order_id: int):
+        """Raises an IntegrityError like the foreign key of the database if an Order does not exist"""
+        if order_id not in self.orders:
+            raise IntegrityError("INSERT INTO order_item", {"order_id": order_id}, KeyError(f"order {order_id}"))
+
+    @staticmethod
+    def _check_products(items: list):
+        """Raises an IntegrityError like the unique constraint of the database if items of an Order share a product
+
+        It runs before a new Order is stored, so that a failing Order leaves nothing behind.
+        """
+        if not OrderItem.unique_products:
+            return
+        products = set()
+        for item in items:
+            if item.product_id in products:
+                raise _duplicate_product(item)
+            products.add(item.product_id)
+
+    def _store_item(self, item: OrderItem):
+        """Stores the column values of an Order Item, giving a new item its id"""
+        self._check_order(item.order_id)
+        old = self.items.get(item.id)
+        if OrderItem.unique_products and (old is None or old["product_id"] != item.product_id):
+            if any(self.items[item_id]["product_id"] == item.product_id for item_id in self.order_items[item.order_id]):
+                raise _duplicate_product(item)
+        if old is not None:
+            self._remove_item(item.id)
+        if item.id is None:
+            item.id = self._next_id(OrderItem)
+        self.items[item.id] = _column_values(item)
+        self.order_items[item.order_id].add(item.id)
+        self._count_product(item.product_id, item.order_id, 1)
+
+    def _remove_item(self, item_id: int) -> int:
+        """Removes an Order Item and returns the id of its Order"""
+        values = self.items.pop(item_id)
+        self.order_items[values["order_id"]].discard(item_id)
+        self._count_product(values["product_id"], values["order_id"], -1)
+        return values["order_id"]
+
+    def _count_product(self, product_id: int, order_id: int, delta: int):
+        """Changes the number of items of a product in an Order in the inverted product index"""
+        orders = self.by_product.setdefault(product_id, {})
+        orders[order_id] = orders.get(order_id, 0) + delta
+        if not orders[order_id]:
+            del orders[order_id]
+            if not orders:
+                del self.by_product[product_id]
+
+    @staticmethod
+    def _status_change(order: Order) -> dict:
+        return {"id": order.id, "customer_id": order.customer_id, "status": order.status.name}
+
+
+def _duplicate_product(item: OrderItem) -> IntegrityError:
+    """Returns the error of an Order Item whose product is already in its Order"""
+    return IntegrityError(
+        "INSERT INTO order_item", {"order_id": item.order_id, "product_id": item.product_id},
+        ValueError(f"product {item.product_id} is already in order {item.order_id}"),
+    )
+
+
+def _column_values(instance) -> dict:
+    """Returns the column values of an instance, filling in and copying back the column defaults"""
+    values = {}
+    for column in instance.__table__.columns:
+        value = getattr(instance, column.key)
+        if value is None and column.default is not None and column.default.is_scalar:
+            value = column.default.arg
+            setattr(instance, column.key, value)
+        values[column.key] = value
+    return values
+
+
+def init_storage(app: Flask):
+    """Keeps the Orders and Order Items in memory if ORDER_STORAGE is memory"""
+    storage = app.config.get("ORDER_STORAGE", "sql")
+    if storage not in STORAGES:
+        raise ValueError(f"Invalid ORDER_STORAGE '{storage}', expected one of {STORAGES}")
+    if storage != "memory":
+        return None
+    store = MemoryRepository()
+    use_repository(store)
+    app.extensions["order_repository"] = store
+    return store
@@ -0,0 +1,90 @@
+"""
+Request Metrics
+
+This module records the number, status and latency of requests for every
+endpoint and renders them in the Prometheus text format. When the
+PROMETHEUS_MULTIPROC_DIR environment variable is set, each gunicorn worker
+writes its samples to that directory and the /metrics endpoint aggregates
+the samples of all of the workers.
+"""
+import os
+import time
+from flask import Flask, g, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+)
+
+REQUEST_COUNT = Counter(
+    "orders_http_requests_total",
+    "Number of HTTP requests handled",
+    ["endpoint", "method", "status"],
+)
+REQUEST_LATENCY = Histogram(
+    "orders_http_request_duration_seconds",
+    "Time spent handling HTTP requests",
+    ["endpoint", "method"],
+)
+DB_QUERIES = Histogram(
+    "orders_db_queries_per_request",
+    "Number of SQL statements executed per HTTP request",
+    ["endpoint", "method"],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 250),
+)
+DB_TIME = Histogram(
+    "orders_db_time_seconds",
+    "Time spent in SQL statements per HTTP request",
+    ["endpoint", "method"],
+)
+CACHE_LOOKUPS = Counter(
+    "orders_cache_lookups_total",
+    "Number of order cache lookups by the tier that answered them",
+    ["tier", "result"],
+)
+COALESCED_READS = Counter(
+    "orders_coalesced_reads_total",
+    "Number of reads that waited for an identical read in progress instead of running",
+    ["endpoint"],
+)
+
+
+def init_metrics(app: Flask):
+    """Records metrics for every request handled by the app"""
+    app.before_request(_start_timer)
+    app.after_request(_record_request)
+
+
+def render_metrics():
+    """Returns the current metrics and their content type"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def endpoint_name() -> str:
+    """Returns the name of the endpoint that is handling the request
+
+    Requests that do not match a route are grouped together so that
+    random URLs cannot create an unbounded number of label values.
+    """
+    return request.url_rule.endpoint if request.url_rule else "unmatched"
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+def _start_timer():
+    """Remembers when the request started"""
+    g.request_start = time.perf_counter()
+
+
+def _record_request(response):
+    """Counts the request and observes its latency"""
+    start = g.pop("request_start", None)
+    if start is not None:
+        endpoint = endpoint_name()
+        REQUEST_LATENCY.labels(endpoint, request.method).observe(time.perf_counter() - start)
+        REQUEST_COUNT.labels(endpoint, request.method, response.status_code).inc()
+    return response
@@ -0,0 +1,93 @@
+"""
+Missing Order Ids
+
+Bots and broken clients ask for orders and items that do not exist, over
+and over, and every one of those requests would query the database only
+to return 404 Not Found. With MISSING_ID_CACHE a worker remembers the ids
+it found missing for MISSING_ID_TTL_SECONDS, and rejects ids above the
+highest id in the table without asking the database at all.
+
+The highest ids are raised by every commit of this worker that creates
+orders or items, and read from the database again when a higher id is
+asked for, at most every MAX_ID_REFRESH_SECONDS. An id is only rejected
+for being above the highest id right after that was read; in between, a
+higher id is looked up as usual, so an order that another worker just
+created is found. Only ids at or below the highest id that a lookup did
+not find are remembered, never the ones above it, which are the ones
+about to be created, by this worker or by another one. Ids are never reused, so an id below the highest
+one that is missing stays missing; a creation only forgets the ids it
+created.
+"""
+import time
+import threading
+from flask import Flask
+from service.models import Order, OrderItem
+from service.outbox_events import on_created_committed
+from service.common.cache import LRUCache
+
+
+class MissingIds:
+    """Remembers the Orders and Order Items that were not found"""
+
+    def __init__(self, ttl: float = 5.0, max_entries: int = 10000, refresh_seconds: float = 1.0):
+        self.missing = LRUCache(max_entries, ttl)
+        self.refresh_seconds = refresh_seconds
+        self.lock = threading.Lock()
+        self.max_ids = {Order: None, OrderItem: None}
+        self.refreshed = {Order: 0.0, OrderItem: 0.0}
+
+    def order_missing(self, order_id: int) -> bool:
+        """Returns whether an Order is known not to exist"""
+        return self.missing.get(order_id, False) or self._beyond_max(Order, order_id)
+
+    def item_missing(self, order_id: int, item_id: int) -> bool:
+        """Returns whether an Order Item is known not to exist in an Order"""
+        return self.missing.get((order_id, item_id), False) or self._beyond_max(OrderItem, item_id)
+
+    def remember(self, order_id: int, item_id: int = None):
+        """Remembers that an Order, or an Order Item of it, was not found, unless it is above the highest id"""
+        model, new_id = (Order, order_id) if item_id is None else (OrderItem, item_id)
+        max_id = self.max_ids[model]
+        if max_id is None or new_id > max_id:
+            return
+        self.missing.set(order_id if item_id is None else (order_id, item_id), True)
+
+    def created(self, created: set):
+        """Forgets the ids that a commit created and raises the highest ids"""
+        with self.lock:
+            for order_id, item_id in created:
+                model, new_id = (Order, order_id) if item_id is None else (OrderItem, item_id)
+                if self.max_ids[model] is not None and new_id > self.max_ids[model]:
+                    self.max_ids[model] = new_id
+        for order_id, item_id in created:
+            self.missing.discard(order_id if item_id is None else (order_id, item_id))
+
+    def _beyond_max(self, model, new_id: int) -> bool:
+        """Returns whether an id is above the highest id, reading it at most every refresh_seconds
+
+        A highest id that was not just read may be stale, so it never rejects an id.
+        """
+        max_id = self.max_ids[model]
+        if max_id is not None and new_id <= max_id:
+            return False
+        if time.monotonic() - self.refreshed[model] < self.refresh_seconds:
+            return False
+        self.refreshed[model] = time.monotonic()
+        max_id = model.max_id()
+        with self.lock:
+            self.max_ids[model] = max(max_id or 0, self.max_ids[model] or 0)
+        return max_id is not None and new_id > max_id
+
+
+def init_missing_ids(app: Flask):
+    """Remembers the missing Orders and Order Items if MISSING_ID_CACHE is set"""
+    if not app.config.get("MISSING_ID_CACHE"):
+        return None
+    missing_ids = MissingIds(
+        app.config.get("MISSING_ID_TTL_SECONDS", 5),
+        app.config.get("MISSING_ID_CACHE_SIZE", 10000),
+        app.config.get("MAX_ID_REFRESH_SECONDS", 1),
+    )
+    on_created_committed(missing_ids.created)
+    app.extensions["missing_ids"] = missing_ids
+    return missing_ids
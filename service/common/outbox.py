@@ -0,0 +1,295 @@
+"""
+Order Event Outbox
+
+Every change of an Order or Order Item is written to the order_event table
+in the same transaction as the change itself (see service.outbox_events). This
+module delivers those events to other services in batches, so that they
+no longer have to poll GET /orders to find out what changed.
+
+Delivery is at least once: a batch is marked as published only after the
+sink accepted it, so events are sent again if a publisher dies halfway.
+Several publishers can share the outbox because every batch is claimed
+with SELECT ... FOR UPDATE SKIP LOCKED. Consumers should skip the event
+ids they have already seen.
+
+Sinks are chosen with OUTBOX_SINK:
+    file:///var/lib/orders/events.jsonl - appends JSON lines to a file
+    unix:///run/orders/events.sock      - writes JSON lines to a local socket
+    tcp://localhost:9000                - writes JSON lines to a TCP socket
+    memory://                           - keeps the events in memory, for tests
+
+A publisher thread is started in every worker when OUTBOX_SINK is set, or
+a single one can be run with `flask outbox-publish`. It is woken up by
+every commit that wrote events, and otherwise polls every
+OUTBOX_POLL_SECONDS, which bounds the latency of events that were written
+by other processes.
+
+The events are written even without OUTBOX_SINK, because the change feed
+reads them too. Then an EventRetention thread in every worker deletes the
+events that are older than OUTBOX_RETENTION_SECONDS, so that the table
+does not grow forever. A `flask outbox-publish` that runs on its own has
+to deliver the events within that time.
+"""
+import os
+import json
+import time
+import socket
+import threading
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+from flask import Flask
+from service.models import db
+from service.outbox_events import OrderEvent, on_events_committed
+
+PURGE_INTERVAL = 60  # seconds
+
+
+######################################################################
+#  S I N K S
+######################################################################
+class FileSink:
+    """Appends events to a file as JSON lines"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def send(self, messages: list):
+        """Writes the messages and makes sure they reached the disk"""
+        with open(self.path, "a", encoding="utf-8") as events_file:
+            events_file.writelines(json.dumps(message, separators=(",", ":")) + "\n" for message in messages)
+            events_file.flush()
+            os.fsync(events_file.fileno())
+
+
+class SocketSink:
+    """Writes events as JSON lines to a Unix domain or TCP socket"""
+
+    def __init__(self, address, family=socket.AF_UNIX, timeout: float = 5.0):
+        self.address = address
+        self.family = family
+        self.timeout = timeout
+        self.connection = None
+
+    def send(self, messages: list):
+        """Writes the messages, reconnecting once if the connection was lost"""
+        data = "".join(json.dumps(message, separators=(",", ":")) + "\n" for message in messages).encode()
+        try:
+            self._connect().sendall(data)
+        except OSError:
+            self.close()
+            self._connect().sendall(data)
+
+    def close(self):
+        """Closes the connection, the next send opens a new one"""
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    def _connect(self):
+        if self.connection is None:
+            self.connection = socket.socket(self.family, socket.SOCK_STREAM)
+            self.connection.settimeout(self.timeout)
+            try:
+                self.connection.connect(self.address)
+            except OSError:
+                self.close()
+                raise
+        return self.connection
+
+
+class MemorySink:
+    """Keeps the events in a list, a stand-in for a real sink in tests"""
+
+    def __init__(self):
+        self.messages = []
+        self.lock = threading.Lock()
+
+    def send(self, messages: list):
+        """Keeps the messages"""
+        with self.lock:
+            self.messages.extend(messages)
+
+
+def make_sink(url: str):
+    """Returns the sink for a file://, unix://, tcp:// or memory:// URL"""
+    parts = urlsplit(url)
+    if parts.scheme == "file":
+        return FileSink(parts.path)
+    if parts.scheme == "unix":
+        return SocketSink(parts.path)
+    if parts.scheme == "tcp":
+        return SocketSink((parts.hostname, parts.port), socket.AF_INET)
+    if parts.scheme == "memory":
+        return MemorySink()
+    raise ValueError(f"Unsupported OUTBOX_SINK '{url}', use file://, unix://, tcp:// or memory://")
+
+
+######################################################################
+#  P U B L I S H E R
+######################################################################
+class OutboxPublisher:
+    """Delivers the events of the outbox to a sink in batches"""
+
+    def __init__(self, app: Flask, sink, batch_size: int = 500, poll_seconds: float = 1.0,
+                 retention_seconds: float = 7 * 24 * 3600):
+        # pylint: disable=too-many-arguments
+        self.app = app
+        self.sink = sink
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self.retention = timedelta(seconds=retention_seconds)
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.pid = None
+        self.start_lock = threading.Lock()
+        self.last_purge = 0.0
+
+    def publish_batch(self) -> int:
+        """Delivers the oldest unpublished events and returns how many there were"""
+        with self.app.app_context():
+            try:
+                events = OrderEvent.claim_batch(self.batch_size)
+                if not events:
+                    db.session.commit()
+                    return 0
+                self.sink.send([event.serialize() for event in events])
+                OrderEvent.mark_published([event.id for event in events])
+            except Exception:
+                db.session.rollback()
+                raise
+            finally:
+                db.session.remove()
+        return len(events)
+
+    def drain(self) -> int:
+        """Delivers all of the unpublished events and returns how many there were"""
+        total = 0
+        while True:
+            count = self.publish_batch()
+            total += count
+            if count < self.batch_size:
+                return total
+
+    def purge(self):
+        """Deletes the events that were published longer ago than the retention"""
+        with self.app.app_context():
+            try:
+                OrderEvent.purge_published(datetime.utcnow() - self.retention)
+            finally:
+                db.session.remove()
+
+    def run(self):
+        """Delivers events until stop() is called"""
+        while not self.stopping.is_set():
+            self.wakeup.clear()
+            try:
+                count = self.drain()
+                if count:
+                    self.app.logger.debug("Published %d order events", count)
+                if time.monotonic() - self.last_purge > PURGE_INTERVAL:
+                    self.last_purge = time.monotonic()
+                    self.purge()
+            except Exception as error:  # pylint: disable=broad-except
+                # The events stay in the outbox and are sent again later
+                self.app.logger.warning("Cannot publish order events: %s", error)
+            self.wakeup.wait(self.poll_seconds)
+
+    def wake(self):
+        """Lets the publisher know that there are new events"""
+        self.wakeup.set()
+
+    def start(self):
+        """Starts delivering events on a background thread of this process"""
+        self.pid = os.getpid()
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name="outbox-publisher", daemon=True)
+        self.thread.start()
+
+    def ensure_started(self):
+        """Starts the thread once in every process, e.g. in forked gunicorn workers"""
+        if self.pid != os.getpid():
+            with self.start_lock:
+                if self.pid != os.getpid():
+                    self.start()
+
+    def stop(self, timeout: float = 5.0):
+        """Stops the background thread after the batch it is working on"""
+        self.stopping.set()
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join(timeout)
+            self.thread = None
+
+
+class EventRetention:
+    """Deletes the old events of the outbox when no publisher runs in the process"""
+
+    def __init__(self, app: Flask, retention_seconds: float = 7 * 24 * 3600, interval: float = PURGE_INTERVAL):
+        self.app = app
+        self.retention = timedelta(seconds=retention_seconds)
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.thread = None
+        self.pid = None
+        self.start_lock = threading.Lock()
+
+    def purge(self) -> int:
+        """Deletes the events that were written longer ago than the retention, and returns how many"""
+        with self.app.app_context():
+            try:
+                return OrderEvent.purge_written(datetime.utcnow() - self.retention)
+            finally:
+                db.session.remove()
+
+    def run(self):
+        """Purges the old events every interval until stop() is called"""
+        while not self.stopping.is_set():
+            try:
+                self.purge()
+            except Exception as error:  # pylint: disable=broad-except
+                self.app.logger.warning("Cannot purge order events: %s", error)
+            self.stopping.wait(self.interval)
+
+    def ensure_started(self):
+        """Starts the thread once in every process, e.g. in forked gunicorn workers"""
+        if self.pid != os.getpid():
+            with self.start_lock:
+                if self.pid != os.getpid():
+                    self.pid = os.getpid()
+                    self.stopping.clear()
+                    self.thread = threading.Thread(target=self.run, name="outbox-retention", daemon=True)
+                    self.thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """Stops the background thread"""
+        self.stopping.set()
+        if self.thread:
+            self.thread.join(timeout)
+            self.thread = None
+
+
+def init_outbox(app: Flask):
+    """Starts publishing events in every worker if a sink is configured
+
+    Without a sink only the old events are deleted. The threads are started
+    by the first request of a process rather than here, so that a preloaded
+    app does not run them in the gunicorn master.
+    """
+    url = app.config.get("OUTBOX_SINK")
+    if not url:
+        retention = EventRetention(app, app.config.get("OUTBOX_RETENTION_SECONDS", 7 * 24 * 3600))
+        app.before_request(retention.ensure_started)
+        app.extensions["event_retention"] = retention
+        return None
+    publisher = OutboxPublisher(
+        app,
+        make_sink(url),
+        app.config.get("OUTBOX_BATCH_SIZE", 500),
+        app.config.get("OUTBOX_POLL_SECONDS", 1.0),
+        app.config.get("OUTBOX_RETENTION_SECONDS", 7 * 24 * 3600),
+    )
+    on_events_committed(publisher.wake)
+    app.before_request(publisher.ensure_started)
+    app.extensions["outbox_publisher"] = publisher
+    return publisher
@@ -0,0 +1,84 @@
+"""
+Request Profiling
+
+This module runs selected requests under cProfile so that slow requests
+can be investigated in production. A request is profiled when it carries
+the X-Profile header with the value of PROFILE_SECRET, or at random for
+PROFILE_SAMPLE_RATE of all requests. The profile covers everything from
+parsing the payload to serializing the response, including the database.
+
+Profiles are written to PROFILE_DIR, named after the time, the route and
+the worker, and only the newest PROFILE_MAX_FILES are kept. They can be
+read with the pstats module or a viewer such as snakeviz. The name of the
+file is returned in the X-Profile-Id response header.
+"""
+import os
+import glob
+import hmac
+import time
+import random
+import cProfile
+from flask import Flask, current_app, g, request
+from service.common.metrics import endpoint_name
+
+PROFILE_HEADER = "X-Profile"
+PROFILE_ID_HEADER = "X-Profile-Id"
+
+
+def init_profiling(app: Flask):
+    """Profiles the requests that ask for it"""
+    app.before_request(_start_profiler)
+    app.after_request(_save_profile)
+
+
+def should_profile() -> bool:
+    """Returns True if the current request should be profiled"""
+    secret = current_app.config.get("PROFILE_SECRET")
+    token = request.headers.get(PROFILE_HEADER)
+    # Bytes, since compare_digest() rejects strings that are not ASCII
+    if secret and token and hmac.compare_digest(token.encode(), secret.encode()):
+        return True
+    rate = current_app.config.get("PROFILE_SAMPLE_RATE", 0)
+    return rate > 0 and random.random() < rate
+
+
+def rotate_profiles(directory: str, max_files: int):
+    """Removes the oldest profiles so that at most max_files are kept"""
+    profiles = sorted(glob.glob(os.path.join(directory, "*.prof")))
+    for path in profiles[:max(len(profiles) - max_files, 0)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:  # another worker removed it first
+            pass
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+def _start_profiler():
+    """Starts profiling the request if it was selected"""
+    if not should_profile():
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as error:  # another profiler is already running
+        current_app.logger.warning("Cannot profile request: %s", error)
+        return
+    g.profiler = profiler
+
+
+def _save_profile(response):
+    """Stops the profiler and writes out the profile"""
+    profiler = g.pop("profiler", None)
+    if profiler is None:
+        return response
+    profiler.disable()
+    directory = current_app.config["PROFILE_DIR"]
+    os.makedirs(directory, exist_ok=True)
+    name = f"{time.time_ns()}-{request.method}-{endpoint_name()}-{os.getpid()}.prof"
+    profiler.dump_stats(os.path.join(directory, name))
+    rotate_profiles(directory, current_app.config.get("PROFILE_MAX_FILES", 100))
+    current_app.logger.info("Saved profile of %s %s to %s", request.method, request.path, name)
+    response.headers[PROFILE_ID_HEADER] = name
+    return response
@@ -0,0 +1,86 @@
+"""
+SQL Query Statistics
+
+This module counts and times every statement that SQLAlchemy sends to the
+database while a request is being handled. The totals are returned to the
+client in a Server-Timing header, recorded as metrics per endpoint, and
+statements that take longer than SLOW_QUERY_MS are logged.
+
+The listeners are attached to the SQLAlchemy Engine class, so they also
+cover engines that are created again when init_db() is called.
+"""
+import re
+import time
+from flask import Flask, current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from service.common.metrics import DB_QUERIES, DB_TIME, endpoint_name
+
+WHITESPACE = re.compile(r"\s+")
+
+
+def init_query_stats(app: Flask):
+    """Tracks the database usage of every request handled by the app"""
+    for name, listener in (
+        ("before_cursor_execute", _before_cursor_execute),
+        ("after_cursor_execute", _after_cursor_execute),
+        ("handle_error", _handle_error),
+    ):
+        if not event.contains(Engine, name, listener):
+            event.listen(Engine, name, listener)
+    app.before_request(_reset_counters)
+    app.after_request(_report_usage)
+
+
+######################################################################
+#  E N G I N E   E V E N T S
+######################################################################
+# pylint: disable=too-many-arguments, unused-argument
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Remembers when the statement started"""
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Adds the statement to the totals of the current request"""
+    elapsed = time.perf_counter() - conn.info["query_start_time"].pop()
+    if not has_request_context():
+        return
+    g.db_queries = g.get("db_queries", 0) + 1
+    g.db_time = g.get("db_time", 0.0) + elapsed
+    threshold = current_app.config.get("SLOW_QUERY_MS", 200)
+    if elapsed * 1000 >= threshold:
+        # Only the parameterized statement is logged, never the bound values
+        current_app.logger.warning(
+            "Slow query (%.1f ms) for %s %s: %s",
+            elapsed * 1000, request.method, endpoint_name(), WHITESPACE.sub(" ", statement).strip(),
+        )
+
+
+def _handle_error(context):
+    """Forgets the start of a statement that failed, so that it is not taken for the next one"""
+    if context.connection is None or context.execution_context is None:
+        return
+    started = context.connection.info.get("query_start_time")
+    if started:
+        started.pop()
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+def _reset_counters():
+    """Starts every request with no database usage"""
+    g.db_queries = 0
+    g.db_time = 0.0
+
+
+def _report_usage(response):
+    """Reports the database usage of the request"""
+    queries = g.get("db_queries", 0)
+    seconds = g.get("db_time", 0.0)
+    endpoint = endpoint_name()
+    DB_QUERIES.labels(endpoint, request.method).observe(queries)
+    DB_TIME.labels(endpoint, request.method).observe(seconds)
+    response.headers.add("Server-Timing", f'db;dur={seconds * 1000:.2f};desc="{queries} queries"')
+    return response
@@ -0,0 +1,359 @@
+"""
+Order Sharding
+
+With ORDER_SHARDS the Orders and their Items are spread over several
+databases: the one of SQLALCHEMY_DATABASE_URI, which is shard 0, and the
+comma separated database URIs of ORDER_SHARDS. Every customer is assigned
+to a shard by a consistent hash ring, so adding a shard only moves about
+1/N of the customers, and all of the orders of a customer are in the same
+database.
+
+The id of an Order or an Order Item tells its shard, id = shard *
+SHARD_ID_SPACE + n, so that it is found with a single query to its shard,
+ids are unique across the shards, e.g. in Order Events, and the orders
+that existed before sharding was turned on stay in shard 0. On PostgreSQL
+n comes from the id sequence of the table in the shard; other databases
+count it in the order_id_counter table, whose row is locked by the update
+until the transaction ends. A shard whose n reaches SHARD_ID_SPACE refuses
+new rows rather than use the ids of the next shard.
+
+The session of the app is replaced by a SQLAlchemy ShardedSession, so the
+models do not change. A statement is sent to the shards that its criteria
+on Order ids, customer ids and Order Item ids and order ids point to, and to every
+shard otherwise. Queries of Orders that need every shard, e.g. by status
+or product, run on all of them at the same time and their results are
+merged.
+
+The Order Events of every shard are written to shard 0, so that the change
+feed and the outbox publisher see a single sequence of event ids. The
+shards commit one after the other, and shard 0 always commits first, so a
+failure before the other shards commit can leave an event without its
+change, which consumers see as a change to the same state, but never a
+change without its event. For the same reason the change feed only serves
+events once they are older than CHANGE_FEED_SAFETY_LAG_SECONDS, when the
+changes of the other shards have committed. Idempotency keys and everything
+else stays in shard 0 too. Customers whose orders were created before sharding
+was turned on, or before a shard was added, keep those orders where they
+are, so they have to be moved to the new shard of the customer for
+GET /orders?customer_id= to find them.
+"""
+import os
+import bisect
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask
+from flask_sqlalchemy.query import Query
+from flask_sqlalchemy.session import _app_ctx_id
+from sqlalchemy import (
+    BigInteger, Column, Integer, MetaData, String, Table, create_engine, event, func, insert, select, text, update
+)
+from sqlalchemy.ext.horizontal_shard import ShardedQuery, ShardedSession
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter, BooleanClauseList
+from service.models import db, Order, OrderItem
+from service.outbox_events import CHANGED_ORDERS
+
+# Ids of Orders and Order Items per shard, so that 32 shards fit into a 32 bit id
+SHARD_ID_SPACE = 2 ** 26
+MAX_SHARDS = 32
+
+# The last n of the ids of each table in each shard, on databases without sequences
+COUNTERS = Table(
+    "order_id_counter", MetaData(),
+    Column("table_name", String(32), primary_key=True),
+    Column("shard_id", Integer, primary_key=True),
+    Column("last_id", BigInteger, nullable=False),
+)
+
+
+class HashRing:
+    """Maps keys to shards with consistent hashing"""
+
+    def __init__(self, shard_ids: list, replicas: int = 100):
+        points = sorted((_hash(f"{shard_id}#{replica}"), shard_id) for shard_id in shard_ids for replica in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.shard_ids = [shard_id for _, shard_id in points]
+
+    def shard_of(self, key) -> str:
+        """Returns the shard of a key"""
+        index = bisect.bisect(self.hashes, _hash(str(key))) % len(self.hashes)
+        return self.shard_ids[index]
+
+
+def _hash(value: str) -> int:
+    """Returns a hash that is the same in every process, unlike hash()"""
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+######################################################################
+#  S H A R D E D   S E S S I O N
+######################################################################
+class FanOutQuery(ShardedQuery, Query):
+    """A query of Orders that runs on all of its shards at the same time"""
+
+    def __iter__(self):
+        return iter(self.all())
+
+    def all(self):
+        """Returns the results of every shard of the query, offset and limited after they were merged"""
+        shard_ids = self._fan_out_shards()
+        if len(shard_ids) < 2:
+            return super().all()
+        offset, limit = self._window()
+        query = self
+        if offset or limit is not None:
+            if self._order_by_clauses:
+                raise NotImplementedError("A query of every shard can only be offset and limited in the order of the ids")
+            # Every shard returns its results up to the end of the window, which is cut from the merged results
+            query = self.offset(None).limit(None if limit is None else offset + limit)
+        results = []
+        for objects in self.session.router.executor.map(self._all_in_shard, shard_ids, [query] * len(shard_ids)):
+            results.extend(self.session.merge(obj, load=False) for obj in objects)
+        if not self._order_by_clauses:
+            results.sort(key=lambda obj: obj.id)
+        return results[offset:None if limit is None else offset + limit]
+
+    def first(self):
+        """Returns the first result of every shard of the query, or None"""
+        results = self.limit(1).all()
+        return results[0] if results else None
+
+    def count(self) -> int:
+        """Returns the total count of every shard of the query, within its offset and limit"""
+        shard_ids = self._fan_out_shards()
+        if not shard_ids:
+            return super().count()
+        offset, limit = self._window()
+        query = self.offset(None).limit(None)
+        # The criteria end up in a subquery, so the shards are set explicitly
+        total = sum(super(FanOutQuery, query.set_shard(shard_id)).count() for shard_id in shard_ids)
+        total = max(total - offset, 0)
+        return total if limit is None else min(total, limit)
+
+    def _window(self) -> tuple:
+        """Returns the offset and the limit of the query, or None if it is not limited"""
+        offset = 0 if self._offset_clause is None else self._offset_clause.effective_value
+        limit = None if self._limit_clause is None else self._limit_clause.effective_value
+        return offset, limit
+
+    def _fan_out_shards(self) -> list:
+        """Returns the shards that the criteria of the query point to, or none if they are already set"""
+        if "_sa_shard_id" in self._execution_options or len(self.column_descriptions) != 1:
+            return []
+        if not isinstance(self.column_descriptions[0]["expr"], type):
+            return []  # only whole objects are merged
+        return self.session.router.statement_shards(self.statement, {})
+
+    def _all_in_shard(self, shard_id: str, query) -> list:
+        """Loads the objects of a query in one shard with a session of its own"""
+        with self.session.router.session_factory() as session:
+            objects = query.with_session(session).set_shard(shard_id).all()
+            session.expunge_all()
+        return objects
+
+
+class OrderShardSession(ShardedSession):
+    """A session that sends the statements of Orders to their shards"""
+
+    def __init__(self, router, **kwargs):
+        super().__init__(
+            shard_chooser=router.shard_chooser,
+            identity_chooser=router.identity_chooser,
+            execute_chooser=router.execute_chooser,
+            shards=router.engines,
+            query_cls=FanOutQuery,
+            **kwargs,
+        )
+        self.router = router
+
+
+@event.listens_for(OrderShardSession, "before_flush")
+def _assign_ids(session, flush_context, instances):  # pylint: disable=unused-argument
+    """Gives new Orders, and then their new items, an id of their shard before they are inserted"""
+    router = session.router
+    for model in (Order, OrderItem):
+        for instance in session.new:
+            if isinstance(instance, model) and instance.id is None:
+                instance.id = router.next_id(session, model, router.shard_chooser(None, instance))
+
+
+@event.listens_for(OrderShardSession, "before_commit")
+def _commit_events_first(session):
+    """Commits shard 0, which holds the Order Events, before the shards of the Orders
+
+    The session commits its shards in no particular order, so the database
+    transaction of shard 0 is committed here, and the session commits it
+    again, with nothing left to do.
+    """
+    if session.in_nested_transaction():
+        return
+    session.flush()
+    if session.info.get(CHANGED_ORDERS):
+        session.connection(bind_arguments={"shard_id": "0"}).connection.dbapi_connection.commit()
+
+
+class ShardRouter:
+    """Knows the shards and chooses the shards of instances and statements"""
+
+    def __init__(self, engines: list, replicas: int = 100):
+        if len(engines) > MAX_SHARDS:
+            raise ValueError(f"ORDER_SHARDS can hold at most {MAX_SHARDS - 1} databases")
+        self.engines = {str(index): engine for index, engine in enumerate(engines)}
+        self.ring = HashRing(list(self.engines), replicas)
+        self.executor = ThreadPoolExecutor(len(engines), thread_name_prefix="order-shard")
+        self.session_factory = sessionmaker(class_=OrderShardSession, router=self)
+        self.default_session = None
+
+    ##################################################
+    # Choosers of the ShardedSession
+    ##################################################
+
+    def shard_of_order(self, order_id: int) -> str:
+        """Returns the shard of an Order id, or of an Order Item id"""
+        return str(order_id // SHARD_ID_SPACE)
+
+    def shard_of_customer(self, customer_id: int) -> str:
+        """Returns the shard of the orders of a customer"""
+        return self.ring.shard_of(customer_id)
+
+    def shard_chooser(self, mapper, instance, clause=None, **kwargs):  # pylint: disable=unused-argument
+        """Returns the shard of an instance that is flushed"""
+        if isinstance(instance, Order):
+            if instance.id is not None:
+                return self.shard_of_order(instance.id)
+            return self.shard_of_customer(instance.customer_id)
+        if isinstance(instance, OrderItem):
+            if instance.order_id is not None:
+                return self.shard_of_order(instance.order_id)
+            return self.shard_chooser(mapper, instance.order)
+        return "0"
+
+    def identity_chooser(self, mapper, primary_key, **kwargs) -> list:  # pylint: disable=unused-argument
+        """Returns the shards that an instance with a primary key can be in"""
+        if mapper.class_ in (Order, OrderItem):
+            return [self.shard_of_order(primary_key[0])]
+        return ["0"]
+
+    def execute_chooser(self, context) -> list:
+        """Returns the shards to run a statement on"""
+        if context.is_select and context.lazy_loaded_from is not None:
+            return [context.lazy_loaded_from.identity_token]
+        if not {mapper.class_ for mapper in context.all_mappers} & {Order, OrderItem}:
+            return ["0"]
+        return self.statement_shards(context.statement, context.parameters)
+
+    def statement_shards(self, statement, parameters) -> list:
+        """Returns the shards that the criteria of a statement point to, or all of them"""
+        shard_ids = set(self.engines)
+        clause = getattr(statement, "whereclause", None)
+        if clause is None:
+            return sorted(shard_ids)
+        if isinstance(clause, BooleanClauseList) and clause.operator is operators.and_:
+            criteria = clause.clauses
+        else:
+            criteria = [clause]
+        for criterion in criteria:
+            matched = self._criterion_shards(criterion, parameters or {})
+            if matched is not None:
+                shard_ids &= matched
+        return sorted(shard_ids)
+
+    def _criterion_shards(self, criterion, parameters: dict):
+        """Returns the shards of an equal or IN criterion on a shard key, or None"""
+        if not isinstance(criterion, BinaryExpression) or not isinstance(criterion.right, BindParameter):
+            return None
+        if criterion.operator not in (operators.eq, operators.in_op):
+            return None
+        column = criterion.left
+        table = getattr(column, "table", None)
+        if table in (Order.__table__, OrderItem.__table__) and column.key == "id":
+            shard_of = self.shard_of_order
+        elif table is Order.__table__ and column.key == "customer_id":
+            shard_of = self.shard_of_customer
+        elif table is OrderItem.__table__ and column.key == "order_id":
+            shard_of = self.shard_of_order
+        else:
+            return None
+        value = parameters.get(criterion.right.key, criterion.right.effective_value)
+        values = value if isinstance(value, (list, tuple, set)) else [value]
+        return {shard_of(value) for value in values}
+
+    ##################################################
+    # Ids and schema
+    ##################################################
+
+    def next_id(self, session, model, shard_id: str) -> int:
+        """Returns a new id of an Order or an Order Item in a shard"""
+        connection = session.connection(bind_arguments={"shard_id": shard_id})
+        table = model.__tablename__
+        if connection.dialect.name == "postgresql":
+            number = connection.scalar(text(f"SELECT nextval(pg_get_serial_sequence('\"{table}\"', 'id'))"))
+        else:
+            number = self._count_id(connection, model, int(shard_id))
+        if number >= SHARD_ID_SPACE:
+            raise OverflowError(f"Shard {shard_id} has no {table} ids left")
+        return int(shard_id) * SHARD_ID_SPACE + number
+
+    @staticmethod
+    def _count_id(connection, model, shard_id: int) -> int:
+        """Returns the next n of a table in a shard, holding the lock of its counter until the transaction ends"""
+        counter = (COUNTERS.c.table_name == model.__tablename__) & (COUNTERS.c.shard_id == shard_id)
+        if connection.execute(update(COUNTERS).where(counter).values(last_id=COUNTERS.c.last_id + 1)).rowcount:
+            return connection.scalar(select(COUNTERS.c.last_id).where(counter))
+        # The first row of the shard counts on from the rows that it holds already
+        base = shard_id * SHARD_ID_SPACE
+        highest = connection.scalar(select(func.max(model.id)).where(model.id > base, model.id < base + SHARD_ID_SPACE))
+        number = (highest or base) - base + 1
+        connection.execute(insert(COUNTERS).values(table_name=model.__tablename__, shard_id=shard_id, last_id=number))
+        return number
+
+    def create_all(self):
+        """Creates the missing tables in every shard"""
+        for shard_id, engine in self.engines.items():
+            if shard_id != "0":
+                db.metadata.create_all(engine)
+            if engine.dialect.name != "postgresql":
+                COUNTERS.metadata.create_all(engine)
+
+    def dispose(self):
+        """Discards the pooled connections that were inherited from a parent process"""
+        for shard_id, engine in self.engines.items():
+            if shard_id != "0":
+                engine.dispose(close=False)
+
+    ##################################################
+    # Installation
+    ##################################################
+
+    def install(self):
+        """Makes the session of the app a sharded one"""
+        self.default_session = db.session
+        db.session = scoped_session(self.session_factory, scopefunc=_app_ctx_id)
+        Order.query_class = FanOutQuery
+        Order.shards = self
+
+    def uninstall(self):
+        """Restores the session of the app"""
+        db.session.remove()
+        db.session = self.default_session
+        Order.query_class = Query
+        Order.shards = None
+        self.executor.shutdown()
+
+
+def init_sharding(app: Flask):
+    """Spreads the Orders over the databases of ORDER_SHARDS, if it is set"""
+    uris = [uri.strip() for uri in app.config.get("ORDER_SHARDS", "").split(",") if uri.strip()]
+    if not uris:
+        return None
+    options = app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {})
+    with app.app_context():
+        engines = [db.engine] + [create_engine(uri, **options) for uri in uris]
+    router = ShardRouter(engines, app.config.get("ORDER_SHARD_REPLICAS", 100))
+    if app.config.get("DB_INIT_MODE", "create") == "create":
+        router.create_all()
+    os.register_at_fork(after_in_child=router.dispose)
+    router.install()
+    app.extensions["order_shards"] = router
+    return router
@@ -0,0 +1,76 @@
+"""
+Read Coalescing
+
+When many clients ask for the same popular order or list at once, every
+request would run the same queries and serialize the same result. With
+READ_COALESCING the identical reads that arrive at a worker while one of
+them is in flight wait for that one instead, and all of them return its
+result, or its error.
+
+A read that starts after this worker committed a change of an order never
+joins a flight that started before the commit, so a client still reads
+its own writes. Threading primitives are used for waiting, which gevent
+patches, so this works with both thread and greenlet workers.
+"""
+import threading
+from flask import Flask
+from service.outbox_events import on_orders_committed
+from service.common.metrics import COALESCED_READS
+
+
+class _Flight:
+    """A read that is in progress, and the requests that wait for it"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs only one of the identical reads that are in progress at the same time"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.generation = 0
+
+    def do(self, key, function, label: str = ""):
+        """Returns function(), or the result of the identical call in progress"""
+        with self.lock:
+            flight_key = (self.generation, key)
+            flight = self.flights.get(flight_key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[flight_key] = _Flight()
+        if not leader:
+            COALESCED_READS.labels(label).inc()
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = function()
+            return flight.result
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self.lock:
+                self.flights.pop(flight_key, None)
+            flight.done.set()
+
+    def forget(self, order_ids=None):  # pylint: disable=unused-argument
+        """Lets the reads that start from now on run again, after a commit"""
+        with self.lock:
+            self.generation += 1
+
+
+def init_single_flight(app: Flask):
+    """Coalesces identical concurrent reads if READ_COALESCING is set"""
+    if not app.config.get("READ_COALESCING"):
+        return None
+    flights = SingleFlight()
+    on_orders_committed(flights.forget)
+    app.extensions["read_flights"] = flights
+    return flights
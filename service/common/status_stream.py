@@ -0,0 +1,287 @@
+"""
+Order Status Stream
+
+This module pushes the status changes of orders to browsers as
+Server-Sent Events, so that tracking pages no longer have to poll
+GET /orders/{id}. A page subscribes to one order or to all orders of a
+customer at GET /orders/status-stream.
+
+Every worker has a single broker that fans the changes out to its
+subscribers, which are indexed by order id and customer id so that a
+change only visits the subscribers that want it. On PostgreSQL a
+committed change is sent with NOTIFY, and one thread per worker LISTENs
+for the changes of every worker. On other databases only the changes
+made by the same process are seen.
+
+Pushes are best effort: a subscriber that falls behind is disconnected,
+and a browser reconnects on its own and gets the current status of the
+order it follows first.
+
+An open stream holds a thread of its worker for up to
+STATUS_STREAM_MAX_SECONDS, so a gthread worker with 4 threads is taken
+over by 4 subscribers, and a sync worker is restarted when a stream
+outlives its timeout. Every worker therefore serves at most
+STATUS_STREAM_MAX_STREAMS streams at a time and answers 503 Service
+Unavailable beyond that; gunicorn.conf.py sizes the limit from the worker
+class, and only gevent workers can serve many streams.
+"""
+import os
+import json
+import queue
+import select
+import time
+import threading
+from flask import Flask
+from service.models import db
+from service.outbox_events import on_status_committed
+
+CHANNEL = "order_status"
+RETRY_AFTER_SECONDS = 10
+
+
+class TooManyStreams(Exception):
+    """Used when a worker already serves as many streams as it may"""
+
+
+class Subscription:
+    """The queue of status changes of one stream"""
+
+    def __init__(self, order_id=None, customer_id=None, queue_size: int = 100):
+        self.order_id = order_id
+        self.customer_id = customer_id
+        self.queue = queue.Queue(queue_size)
+
+    def get(self, timeout: float):
+        """Returns the next change, None if the stream was closed, or raises queue.Empty"""
+        return self.queue.get(timeout=timeout)
+
+    def put(self, change: dict) -> bool:
+        """Queues a change, returns False if the subscriber fell behind"""
+        try:
+            self.queue.put_nowait(change)
+        except queue.Full:
+            return False
+        return True
+
+    def close(self):
+        """Ends the stream after the changes that are already queued"""
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            self.queue.get_nowait()  # an overflowing stream is closed right away
+            self.queue.put_nowait(None)
+
+
+class StatusBroker:
+    """Fans the status changes out to the subscribers of this worker"""
+
+    def __init__(self, app: Flask, mode: str = "auto", queue_size: int = 100, max_streams: int = 2):
+        self.app = app
+        self.mode = mode
+        self.queue_size = queue_size
+        self.max_streams = max_streams
+        self.lock = threading.Lock()
+        self.by_order = {}
+        self.by_customer = {}
+        self.streams = 0
+        self.listener = None
+        self.pid = None
+        self.publisher = None
+        self.publisher_pid = None
+        self.publish_lock = threading.Lock()
+        self.ready = threading.Event()
+        self.stopping = threading.Event()
+
+    def subscribe(self, order_id=None, customer_id=None) -> Subscription:
+        """Returns a new subscription to the changes of an order or a customer
+
+        Raises TooManyStreams when the worker serves max_streams already.
+        """
+        self.ensure_listening()
+        subscription = Subscription(order_id, customer_id, self.queue_size)
+        with self.lock:
+            if self.streams >= self.max_streams:
+                raise TooManyStreams(f"This worker serves {self.streams} status streams already")
+            self.streams += 1
+            if order_id is not None:
+                self.by_order.setdefault(order_id, set()).add(subscription)
+            else:
+                self.by_customer.setdefault(customer_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """Stops sending changes to a subscription"""
+        with self.lock:
+            if subscription.order_id is not None:
+                index, key = self.by_order, subscription.order_id
+            else:
+                index, key = self.by_customer, subscription.customer_id
+            subscribers = index.get(key, set())
+            if subscription in subscribers:
+                subscribers.discard(subscription)
+                self.streams -= 1
+            if not subscribers:
+                index.pop(key, None)
+
+    def dispatch(self, changes: list):
+        """Queues the changes for the subscribers that want them"""
+        targets = []
+        with self.lock:
+            for change in changes:
+                subscribers = self.by_order.get(change["id"], set()) | self.by_customer.get(change["customer_id"], set())
+                targets.extend((subscription, change) for subscription in subscribers)
+        for subscription, change in targets:
+            if not subscription.put(change):
+                self.app.logger.warning("Closing a status stream that fell behind")
+                self.unsubscribe(subscription)
+                subscription.close()
+
+    def publish(self, changes: list):
+        """Sends committed changes to the subscribers of every worker"""
+        if not self.uses_notify():
+            self.dispatch(changes)
+            return
+        try:
+            self._notify(changes)
+        except Exception as error:  # pylint: disable=broad-except
+            # The change is committed, only the push is lost
+            self.app.logger.warning("Cannot send order status changes: %s", error)
+            self._close_publisher()
+
+    def stream(self, subscription: Subscription, first: list, keepalive: float, max_seconds: float):
+        """Yields the Server-Sent Events of a subscription until it ends
+
+        A comment is sent when there was no change for keepalive seconds, so
+        that proxies keep the connection open and a client that went away is
+        noticed. The stream ends after max_seconds to free the worker.
+        """
+        deadline = time.monotonic() + max_seconds
+        try:
+            yield "retry: 3000\n\n"
+            for change in first:
+                yield format_event(change)
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    change = subscription.get(min(keepalive, remaining))
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if change is None:
+                    return
+                yield format_event(change)
+        finally:
+            self.unsubscribe(subscription)
+
+    ##################################################
+    # PostgreSQL LISTEN / NOTIFY
+    ##################################################
+
+    def uses_notify(self) -> bool:
+        """Returns whether the changes are sent through PostgreSQL"""
+        if self.mode == "auto":
+            return self.app.config["SQLALCHEMY_DATABASE_URI"].startswith("postgres")
+        return self.mode == "postgres"
+
+    def ensure_listening(self):
+        """Starts the listener thread once in every process that has subscribers"""
+        if not self.uses_notify():
+            return
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    # Threads and subscribers do not survive a fork
+                    self.pid = os.getpid()
+                    self.by_order, self.by_customer, self.streams = {}, {}, 0
+                    self.ready.clear()
+                    self.stopping.clear()
+                    self.listener = threading.Thread(target=self.listen, name="status-listener", daemon=True)
+                    self.listener.start()
+        self.ready.wait(5)  # so that no change is missed right after subscribing
+
+    def listen(self):
+        """Dispatches the notifications of every worker until stop() is called"""
+        while not self.stopping.is_set():
+            try:
+                connection = self._connect()
+            except Exception as error:  # pylint: disable=broad-except
+                self.app.logger.warning("Cannot listen for order status changes: %s", error)
+                self.stopping.wait(1)
+                continue
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(f"LISTEN {CHANNEL}")
+                self.ready.set()
+                self._receive(connection)
+            except Exception as error:  # pylint: disable=broad-except
+                self.app.logger.warning("Lost the order status listener: %s", error)
+            finally:
+                connection.close()
+
+    def stop(self):
+        """Stops the listener thread"""
+        self.stopping.set()
+        if self.listener:
+            self.listener.join(5)
+        self._close_publisher()
+        self.pid = None
+
+    def _receive(self, connection):
+        """Dispatches notifications as they arrive on the connection"""
+        while not self.stopping.is_set():
+            if select.select([connection], [], [], 1.0)[0]:
+                connection.poll()
+                changes = []
+                while connection.notifies:
+                    changes.extend(json.loads(connection.notifies.pop(0).payload))
+                if changes:
+                    self.dispatch(changes)
+
+    def _notify(self, changes: list):
+        """Sends the changes to the listeners of every worker"""
+        with self.publish_lock:
+            if self.publisher_pid != os.getpid():
+                # A connection of the parent process must not be used, or closed
+                self.publisher, self.publisher_pid = None, os.getpid()
+            if self.publisher is None or self.publisher.closed:
+                self.publisher = self._connect()
+            with self.publisher.cursor() as cursor:
+                # A notification payload must stay below 8000 bytes
+                for start in range(0, len(changes), 50):
+                    payload = json.dumps(changes[start:start + 50], separators=(",", ":"))
+                    cursor.execute("SELECT pg_notify(%s, %s)", (CHANNEL, payload))
+
+    def _close_publisher(self):
+        with self.publish_lock:
+            if self.publisher is not None:
+                self.publisher.close()
+                self.publisher = None
+
+    def _connect(self):
+        """Opens a connection of its own, outside of the pool of the app"""
+        with self.app.app_context():
+            engine = db.engine
+        args, kwargs = engine.dialect.create_connect_args(engine.url)
+        connection = engine.dialect.loaded_dbapi.connect(*args, **kwargs)
+        connection.autocommit = True
+        return connection
+
+
+def format_event(change: dict) -> str:
+    """Returns a status change as a Server-Sent Event"""
+    return f"event: status\ndata: {json.dumps(change, separators=(',', ':'))}\n\n"
+
+
+def init_status_stream(app: Flask):
+    """Creates the status broker of the app"""
+    mode = app.config.get("STATUS_STREAM_BROKER", "auto")
+    if mode not in ("auto", "postgres", "local"):
+        raise ValueError(f"STATUS_STREAM_BROKER must be auto, postgres or local, not '{mode}'")
+    broker = StatusBroker(
+        app, mode, app.config.get("STATUS_STREAM_QUEUE_SIZE", 100), app.config.get("STATUS_STREAM_MAX_STREAMS", 2)
+    )
+    on_status_committed(broker.publish)
+    app.extensions["status_broker"] = broker
+    return broker
@@ -0,0 +1,165 @@
+"""
+Request Validation
+
+This module compiles the flask-restx models that document the request
+bodies into plain Python functions that validate a whole payload in a
+single pass. Every problem is collected with the path of the field it
+was found in, e.g. "items[3].quantity: must be at least 1", instead of
+stopping at the first one.
+
+The generated functions return a clean copy of the payload that only
+holds the writable fields of the model, so the models can trust it and
+skip checking it again.
+"""
+import math
+from flask_restx import fields
+from service.models import DataValidationError
+
+_MISSING = object()
+
+
+def compile_validator(model, name: str = "payload"):
+    """Returns a function that validates data against a flask-restx model
+
+    The function returns the validated data, or raises a DataValidationError
+    whose errors attribute lists every problem that was found.
+    """
+    compiler = _Compiler()
+    entry = compiler.model_function(model)
+    namespace = {"_MISSING": _MISSING, "_isfinite": math.isfinite}
+    namespace.update(compiler.constants)
+    exec(compile("\n".join(compiler.lines), f"<validator {model.name}>", "exec"), namespace)  # pylint: disable=exec-used
+    check = namespace[entry]
+
+    def validate(data):
+        errors = []
+        result = check(data, "", errors)
+        if errors:
+            count = len(errors)
+            raise DataValidationError(
+                f"Invalid {name}: {count} error{'s' if count > 1 else ''} - {'; '.join(errors)}", errors
+            )
+        return result
+
+    validate.source = "\n".join(compiler.lines)
+    return validate
+
+
+class _Compiler:
+    """Generates the source code of the validation functions of models"""
+
+    def __init__(self):
+        self.lines = []
+        self.constants = {}
+        self.functions = {}
+
+    def model_function(self, model) -> str:
+        """Returns the name of the function that checks a model, generating it once"""
+        if model.name in self.functions:
+            return self.functions[model.name]
+        func = self.functions[model.name] = f"_check_{model.name}"
+        body = []
+        for key, field in model.resolved.items():
+            if isinstance(field, type):
+                field = field()  # models may use the class of a field
+            if not getattr(field, "readonly", False):
+                body.extend(self.field_lines(key, field))
+        self.lines.extend([
+            f"def {func}(data, prefix, errors):",
+            "    if not isinstance(data, dict):",
+            "        errors.append((prefix[:-1] or 'body') + ': must be an object')",
+            "        return None",
+            "    result = {}",
+        ])
+        self.lines.extend(f"    {line}" for line in body)
+        self.lines.extend(["    return result", ""])
+        return func
+
+    def field_lines(self, key: str, field) -> list:
+        """Returns the lines that check one field of a model"""
+        lines = [f"value = data.get({key!r}, _MISSING)", "if value is _MISSING:"]
+        lines.append(f"    errors.append(prefix + {key + ': is required'!r})" if field.required else "    pass")
+        for condition, message in self.value_checks(key, field):
+            lines.append(f"elif {condition}:")
+            lines.append(f"    errors.append(prefix + {f'{key}: {message}'!r})")
+        if isinstance(field, fields.List):
+            lines.extend(self.list_lines(key, field))
+        elif isinstance(field, fields.Nested):
+            check = self.model_function(field.nested)
+            lines.extend(["else:", f"    result[{key!r}] = {check}(value, prefix + {key + '.'!r}, errors)"])
+        else:
+            lines.extend(["else:", f"    result[{key!r}] = value"])
+        return lines
+
+    def value_checks(self, key: str, field) -> list:
+        """Returns (condition, message) pairs that flag a bad value"""
+        checks = []
+        if isinstance(field, fields.List):
+            return self.list_checks(field)
+        if isinstance(field, fields.Nested):
+            return []  # checked by the function of the nested model
+        if isinstance(field, fields.Integer):
+            # bool is a subclass of int, but true is not a number in JSON
+            checks.append(("type(value) is not int", "must be an integer"))
+        elif isinstance(field, fields.Float):
+            checks.append(("type(value) not in (int, float) or not _isfinite(value)", "must be a number"))
+        elif isinstance(field, fields.Boolean):
+            checks.append(("type(value) is not bool", "must be a boolean"))
+        elif isinstance(field, fields.String):
+            checks.append(("type(value) is not str", "must be a string"))
+        else:
+            raise TypeError(f"Cannot compile a validator for field '{key}' of type {type(field).__name__}")
+        minimum = getattr(field, "minimum", None)
+        if minimum is not None:
+            checks.append((f"value < {minimum!r}", f"must be at least {minimum}"))
+        maximum = getattr(field, "maximum", None)
+        if maximum is not None:
+            checks.append((f"value > {maximum!r}", f"must be at most {maximum}"))
+        if getattr(field, "enum", None):
+            allowed = self.constant(key, frozenset(field.enum))
+            checks.append((f"value not in {allowed}", f"must be one of {', '.join(field.enum)}"))
+        return checks
+
+    @staticmethod
+    def list_checks(field) -> list:
+        """Returns (condition, message) pairs that flag a bad list"""
+        checks = [("type(value) is not list", "must be a list")]
+        for limit, operator, text in ((field.min_items, "<", "at least"), (field.max_items, ">", "at most")):
+            if limit is not None:
+                plural = "s" if limit != 1 else ""
+                checks.append((f"len(value) {operator} {limit!r}", f"must have {text} {limit} item{plural}"))
+        return checks
+
+    def list_lines(self, key: str, field) -> list:
+        """Returns the lines that check every element of a list"""
+        if isinstance(field.container, fields.Nested):
+            check = self.model_function(field.container.nested)
+            path = f"f'{{prefix}}{key}[{{index}}].'"
+        else:
+            check = self.element_function(key, field.container)
+            path = f"f'{{prefix}}{key}[{{index}}]'"
+        return [
+            "else:",
+            f"    result[{key!r}] = [",
+            f"        {check}(element, {path}, errors)",
+            "        for index, element in enumerate(value)",
+            "    ]",
+        ]
+
+    def element_function(self, key: str, field) -> str:
+        """Generates the function that checks a single element of a list of values"""
+        func = f"_check_{key}_elements_{len(self.functions)}"
+        self.functions[func] = func
+        checks = self.value_checks(key, field)
+        self.lines.append(f"def {func}(value, path, errors):")
+        for index, (condition, message) in enumerate(checks):
+            self.lines.append(f"    {'if' if index == 0 else 'elif'} {condition}:")
+            self.lines.append(f"        errors.append(path + {': ' + message!r})")
+        self.lines.extend(["    return value", ""])
+        return func
+
+    def constant(self, key: str, value) -> str:
+        """Makes a value available to the generated code and returns its name"""
+        name = f"_{key.upper()}_{len(self.constants)}"  # keys are attribute names
+        self.constants[name] = value
+        return name
@@ -2,6 +2,7 @@
 Global Configuration for Application
 """
 import os
+import tempfile
 
 # Get configuration from environment
 DATABASE_URI = os.getenv(
@@ -12,5 +13,116 @@ DATABASE_URI = os.getenv(
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# What each process does to the database schema when the app is loaded:
+#   create - create any missing tables (default)
+#   check  - fail fast if the tables are missing, without creating them
+#   skip   - do nothing, tables are created with `flask db-init`
+DB_INIT_MODE = os.getenv("DB_INIT_MODE", "create")
+
+# SQL statements that take at least this many milliseconds are logged
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+
+# Requests are profiled when they send the X-Profile header with this
+# secret, or at random for the given fraction of requests
+PROFILE_SECRET = os.getenv("PROFILE_SECRET", "")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "orders-profiles"))
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "100"))
+
+# Log output: "text" or single-line "json"
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+
+# Sample rates for the INFO and DEBUG logs of busy routes, given as
+# "METHOD endpoint=rate" pairs, e.g. "GET order_resource=0.01"
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "")
+
+# Responses to requests with an Idempotency-Key header are replayed for
+# IDEMPOTENCY_TTL_SECONDS. A key is held for IDEMPOTENCY_LOCK_SECONDS while
+# its request is processed, after which a retry may process it again.
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_LOCK_SECONDS = float(os.getenv("IDEMPOTENCY_LOCK_SECONDS", "60"))
+
+# Most order ids that can be sent in one POST /orders/batch-get or
+# POST /orders/status-transitions request
+BATCH_GET_MAX_IDS = int(os.getenv("BATCH_GET_MAX_IDS", "500"))
+
+# Where the events of the order outbox are delivered, e.g.
+# file:///var/lib/orders/events.jsonl, unix:///run/orders/events.sock or
+# tcp://localhost:9000. Without a sink the events are only read by the change
+# feed, and each worker deletes those older than OUTBOX_RETENTION_SECONDS.
+OUTBOX_SINK = os.getenv("OUTBOX_SINK", "")
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "500"))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "1"))
+OUTBOX_RETENTION_SECONDS = float(os.getenv("OUTBOX_RETENTION_SECONDS", str(7 * 24 * 3600)))
+
+# GET /orders/changes returns at most CHANGE_FEED_MAX_LIMIT changes and
+# waits at most CHANGE_FEED_MAX_WAIT_SECONDS for new ones, which should stay
+# below the worker timeout. Changes of other processes are noticed within
+# CHANGE_FEED_POLL_SECONDS.
+CHANGE_FEED_MAX_LIMIT = int(os.getenv("CHANGE_FEED_MAX_LIMIT", "1000"))
+CHANGE_FEED_MAX_WAIT_SECONDS = float(os.getenv("CHANGE_FEED_MAX_WAIT_SECONDS", "25"))
+CHANGE_FEED_POLL_SECONDS = float(os.getenv("CHANGE_FEED_POLL_SECONDS", "1"))
+# A missing event id is waited for this long, in case its transaction is
+# still in flight, before the feed moves past it
+CHANGE_FEED_SAFETY_LAG_SECONDS = float(os.getenv("CHANGE_FEED_SAFETY_LAG_SECONDS", "5"))
+
+# How GET /orders/status-stream learns about status changes: "postgres"
+# to share them between workers with LISTEN/NOTIFY, "local" for the
+# changes of the same process only, or "auto" to use postgres if possible.
+# Streams send a comment every STATUS_STREAM_KEEPALIVE_SECONDS and end after
+# STATUS_STREAM_MAX_SECONDS, after which browsers reconnect on their own.
+STATUS_STREAM_BROKER = os.getenv("STATUS_STREAM_BROKER", "auto")
+STATUS_STREAM_QUEUE_SIZE = int(os.getenv("STATUS_STREAM_QUEUE_SIZE", "100"))
+STATUS_STREAM_KEEPALIVE_SECONDS = float(os.getenv("STATUS_STREAM_KEEPALIVE_SECONDS", "15"))
+STATUS_STREAM_MAX_SECONDS = float(os.getenv("STATUS_STREAM_MAX_SECONDS", "300"))
+# Every open stream holds a thread of its worker, so a worker serves at most
+# STATUS_STREAM_MAX_STREAMS of them (gunicorn.conf.py sizes it per worker class)
+STATUS_STREAM_MAX_STREAMS = int(os.getenv("STATUS_STREAM_MAX_STREAMS", "2"))
+
+# ITEM_UNIQUE_PRODUCT adds a unique (order_id, product_id) index, so that an
+# order holds at most one item per product and POST /orders/{id}/items?merge=true
+# is a single INSERT ... ON CONFLICT DO UPDATE. Duplicates must be merged first.
+ITEM_UNIQUE_PRODUCT = os.getenv("ITEM_UNIQUE_PRODUCT", "false").lower() in ("1", "true", "yes", "on")
+
+# With ITEM_GROUP_COMMIT the items that concurrent requests of a worker add
+# are committed together, in batches of at most ITEM_GROUP_COMMIT_MAX_BATCH
+# items that wait at most ITEM_GROUP_COMMIT_MAX_WAIT_MS for each other
+ITEM_GROUP_COMMIT = os.getenv("ITEM_GROUP_COMMIT", "false").lower() in ("1", "true", "yes", "on")
+ITEM_GROUP_COMMIT_MAX_BATCH = int(os.getenv("ITEM_GROUP_COMMIT_MAX_BATCH", "64"))
+ITEM_GROUP_COMMIT_MAX_WAIT_MS = float(os.getenv("ITEM_GROUP_COMMIT_MAX_WAIT_MS", "5"))
+
+# With ORDER_CACHE the results of GET /orders and GET /orders/{id} are cached
+# in every worker and in a shared cache, redis://host:6379/0 or memory://
+ORDER_CACHE = os.getenv("ORDER_CACHE", "")
+ORDER_CACHE_PREFIX = os.getenv("ORDER_CACHE_PREFIX", "orders:")
+ORDER_CACHE_TTL_SECONDS = float(os.getenv("ORDER_CACHE_TTL_SECONDS", "300"))
+ORDER_CACHE_LOCAL_SIZE = int(os.getenv("ORDER_CACHE_LOCAL_SIZE", "10000"))
+ORDER_CACHE_LOCAL_TTL_SECONDS = float(os.getenv("ORDER_CACHE_LOCAL_TTL_SECONDS", "60"))
+# A missing key is loaded by one worker while the others wait for its result
+ORDER_CACHE_LOCK_SECONDS = float(os.getenv("ORDER_CACHE_LOCK_SECONDS", "5"))
+ORDER_CACHE_LOCK_WAIT_MS = float(os.getenv("ORDER_CACHE_LOCK_WAIT_MS", "200"))
+
+# With READ_COALESCING identical reads that arrive while one of them is in
+# progress wait for its result, instead of all running the same queries
+READ_COALESCING = os.getenv("READ_COALESCING", "true").lower() in ("1", "true", "yes", "on")
+
+# With MISSING_ID_CACHE a worker remembers the order and item ids it did not
+# find, and rejects ids above the highest id when it was read again, at most
+# every MAX_ID_REFRESH_SECONDS
+MISSING_ID_CACHE = os.getenv("MISSING_ID_CACHE", "false").lower() in ("1", "true", "yes", "on")
+MISSING_ID_TTL_SECONDS = float(os.getenv("MISSING_ID_TTL_SECONDS", "5"))
+MISSING_ID_CACHE_SIZE = int(os.getenv("MISSING_ID_CACHE_SIZE", "10000"))
+MAX_ID_REFRESH_SECONDS = float(os.getenv("MAX_ID_REFRESH_SECONDS", "1"))
+
+# With ORDER_SHARDS the orders are spread by customer over the database of
+# DATABASE_URI and these comma separated database URIs, with
+# ORDER_SHARD_REPLICAS points per database on the consistent hash ring
+ORDER_SHARDS = os.getenv("ORDER_SHARDS", "")
+ORDER_SHARD_REPLICAS = int(os.getenv("ORDER_SHARD_REPLICAS", "100"))
+
+# ORDER_STORAGE=memory keeps the orders and their items in the memory of the
+# worker, with indexes by customer, status and product, instead of the database
+ORDER_STORAGE = os.getenv("ORDER_STORAGE", "sql")
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
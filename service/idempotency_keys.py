@@ -0,0 +1,128 @@
+"""
+Idempotency Keys
+
+IdempotencyKey - The stored response of a request sent with an Idempotency-Key
+
+Attributes:
+-----------
+key (string) - the Idempotency-Key header of the request
+scope (string) - the method and path of the request
+request hash (string) - SHA-256 digest of the request body
+status code (number) - status of the stored response, empty while in progress
+body (string) - JSON body of the stored response
+location (string) - Location header of the stored response
+expires at (datetime) - when the key may be used again for another request
+
+The keys are claimed and completed around the requests by the idempotent
+decorator of service.common.idempotency.
+"""
+import logging
+from datetime import datetime, timedelta
+from service.models import db
+
+logger = logging.getLogger("flask.app")
+
+
+class IdempotencyKey(db.Model):
+    """
+    Class that represents the stored response of an idempotent request
+
+    A row is inserted before the request is processed, so that a second
+    request with the same key can tell that the first one is in progress,
+    and it is completed with the response once the request succeeded.
+    """
+
+    ##################################################
+    # Table Schema
+    ##################################################
+
+    key = db.Column(db.String(255), primary_key=True)
+    scope = db.Column(db.String(255), primary_key=True)
+    request_hash = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer, nullable=True)
+    body = db.Column(db.Text, nullable=True)
+    location = db.Column(db.String(2048), nullable=True)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    ##################################################
+    # INSTANCE METHODS
+    ##################################################
+
+    def __repr__(self):
+        return f"<IdempotencyKey: key={self.key}, scope={self.scope}, status_code={self.status_code}>"
+
+    @property
+    def in_progress(self) -> bool:
+        """ True until the response of the request has been stored """
+        return self.status_code is None
+
+    def create(self):
+        """
+        Claims the key before the request is processed
+
+        Raises an IntegrityError if another request claimed it first
+        """
+        logger.info("Claiming idempotency key %s for %s", self.key, self.scope)
+        db.session.add(self)
+        try:
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+    def complete(self, status_code: int, body: str, location: str, expires_at: datetime):
+        """ Stores the response of the request """
+        self.expires_at = expires_at
+        self.status_code = status_code
+        self.body = body
+        self.location = location
+        db.session.commit()
+
+    def delete(self):
+        """ Releases the key so that the request can be retried """
+        logger.info("Releasing idempotency key %s for %s", self.key, self.scope)
+        db.session.delete(self)
+        db.session.commit()
+
+    ##################################################
+    # CLASS METHODS
+    ##################################################
+
+    @classmethod
+    def expiry(cls, ttl_seconds: float) -> datetime:
+        """ Returns when a key that is stored now expires """
+        return datetime.utcnow() + timedelta(seconds=ttl_seconds)
+
+    @classmethod
+    def find(cls, key: str, scope: str):
+        """Finds the unexpired entry of a key
+
+        :param key: the Idempotency-Key of the request
+        :type key: str
+        :param scope: the method and path of the request
+        :type scope: str
+
+        :return: the entry of the key, or None if there is none or it expired
+        :return type: IdempotencyKey
+
+        """
+        entry = db.session.get(cls, (key, scope))
+        now = datetime.utcnow()
+        if entry and entry.expires_at <= now:
+            logger.info("Idempotency key %s for %s has expired", key, scope)
+            # Another request may be deleting it at the same time
+            cls.query.filter(cls.key == key, cls.scope == scope, cls.expires_at <= now).delete(
+                synchronize_session=False
+            )
+            db.session.expunge(entry)
+            db.session.commit()
+            return None
+        return entry
+
+    @classmethod
+    def purge_expired(cls) -> int:
+        """ Deletes all of the expired keys and returns how many there were """
+        count = cls.query.filter(cls.expires_at <= datetime.utcnow()).delete(synchronize_session=False)
+        db.session.commit()
+        logger.info("Purged %d expired idempotency keys", count)
+        return count
@@ -1,7 +1,7 @@
 """
 Models for Orders Service
 
-All of the models are stored in this module
+The models of the Orders and their items are stored in this module
 
 Models
 ------
@@ -20,30 +20,162 @@ product id (number) - id of the product
 quantity (number) - quantity of the item
 price (number) - price of the product
 order id (number) - id of the order containing the item
+
+The Order Events of the changes are in service.outbox_events, the
+responses of idempotent requests in service.idempotency_keys.
+
+Repositories
+------------
+The Orders and Order Items are read and written through the repository
+that use_repository() of service.repository set, the SqlRepository unless
+it was replaced, e.g. with the in-memory MemoryRepository of
+ORDER_STORAGE=memory.
 """
 
+import os
 import logging
 from enum import Enum
 from datetime import date
-from flask import Flask
+from flask import Flask, abort, has_app_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.orm import load_only, selectinload
+from sqlalchemy.pool import StaticPool
 
 logger = logging.getLogger("flask.app")
 
 # Create the SQLAlchemy object to be initialized later in init_db()
 db = SQLAlchemy()
 
+DB_INIT_MODES = ("create", "check", "skip")
+
+# The columns of an Order that can be selected with a sparse fieldset
+ORDER_FIELDS = ("id", "customer_id", "status", "created_on", "updated_on")
+
+# Optional unique index that allows an order only one item per product
+ITEM_PRODUCT_INDEX = "ix_order_item_order_id_product_id"
+
 
 # Function to initialize the database
-def init_db(app):
-    """ Initializes the SQLAlchemy app """
-    Order.init_db(app)
-    OrderItem.init_db(app)
+def init_db(app: Flask):
+    """Initializes the SQLAlchemy app
+
+    The amount of work done against the database depends on the
+    DB_INIT_MODE setting:
+        create - create any missing tables (the default)
+        check  - verify that the tables exist with a single catalog query
+        skip   - do not touch the database; use `flask db-init` instead
+    """
+    mode = app.config.get("DB_INIT_MODE", "create")
+    if mode not in DB_INIT_MODES:
+        raise ValueError(f"Invalid DB_INIT_MODE '{mode}', expected one of {DB_INIT_MODES}")
+    logger.info("Initializing database (mode=%s)", mode)
+    Order.app = app
+    OrderItem.app = app
+    # This is where we initialize SQLAlchemy from the Flask app
+    db.init_app(app)
+    if not has_app_context():
+        app.app_context().push()
+    unique_item_products(app.config.get("ITEM_UNIQUE_PRODUCT", False))
+    if mode == "create":
+        db.create_all()  # make our sqlalchemy tables
+        create_indexes()
+    elif mode == "check":
+        check_schema()
+    # Don't keep the startup connection around, so that nothing is inherited
+    # by worker processes when the app is preloaded and then forked
+    dispose_pool(db.engine)
+
+
+def dispose_pool(engine, close: bool = True):
+    """Discards the pooled connections of an engine, unless they hold the database
+
+    An in-memory SQLite database, e.g. DATABASE_URI=sqlite://, lives in the
+    single connection of a StaticPool and would be gone with its tables.
+    """
+    if isinstance(engine.pool, StaticPool):
+        return
+    engine.dispose(close=close)
+
+
+def dispose_engine():
+    """Discards pooled connections inherited from a parent process
+
+    The connections are dropped without being closed, because closing them
+    would also close the sockets that the parent process is still using.
+    New connections are opened lazily on the first request.
+    """
+    if Order.app is None:
+        return
+    with Order.app.app_context():
+        for engine in db.engines.values():
+            dispose_pool(engine, close=False)
+
+
+# Make sure forked children (e.g. gunicorn workers) never share connections
+os.register_at_fork(after_in_child=dispose_engine)
+
+
+def check_schema():
+    """Raises a DatabaseSchemaError if any of our tables, or the optional product index, are missing"""
+    inspector = inspect(db.engine)
+    missing = set(db.metadata.tables) - set(inspector.get_table_names())
+    if missing:
+        raise DatabaseSchemaError(
+            f"Missing tables: {', '.join(sorted(missing))}. Run 'flask db-init' to create them."
+        )
+    if OrderItem.unique_products:
+        names = {index["name"] for index in inspector.get_indexes(OrderItem.__tablename__)}
+        if ITEM_PRODUCT_INDEX not in names:
+            raise DatabaseSchemaError(f"Missing index {ITEM_PRODUCT_INDEX}. Run 'flask db-init' to create it.")
+
+
+def unique_item_products(enabled: bool):
+    """Adds the unique (order_id, product_id) index to the schema of Order Items, or removes it"""
+    table = OrderItem.__table__
+    index = next((index for index in table.indexes if index.name == ITEM_PRODUCT_INDEX), None)
+    if enabled and index is None:
+        db.Index(ITEM_PRODUCT_INDEX, table.c.order_id, table.c.product_id, unique=True)
+    elif not enabled and index is not None:
+        table.indexes.discard(index)
+    OrderItem.unique_products = enabled
+
+
+def shard_bind(order_id: int) -> dict:
+    """Returns the bind arguments of the shard of an Order, for statements of tables rather than models"""
+    if Order.shards is None:
+        return {}
+    return {"shard_id": Order.shards.shard_of_order(order_id)}
+
+
+def create_indexes():
+    """Creates the indexes of tables that existed before the indexes were added
+
+    CREATE INDEX IF NOT EXISTS leaves the indexes that exist to the database,
+    instead of looking every one of them up in the catalog first.
+    """
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                try:
+                    connection.execute(CreateIndex(index, if_not_exists=True))
+                except SQLAlchemyError as error:
+                    raise DatabaseSchemaError(f"Cannot create index {index.name}: {error}") from error
 
 
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
 
+    def __init__(self, message: str, errors: list = None):
+        super().__init__(message)
+        self.errors = errors or [message]
+
+
+class DatabaseSchemaError(Exception):
+    """ Used when the database schema does not match the models """
+
 
 class OrderStatus(Enum):
     """Enumeration of valid Order Statuses"""
@@ -55,6 +187,15 @@ class OrderStatus(Enum):
     CANCELLED = 5
 
 
+# The statuses that an Order may be in to move it to another status
+ALLOWED_TRANSITIONS = {
+    OrderStatus.IN_PROGRESS: (OrderStatus.CONFIRMED,),
+    OrderStatus.SHIPPED: (OrderStatus.CONFIRMED, OrderStatus.IN_PROGRESS),
+    OrderStatus.DELIVERED: (OrderStatus.SHIPPED,),
+    OrderStatus.CANCELLED: (OrderStatus.CONFIRMED, OrderStatus.IN_PROGRESS),
+}
+
+
 class Order(db.Model):
     """
     Class that represents an Order
@@ -64,6 +205,8 @@ class Order(db.Model):
     """
 
     app = None
+    shards = None  # the ShardRouter when the Orders are sharded
+    repository = None  # where the Orders are stored, see service.repository
 
     ##################################################
     # Table Schema
@@ -92,8 +235,7 @@ class Order(db.Model):
         """
         logger.info("Creating order of customer# %s", self.customer_id)
         self.id = None  # pylint: disable=invalid-name
-        db.session.add(self)
-        db.session.commit()
+        self.repository.create_order(self)
 
     def update(self):
         """
@@ -102,16 +244,22 @@ class Order(db.Model):
         if not self.id:
             raise DataValidationError("Update called with empty ID field")
         logger.info("Saving order# %s", self.id)
-        db.session.commit()
+        self.repository.update_order(self)
 
     def delete(self):
         """ Removes an Order from the data store """
         logger.info("Deleting order# %s", self.id)
-        db.session.delete(self)
-        db.session.commit()
+        self.repository.delete_order(self)
 
-    def serialize(self):
-        """ Serializes an Order into a dictionary """
+    def serialize(self, fields: tuple = None, embed_items: bool = True):
+        """ Serializes an Order into a dictionary
+
+        Args:
+            fields (tuple): the columns to include, all of them if None
+            embed_items (bool): False to leave out the items
+        """
+        if fields is not None or not embed_items:
+            return self._serialize_fields(fields or ORDER_FIELDS, embed_items)
         items: list = []
         for item in self.items:
             items.append(OrderItem.serialize(item))
@@ -124,13 +272,31 @@ class Order(db.Model):
             "updated_on": self.updated_on.isoformat()
         }
 
-    def deserialize(self, data):
+    def _serialize_fields(self, fields: tuple, embed_items: bool) -> dict:
+        """ Serializes only the given fields, without touching the others """
+        data = {}
+        for name in fields:
+            value = getattr(self, name)
+            if isinstance(value, OrderStatus):
+                value = value.name
+            elif isinstance(value, date):
+                value = value.isoformat()
+            data[name] = value
+        if embed_items:
+            data["items"] = [item.serialize() for item in self.items]
+        return data
+
+    def deserialize(self, data, validated: bool = False):
         """
         Deserializes an Order from a dictionary
 
         Args:
             data (dict): A dictionary containing the resource data
+            validated (bool): True if data was already checked by a request
+                validator, so that it can be copied without checking it again
         """
+        if validated:
+            return self._load(data)
         try:
             if isinstance(data["customer_id"], int) and data["customer_id"] >= 0:
                 self.customer_id = data["customer_id"]
@@ -159,6 +325,15 @@ class Order(db.Model):
             ) from error
         return self
 
+    def _load(self, data):
+        """ Copies validated data into the Order without checking it again """
+        self.customer_id = data["customer_id"]
+        self.status = OrderStatus[data.get("status", "CONFIRMED")]
+        if "items" in data:
+            self.items = [OrderItem().deserialize(item, validated=True) for item in data["items"]]
+        self.updated_on = date.today()
+        return self
+
     ##################################################
     # CLASS METHODS
     ##################################################
@@ -171,32 +346,100 @@ class Order(db.Model):
         :type data: Flask
 
         """
-        logger.info("Initializing database")
-        cls.app = app
-        # This is where we initialize SQLAlchemy from the Flask app
-        db.init_app(app)
-        app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        init_db(app)
 
     @classmethod
-    def all(cls) -> list:
+    def projection(cls, fields: tuple = None, embed_items: bool = True) -> tuple:
+        """Returns the loader options that load only what will be serialized
+
+        Columns that are not in fields are left out of the SELECT, and the
+        items are loaded with one more statement for all of the orders when
+        they are embedded, or not at all otherwise.
+
+        :param fields: the columns to load, all of them if None
+        :type fields: tuple
+        :param embed_items: True if the items will be serialized
+        :type embed_items: bool
+
+        :return: options for Query.options()
+        :rtype: tuple
+
+        """
+        options = []
+        if fields is not None:
+            options.append(load_only(*(getattr(cls, name) for name in fields)))
+        if embed_items:
+            options.append(selectinload(cls.items))
+        return tuple(options)
+
+    @classmethod
+    def all(cls, options: tuple = ()) -> list:
         """ Returns all of the Orders in the database """
         logger.info("Processing all Orders")
-        return cls.query.all()
+        return cls.repository.all_orders(options)
 
     @classmethod
-    def find(cls, order_id: int):
+    def find(cls, order_id: int, options: tuple = ()):
         """Finds an Order by it's ID
 
         :param order_id: the id of the Order to find
         :type order_id: int
+        :param options: loader options, e.g. from Order.projection()
+        :type options: tuple
 
         :return: an instance with the order_id, or None if not found
         :return type: Order
 
         """
         logger.info("Processing lookup for order id %s ...", order_id)
-        return cls.query.get(order_id)
+        return cls.repository.find_order(order_id, options)
+
+    @classmethod
+    def max_id(cls) -> int:
+        """ Returns the highest id of an Order, 0 if there are none """
+        return cls.repository.max_order_id()
+
+    @classmethod
+    def find_many(cls, order_ids: list) -> list:
+        """Finds many Orders by their IDs together with their items
+
+        The orders and all of their items are loaded with two SQL statements,
+        no matter how many ids are given.
+
+        :param order_ids: the ids of the Orders to find
+        :type order_ids: list
+
+        :return: the Orders that were found, in the order of the ids
+        :rtype: list
+
+        """
+        logger.info("Processing lookup for %d order ids ...", len(order_ids))
+        if not order_ids:
+            return []
+        found = {order.id: order for order in cls.repository.find_orders(set(order_ids))}
+        return [found[order_id] for order_id in dict.fromkeys(order_ids) if order_id in found]
+
+    @classmethod
+    def transition_many(cls, target: OrderStatus, order_ids: list = None, **filters) -> tuple:
+        """Moves many Orders to a status with a single conditional UPDATE
+
+        Only the Orders whose status allows the transition are changed, the
+        others are left alone and reported as rejected.
+
+        :param target: the status to move the Orders to
+        :type target: OrderStatus
+        :param order_ids: the ids of the Orders to change, or None to use filters
+        :type order_ids: list
+        :param filters: customer_id, status and product_id to select the Orders
+
+        :return: the ids of the updated Orders, and the rejected ids with their status
+        :rtype: tuple
+
+        """
+        logger.info("Processing transition to %s ...", target.name)
+        if order_ids is None and all(value is None for value in filters.values()):
+            raise DataValidationError("Select the Orders by ids or by at least one filter")
+        return cls.repository.transition_orders(target, ALLOWED_TRANSITIONS.get(target, ()), order_ids, **filters)
 
     @classmethod
     def find_or_404(cls, order_id: int):
@@ -210,7 +453,7 @@ class Order(db.Model):
 
         """
         logger.info("Processing lookup or 404 for order id %s ...", order_id)
-        return cls.query.get_or_404(order_id)
+        return cls.repository.find_order(order_id) or abort(404)
 
     @classmethod
     def find_by_customer(cls, customer_id: int) -> list:
@@ -224,7 +467,7 @@ class Order(db.Model):
 
         """
         logger.info("Processing customer id query for %d ...", customer_id)
-        return cls.query.filter(cls.customer_id == customer_id)
+        return cls.repository.filter_orders(customer_id=customer_id)
 
     @classmethod
     def find_by_status(cls, status: OrderStatus = OrderStatus.CONFIRMED) -> list:
@@ -238,7 +481,7 @@ class Order(db.Model):
 
         """
         logger.info("Processing status query for %s ...", status.name)
-        return cls.query.filter(cls.status == status)
+        return cls.repository.filter_orders(status=status)
 
     @classmethod
     def find_by_product(cls, product_id: int) -> list:
@@ -252,7 +495,7 @@ class Order(db.Model):
 
         """
         logger.info("Processing product id query for %d ...", product_id)
-        return cls.query.filter(cls.items.any(product_id=product_id))
+        return cls.repository.filter_orders(product_id=product_id)
 
 
 class OrderItem(db.Model):
@@ -264,6 +507,8 @@ class OrderItem(db.Model):
     """
 
     app = None
+    unique_products = False  # whether an order may hold only one item per product
+    repository = None  # where the Order Items are stored, see service.repository
 
     ##################################################
     # Table Schema
@@ -290,8 +535,45 @@ class OrderItem(db.Model):
         """
         logger.info("Creating item of order# %s", self.order_id)
         self.id = None  # pylint: disable=invalid-name
-        db.session.add(self)
-        db.session.commit()
+        self.repository.create_item(self)
+
+    @classmethod
+    def create_batch(cls, items: list) -> dict:
+        """Creates many Order Items with a single commit
+
+        If the commit fails, every item is created on its own so that one bad
+        item does not fail the others. The items are detached from the session
+        and keep their values, so they can be used by other threads.
+
+        :return: the errors of the items that could not be created, by index
+        :rtype: dict
+        """
+        logger.info("Creating a batch of %d items", len(items))
+        return cls.repository.create_items(items)
+
+    @classmethod
+    def merge(cls, order_id: int, data: dict) -> tuple:
+        """Adds an item to an Order, or its quantity to the item of the same product
+
+        In the database, with the unique product index this is a single
+        INSERT ... ON CONFLICT DO UPDATE, otherwise the Order is locked while
+        its item of the product is looked up, so that concurrent merges of the
+        same Order do not create duplicates. The price of an existing item is
+        kept.
+
+        :param order_id: the id of the Order
+        :param data: the validated product_id, quantity and price of the item
+
+        :return: the item, and True if it was created
+        :rtype: tuple
+        """
+        logger.info("Merging product %s into order# %s", data["product_id"], order_id)
+        today = date.today()
+        values = {
+            "order_id": order_id, "product_id": data["product_id"], "quantity": data["quantity"],
+            "price": data["price"], "created_on": today, "updated_on": today,
+        }
+        return cls.repository.merge_item(values)
 
     def update(self):
         """
@@ -300,13 +582,12 @@ class OrderItem(db.Model):
         if not self.id:
             raise DataValidationError("Update called with empty ID field")
         logger.info("Saving order item# %s", self.id)
-        db.session.commit()
+        self.repository.update_item(self)
 
     def delete(self):
         """ Removes an Order Item from the data store """
         logger.info("Deleting order item# %s", self.id)
-        db.session.delete(self)
-        db.session.commit()
+        self.repository.delete_item(self)
 
     def serialize(self):
         """ Serializes an Order into a dictionary """
@@ -320,13 +601,21 @@ class OrderItem(db.Model):
             "updated_on": self.updated_on.isoformat()
         }
 
-    def deserialize(self, data):
+    def deserialize(self, data, validated: bool = False):
         """
         Deserializes an Order from a dictionary
 
         Args:
             data (dict): A dictionary containing the resource data
+            validated (bool): True if data was already checked by a request
+                validator, so that it can be copied without checking it again
         """
+        if validated:
+            self.product_id = data["product_id"]
+            self.quantity = data["quantity"]
+            self.price = data["price"]
+            self.updated_on = date.today()
+            return self
         try:
             if isinstance(data["product_id"], int) and data["product_id"] >= 0:
                 self.product_id = data["product_id"]
@@ -367,18 +656,13 @@ class OrderItem(db.Model):
         :type data: Flask
 
         """
-        logger.info("Initializing database")
-        cls.app = app
-        # This is where we initialize SQLAlchemy from the Flask app
-        db.init_app(app)
-        app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        init_db(app)
 
     @classmethod
     def all(cls) -> list:
         """ Returns all of the Order Items in the database """
         logger.info("Processing all Order Items")
-        return cls.query.all()
+        return cls.repository.all_items()
 
     @classmethod
     def find(cls, item_id: int):
@@ -392,7 +676,12 @@ class OrderItem(db.Model):
 
         """
         logger.info("Processing lookup for item id %s ...", item_id)
-        return cls.query.get(item_id)
+        return cls.repository.find_item(item_id)
+
+    @classmethod
+    def max_id(cls) -> int:
+        """ Returns the highest id of an Order Item, 0 if there are none """
+        return cls.repository.max_item_id()
 
     @classmethod
     def find_or_404(cls, item_id: int):
@@ -406,7 +695,7 @@ class OrderItem(db.Model):
 
         """
         logger.info("Processing lookup or 404 for item id %s ...", item_id)
-        return cls.query.get_or_404(item_id)
+        return cls.repository.find_item(item_id) or abort(404)
 
     @classmethod
     def find_by_order_and_item_id(cls, order_id: int, item_id: int):
@@ -423,7 +712,4 @@ class OrderItem(db.Model):
         """
         logger.info(
             "Processing lookup for order id %s and item id %s...", order_id, item_id)
-        item = cls.query.get(item_id)
-        if item and item.order_id == order_id:
-            return item
-        return None
+        return cls.repository.find_order_item(order_id, item_id)
@@ -0,0 +1,297 @@
+"""
+Order Events
+
+OrderEvent - A change of an Order or Order Item, kept in a transactional outbox
+
+Attributes:
+-----------
+order id (number) - id of the changed order
+item id (number) - id of the changed item, empty for changes of the order
+event type (string) - e.g. order.created, order.updated or item.deleted
+payload (string) - JSON of the changed fields, only the ids for deletions
+created at (datetime) - when the change was committed
+published at (datetime) - when the event was delivered, empty until then
+
+The ids of the events only ever increase, and are the cursor of the change
+feed at GET /orders/changes. The newest event is never purged, so that its
+id stays the highest one that was handed out.
+
+The listeners of the Session below write an Order Event for every Order
+and Order Item that is flushed, and let the callbacks of
+on_orders_committed() and the others know what a commit changed.
+"""
+import json
+import logging
+from datetime import date, datetime
+from sqlalchemy import event, func, inspect, select, update
+from sqlalchemy.orm import Session
+from service.models import ORDER_FIELDS, db, Order, OrderItem, OrderStatus
+
+logger = logging.getLogger("flask.app")
+
+
+class OrderEvent(db.Model):
+    """
+    Class that represents a change of an Order or an Order Item
+
+    Events are written by the session in the same transaction as the change
+    itself (a transactional outbox), and are delivered to other services by
+    the publisher in service.common.outbox.
+    """
+
+    ##################################################
+    # Table Schema
+    ##################################################
+
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, nullable=False)
+    item_id = db.Column(db.Integer, nullable=True)
+    event_type = db.Column(db.String(32), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    published_at = db.Column(db.DateTime, nullable=True, index=True)
+
+    ##################################################
+    # INSTANCE METHODS
+    ##################################################
+
+    def __repr__(self):
+        return f"<OrderEvent: id={self.id}, event_type={self.event_type}, order_id={self.order_id}>"
+
+    def serialize(self):
+        """ Serializes an Order Event into a dictionary """
+        return {
+            "id": self.id,
+            "type": self.event_type,
+            "order_id": self.order_id,
+            "item_id": self.item_id,
+            "payload": json.loads(self.payload),
+            "created_at": self.created_at.isoformat(),
+        }
+
+    ##################################################
+    # CLASS METHODS
+    ##################################################
+
+    @classmethod
+    def claim_batch(cls, size: int) -> list:
+        """Returns the oldest unpublished events and locks them
+
+        Events that are locked by another publisher are skipped, so that
+        several publishers can drain the outbox side by side. The lock is
+        held until the transaction ends.
+        """
+        return (
+            cls.query.filter(cls.published_at.is_(None))
+            .order_by(cls.id)
+            .limit(size)
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+
+    @classmethod
+    def mark_published(cls, event_ids: list):
+        """ Marks the events as delivered and commits the transaction """
+        db.session.execute(update(cls).where(cls.id.in_(event_ids)).values(published_at=datetime.utcnow()))
+        db.session.commit()
+
+    @classmethod
+    def purge_published(cls, before: datetime) -> int:
+        """ Deletes the events that were published before the given time """
+        count = cls.query.filter(cls.published_at < before, cls._not_newest()).delete(synchronize_session=False)
+        db.session.commit()
+        logger.info("Purged %d published order events", count)
+        return count
+
+    @classmethod
+    def purge_written(cls, before: datetime) -> int:
+        """ Deletes the events that were written before the given time, published or not """
+        count = cls.query.filter(cls.created_at < before, cls._not_newest()).delete(synchronize_session=False)
+        db.session.commit()
+        logger.info("Purged %d order events", count)
+        return count
+
+    @classmethod
+    def _not_newest(cls):
+        """Returns the criterion that keeps the newest event from being purged
+
+        The newest event holds the high-water mark of the ids: the current
+        cursor of the change feed would fall back to 0 without it, and SQLite
+        would hand out its id and the ones before it again.
+        """
+        return cls.id < select(func.max(cls.id)).scalar_subquery()
+
+    @classmethod
+    def changed_orders(cls, cursor: int, limit: int) -> list:
+        """Returns (event id, order id, created at) rows of the first events after the cursor"""
+        query = select(cls.id, cls.order_id, cls.created_at).where(cls.id > cursor).order_by(cls.id).limit(limit)
+        return db.session.execute(query).all()
+
+    @classmethod
+    def first_written_after(cls, moment: datetime):
+        """Returns the id of the oldest event that was written after a moment, or None"""
+        return db.session.scalar(select(func.min(cls.id)).where(cls.created_at > moment))
+
+    @classmethod
+    def cursor_range(cls) -> tuple:
+        """Returns the ids of the oldest and newest events that are kept, or None"""
+        return tuple(db.session.execute(select(func.min(cls.id), func.max(cls.id))).one())
+
+    @classmethod
+    def record_status_changes(cls, order_ids: list, status: OrderStatus):
+        """ Records the events of a bulk status change in the current transaction """
+        today = date.today().isoformat()
+        cls.record([
+            cls._row(order_id, None, "order.updated", {"id": order_id, "status": status.name, "updated_on": today})
+            for order_id in order_ids
+        ])
+
+    @classmethod
+    def record(cls, rows: list):
+        """ Writes events of changes that bypassed the session in the current transaction """
+        if rows:
+            _write_events(db.session(), rows)
+
+    @staticmethod
+    def _row(order_id: int, item_id, event_type: str, payload: dict) -> dict:
+        """ Returns the column values of an event """
+        return {
+            "order_id": order_id,
+            "item_id": item_id,
+            "event_type": event_type,
+            "payload": json.dumps(payload, separators=(",", ":")),
+            "created_at": datetime.utcnow(),
+        }
+
+    @classmethod
+    def for_change(cls, instance, change: str):
+        """ Returns the column values of the event of a changed Order or Order Item """
+        if isinstance(instance, Order):
+            payload = {"id": instance.id} if change == "deleted" else instance.serialize(ORDER_FIELDS, False)
+            return cls._row(instance.id, None, f"order.{change}", payload)
+        if change == "deleted":
+            payload = {"id": instance.id, "order_id": instance.order_id}
+        else:
+            payload = instance.serialize()
+        return cls._row(instance.order_id, instance.id, f"item.{change}", payload)
+
+
+######################################################################
+#  T R A N S A C T I O N A L   O U T B O X
+######################################################################
+CHANGED_ORDERS = "orders.changed_orders"
+CREATED_IDS = "orders.created_ids"
+STATUS_CHANGES = "orders.status_changes"
+_commit_listeners = []
+_order_listeners = []
+_created_listeners = []
+_status_listeners = []
+
+
+def on_events_committed(callback):
+    """Calls callback() after every commit that wrote Order Events"""
+    _commit_listeners.append(callback)
+
+
+def on_orders_committed(callback):
+    """Calls callback(order_ids) after every commit with the ids of the Orders it changed
+
+    Changes of the items of an Order count as changes of the Order.
+    """
+    _order_listeners.append(callback)
+
+
+def on_created_committed(callback):
+    """Calls callback(created) after every commit that created Orders or Order Items
+
+    created is a set of (order_id, item_id) pairs, with an item_id of None
+    for the Orders themselves.
+    """
+    _created_listeners.append(callback)
+
+
+def on_status_committed(callback):
+    """Calls callback(changes) after every commit that set the status of Orders
+
+    Every change is a dictionary with the id, customer_id and new status of
+    an Order, including the Orders that were created.
+    """
+    _status_listeners.append(callback)
+
+
+def stash_status_changes(session, changes):
+    """Keeps status changes until the transaction that made them commits"""
+    session.info.setdefault(STATUS_CHANGES, []).extend(changes)
+
+
+def _status_change(instance, change: str):
+    """Returns the status change of a flushed Order, or None"""
+    if not isinstance(instance, Order) or change == "deleted":
+        return None
+    if change == "updated" and not inspect(instance).attrs.status.history.has_changes():
+        return None
+    return {"id": instance.id, "customer_id": instance.customer_id, "status": instance.status.name}
+
+
+@event.listens_for(Session, "after_flush")
+def _record_events(session, flush_context):  # pylint: disable=unused-argument
+    """Writes an Order Event for every Order and Order Item that was flushed"""
+    rows = []
+    for change, instances in (("created", session.new), ("updated", session.dirty), ("deleted", session.deleted)):
+        for instance in instances:
+            if not isinstance(instance, (Order, OrderItem)):
+                continue
+            if change == "updated" and not session.is_modified(instance, include_collections=False):
+                continue
+            rows.append(OrderEvent.for_change(instance, change))
+            status_change = _status_change(instance, change)
+            if status_change:
+                stash_status_changes(session, [status_change])
+    if rows:
+        _write_events(session, rows)
+
+
+def _write_events(session, rows: list):
+    """Inserts Order Events and remembers which Orders the transaction changed"""
+    # The events of every shard are kept in shard 0, so that their ids are a single sequence
+    bind_arguments = None if Order.shards is None else {"shard_id": "0"}
+    session.connection(bind_arguments=bind_arguments).execute(OrderEvent.__table__.insert(), rows)
+    session.info.setdefault(CHANGED_ORDERS, set()).update(row["order_id"] for row in rows)
+    created = [(row["order_id"], row["item_id"]) for row in rows if row["event_type"].endswith(".created")]
+    if created:
+        session.info.setdefault(CREATED_IDS, set()).update(created)
+
+
+@event.listens_for(Session, "after_commit")
+def _notify_events(session):
+    """Lets the listeners know that new events were committed"""
+    order_ids = session.info.pop(CHANGED_ORDERS, None)
+    notify_committed(order_ids, session.info.pop(CREATED_IDS, None), session.info.pop(STATUS_CHANGES, None))
+    if order_ids:
+        for callback in _commit_listeners:
+            callback()
+
+
+def notify_committed(order_ids: set, created: set = None, changes: list = None):
+    """Lets the listeners know about the Orders, the created ids and the status changes of a commit
+
+    Repositories that do not commit with a SQLAlchemy Session call this
+    themselves, without writing Order Events.
+    """
+    if created:
+        for callback in _created_listeners:
+            callback(created)
+    if order_ids:
+        for callback in _order_listeners:
+            callback(order_ids)
+    if changes:
+        for callback in _status_listeners:
+            callback(changes)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_events(session):
+    """Forgets the events of a transaction that was rolled back"""
+    session.info.pop(CHANGED_ORDERS, None)
+    session.info.pop(CREATED_IDS, None)
+    session.info.pop(STATUS_CHANGES, None)
@@ -0,0 +1,311 @@
+"""
+Repositories
+
+The Orders and Order Items are read and written through a Repository, the
+SqlRepository of SQLAlchemy unless use_repository() replaced it, e.g. with
+the in-memory MemoryRepository of ORDER_STORAGE=memory.
+"""
+from abc import ABC, abstractmethod
+from datetime import date
+from sqlalchemy import func, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import make_transient, selectinload
+from service.models import db, shard_bind, Order, OrderItem, OrderStatus
+from service.outbox_events import OrderEvent, stash_status_changes
+
+# Dialects that can merge an item with INSERT ... ON CONFLICT DO UPDATE
+UPSERT_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+
+######################################################################
+#  R E P O S I T O R I E S
+######################################################################
+class Repository(ABC):
+    """
+    Class that stores the Orders and Order Items
+
+    The models hand every read and write of Orders and Order Items to the
+    repository in use, so that they can be kept somewhere else than in the
+    database of SQLAlchemy. Reads return Orders with their items, and
+    filter_orders() returns a query that can be counted, limited and offset.
+    A repository lets the listeners of on_orders_committed() and the others
+    know about the changes that it committed.
+    """
+
+    @abstractmethod
+    def create_order(self, order: Order):
+        """Stores a new Order with its items and gives them their ids"""
+
+    @abstractmethod
+    def update_order(self, order: Order):
+        """Stores the changes of the columns of an Order, its items are changed on their own"""
+
+    @abstractmethod
+    def delete_order(self, order: Order):
+        """Removes an Order with its items"""
+
+    @abstractmethod
+    def all_orders(self, options: tuple = ()) -> list:
+        """Returns all of the Orders"""
+
+    @abstractmethod
+    def find_order(self, order_id: int, options: tuple = ()):
+        """Returns the Order with an id, or None"""
+
+    @abstractmethod
+    def find_orders(self, order_ids: set) -> list:
+        """Returns the Orders with the given ids that exist, in any order"""
+
+    @abstractmethod
+    def filter_orders(self, customer_id: int = None, status: OrderStatus = None, product_id: int = None):
+        """Returns a query of the Orders that match every given filter"""
+
+    @abstractmethod
+    def transition_orders(self, target: OrderStatus, allowed: tuple, order_ids: list = None, **filters) -> tuple:
+        """Moves the selected Orders in an allowed status to target
+
+        :return: the sorted ids of the updated Orders, and the rejected ids with their status
+        :rtype: tuple
+        """
+
+    @abstractmethod
+    def max_order_id(self) -> int:
+        """Returns the highest id of an Order, 0 if there are none"""
+
+    @abstractmethod
+    def create_item(self, item: OrderItem):
+        """Stores a new Order Item and gives it its id"""
+
+    @abstractmethod
+    def create_items(self, items: list) -> dict:
+        """Stores new Order Items and returns the errors of the ones that could not be created, by index"""
+
+    @abstractmethod
+    def merge_item(self, values: dict) -> tuple:
+        """Adds the quantity of values to the item of its product, or creates the item
+
+        :return: the item, and True if it was created
+        :rtype: tuple
+        """
+
+    @abstractmethod
+    def update_item(self, item: OrderItem):
+        """Stores the changes of an Order Item"""
+
+    @abstractmethod
+    def delete_item(self, item: OrderItem):
+        """Removes an Order Item"""
+
+    @abstractmethod
+    def all_items(self) -> list:
+        """Returns all of the Order Items"""
+
+    @abstractmethod
+    def find_item(self, item_id: int):
+        """Returns the Order Item with an id, or None"""
+
+    @abstractmethod
+    def find_order_item(self, order_id: int, item_id: int):
+        """Returns the Order Item with an id in an Order, or None"""
+
+    @abstractmethod
+    def max_item_id(self) -> int:
+        """Returns the highest id of an Order Item, 0 if there are none"""
+
+
+class SqlRepository(Repository):
+    """
+    Class that stores the Orders and Order Items with SQLAlchemy
+
+    This is the default repository. Its changes are committed in the
+    session of the app, which writes their Order Events to the outbox.
+    """
+
+    ##################################################
+    # Orders
+    ##################################################
+
+    def create_order(self, order: Order):
+        db.session.add(order)
+        db.session.commit()
+
+    def update_order(self, order: Order):
+        db.session.commit()
+
+    def delete_order(self, order: Order):
+        db.session.delete(order)
+        db.session.commit()
+
+    def all_orders(self, options: tuple = ()) -> list:
+        return Order.query.options(*options).all()
+
+    def find_order(self, order_id: int, options: tuple = ()):
+        return Order.query.options(*options).get(order_id)
+
+    def find_orders(self, order_ids: set) -> list:
+        return Order.query.options(selectinload(Order.items)).filter(Order.id.in_(order_ids)).all()
+
+    def filter_orders(self, customer_id: int = None, status: OrderStatus = None, product_id: int = None):
+        return Order.query.filter(self._selection(customer_id=customer_id, status=status, product_id=product_id))
+
+    def transition_orders(self, target: OrderStatus, allowed: tuple, order_ids: list = None, **filters) -> tuple:
+        """Moves the Orders with a single conditional UPDATE"""
+        selection = self._selection(order_ids, **filters)
+        statement = (
+            update(Order)
+            .where(selection, Order.status.in_(allowed))
+            .values(status=target, updated_on=date.today())
+        )
+        if db.engine.dialect.update_returning:
+            rows = db.session.execute(statement.returning(Order.id, Order.customer_id)).all()
+        else:
+            rows = db.session.execute(
+                select(Order.id, Order.customer_id).where(selection, Order.status.in_(allowed)).with_for_update()
+            ).all()
+            db.session.execute(
+                update(Order).where(Order.id.in_([row.id for row in rows])).values(status=target, updated_on=date.today())
+            )
+        changed = {row.id: row.customer_id for row in rows}
+        OrderEvent.record_status_changes(list(changed), target)
+        stash_status_changes(db.session, [
+            {"id": order_id, "customer_id": customer_id, "status": target.name}
+            for order_id, customer_id in changed.items()
+        ])
+        rejected = {
+            order_id: status
+            for order_id, status in db.session.execute(
+                select(Order.id, Order.status).where(selection, Order.status.not_in(allowed)).order_by(Order.id)
+            )
+            if order_id not in changed
+        }
+        db.session.commit()
+        return sorted(changed), rejected
+
+    @staticmethod
+    def _selection(order_ids: list = None, customer_id: int = None, status: OrderStatus = None,
+                   product_id: int = None):
+        """Returns the WHERE clause that selects Orders by ids or by filters"""
+        if order_ids is not None:
+            return Order.id.in_(order_ids)
+        criteria = []
+        if customer_id is not None:
+            criteria.append(Order.customer_id == customer_id)
+        if status is not None:
+            criteria.append(Order.status == status)
+        if product_id is not None:
+            criteria.append(Order.items.any(product_id=product_id))
+        return db.and_(*criteria)
+
+    def max_order_id(self) -> int:
+        return max((value or 0 for value in db.session.scalars(select(func.max(Order.id)))), default=0)
+
+    ##################################################
+    # Order Items
+    ##################################################
+
+    def create_item(self, item: OrderItem):
+        db.session.add(item)
+        db.session.commit()
+
+    def create_items(self, items: list) -> dict:
+        """Creates the items with a single commit, or every item on its own if that fails
+
+        The items are detached from the session and keep their values, so
+        they can be used by other threads.
+        """
+        try:
+            self._commit_detached(items)
+            return {}
+        except SQLAlchemyError:
+            db.session.rollback()
+        errors = {}
+        for index, item in enumerate(items):
+            try:
+                self._commit_detached([item])
+            except SQLAlchemyError as error:
+                db.session.rollback()
+                errors[index] = error
+        return errors
+
+    @staticmethod
+    def _commit_detached(items: list):
+        """Inserts items, detaches them from the session and commits"""
+        for item in items:
+            make_transient(item)
+            item.id = None
+        db.session.add_all(items)
+        db.session.flush()
+        for item in items:
+            db.session.expunge(item)
+        db.session.commit()
+
+    def merge_item(self, values: dict) -> tuple:
+        """Merges with an upsert if the unique product index allows it, or locks the Order otherwise"""
+        dialect = db.engine.dialect
+        # The upsert leaves the id to the database, which does not know the shards of the ids
+        upsert = OrderItem.unique_products and Order.shards is None
+        if upsert and dialect.name in UPSERT_INSERTS and dialect.insert_returning:
+            return self._upsert(values)
+        order_id = values["order_id"]
+        db.session.execute(select(Order.id).where(Order.id == order_id).with_for_update())
+        item = db.session.execute(
+            select(OrderItem).where(OrderItem.order_id == order_id, OrderItem.product_id == values["product_id"])
+            .order_by(OrderItem.id).limit(1).with_for_update().execution_options(populate_existing=True)
+        ).scalar()
+        created = item is None
+        if created:
+            item = OrderItem(**values)
+            db.session.add(item)
+        else:
+            item.quantity += values["quantity"]
+            item.updated_on = values["updated_on"]
+        db.session.commit()
+        return item, created
+
+    @staticmethod
+    def _upsert(values: dict) -> tuple:
+        """Merges an item with a single statement, relying on the unique product index"""
+        table = OrderItem.__table__
+        insert = UPSERT_INSERTS[db.engine.dialect.name](table).values(**values)
+        statement = insert.on_conflict_do_update(
+            index_elements=[table.c.order_id, table.c.product_id],
+            set_={"quantity": table.c.quantity + insert.excluded.quantity, "updated_on": insert.excluded.updated_on},
+        ).returning(*table.columns)
+        item = OrderItem(**db.session.execute(statement, bind_arguments=shard_bind(values["order_id"])).one()._asdict())
+        # Quantities are at least 1, so a merged item ends up with more than was posted
+        created = item.quantity == values["quantity"]
+        OrderEvent.record([OrderEvent.for_change(item, "created" if created else "updated")])
+        db.session.commit()
+        return item, created
+
+    def update_item(self, item: OrderItem):
+        db.session.commit()
+
+    def delete_item(self, item: OrderItem):
+        db.session.delete(item)
+        db.session.commit()
+
+    def all_items(self) -> list:
+        return OrderItem.query.all()
+
+    def find_item(self, item_id: int):
+        return OrderItem.query.get(item_id)
+
+    def find_order_item(self, order_id: int, item_id: int):
+        # The order id also selects the shard of the item when the Orders are sharded
+        return OrderItem.query.filter(OrderItem.id == item_id, OrderItem.order_id == order_id).first()
+
+    def max_item_id(self) -> int:
+        return max((value or 0 for value in db.session.scalars(select(func.max(OrderItem.id)))), default=0)
+
+
+def use_repository(new_repository: Repository) -> Repository:
+    """Makes the models store their Orders and Order Items in a repository, and returns the one before"""
+    previous = Order.repository
+    Order.repository = OrderItem.repository = new_repository
+    return previous
+
+
+# The models store their Orders and Order Items with SQLAlchemy until use_repository() replaces it
+use_repository(SqlRepository())
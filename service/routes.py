@@ -4,9 +4,18 @@ Orders Service with Swagger
 Paths:
 ------
 GET / - Displays a UI for Selenium testing
+GET /health - Health check for Kubernetes
+GET /metrics - Request metrics in the Prometheus text format
 GET /orders - Returns a list all of the Orders
 GET /orders/{id} - Returns the Order with a given id number
+
+Both GET endpoints accept ?fields=id,status,... to return only some of the
+columns of the orders and ?embed=none to leave out their items.
 POST /orders - creates a new Order record in the database
+POST /orders/batch-get - Returns the Orders with the given id numbers
+POST /orders/status-transitions - moves many Orders to another status at once
+GET /orders/changes - Returns the Orders that changed after a cursor
+GET /orders/status-stream - Pushes the status changes of an Order or a customer as Server-Sent Events
 PUT /orders/{id} - updates an Order record in the database
 DELETE /orders/{id} - deletes an Order record in the database
 
@@ -17,11 +26,20 @@ PUT /orders/{order_id}/items/{item_id} - updates an Order Item record in the dat
 DELETE /orders/{order_id}/items/{item_id} - deletes an Order Item record in the database
 """
 
-from flask import jsonify
-from flask_restx import Resource, fields, reqparse
+import logging
+from urllib.parse import urlencode
+from flask import Response, jsonify, request
+from flask_restx import Resource, fields, inputs, marshal, reqparse
+from sqlalchemy.exc import IntegrityError
 from service.common import status  # HTTP Status Codes
+from service.common.cache import LIST_NAMESPACE
+from service.common.change_feed import StaleCursorError, current_cursor, read_changes
+from service.common.idempotency import IDEMPOTENCY_HEADER, idempotent
+from service.common.metrics import endpoint_name, render_metrics
+from service.common.status_stream import RETRY_AFTER_SECONDS, TooManyStreams
+from service.common.validation import compile_validator
 # pylint: disable=cyclic-import
-from service.models import Order, OrderItem, OrderStatus
+from service.models import ALLOWED_TRANSITIONS, ORDER_FIELDS, Order, OrderItem, OrderStatus, db
 
 # Import Flask application
 from . import app, api
@@ -65,13 +83,10 @@ order_create_model = api.inherit(
     }
 )
 
-order_model = api.inherit(
-    'Order',
+order_summary_model = api.inherit(
+    'OrderSummary',
     order_core_model,
     {
-        'items': fields.List(fields.Nested(item_model),
-                             required=False,
-                             description='The product items that the order contains'),
         'id': fields.Integer(readOnly=True,
                              description='The unique id assigned internally by service'),
         'created_on': fields.Date(readOnly=True, description='The day the order was created'),
@@ -79,8 +94,101 @@ order_model = api.inherit(
     }
 )
 
+# An Order with ?embed=none is an OrderSummary, and with ?fields= only the
+# selected fields of either model are returned
+order_model = api.inherit(
+    'Order',
+    order_summary_model,
+    {
+        'items': fields.List(fields.Nested(item_model),
+                             required=False,
+                             description='The product items that the order contains, unless ?embed=none'),
+    }
+)
+
+batch_get_model = api.model('BatchGet', {
+    'ids': fields.List(fields.Integer(min=0), required=True, min_items=1, max_items=app.config['BATCH_GET_MAX_IDS'],
+                       description='The ids of the orders to return'),
+})
+
+batch_get_result_model = api.model('BatchGetResult', {
+    'orders': fields.List(fields.Nested(order_model),
+                          description='The orders that were found, in the order of the ids'),
+    'missing': fields.List(fields.Integer,
+                           description='The ids of the orders that do not exist'),
+})
+
+order_filter_model = api.model('OrderFilter', {
+    'customer_id': fields.Integer(min=0, description='Select the orders of a customer'),
+    'status': fields.String(enum=[s.name for s in OrderStatus], description='Select the orders with a status'),
+    'product_id': fields.Integer(min=0, description='Select the orders that contain a product'),
+})
+
+status_transition_model = api.model('StatusTransition', {
+    'target': fields.String(required=True, enum=[s.name for s in ALLOWED_TRANSITIONS],
+                            description='The status to move the orders to'),
+    'ids': fields.List(fields.Integer(min=0), min_items=1, max_items=app.config['BATCH_GET_MAX_IDS'],
+                       description='The ids of the orders to move, instead of a filter'),
+    'filter': fields.Nested(order_filter_model, description='Selects the orders to move, instead of ids'),
+})
+
+rejected_order_model = api.model('RejectedOrder', {
+    'id': fields.Integer(description='The id of an order that was not moved'),
+    'status': fields.String(description='The status that does not allow the transition'),
+})
+
+status_transition_result_model = api.model('StatusTransitionResult', {
+    'target': fields.String(description='The status the orders were moved to'),
+    'updated': fields.List(fields.Integer, description='The ids of the orders that were moved'),
+    'rejected': fields.List(fields.Nested(rejected_order_model),
+                            description='The orders whose status does not allow the transition'),
+    'missing': fields.List(fields.Integer, description='The posted ids of orders that do not exist'),
+})
+
+change_model = api.model('Change', {
+    'id': fields.Integer(description='The id of the order that changed'),
+    'op': fields.String(enum=['upsert', 'delete'], description='Whether the order was created or updated, or deleted'),
+    'order': fields.Nested(order_model, allow_null=True,
+                           description='The current state of the order, empty if it was deleted'),
+})
+
+change_feed_model = api.model('ChangeFeed', {
+    'cursor': fields.Integer(description='Pass as ?since= to get the changes that follow'),
+    'has_more': fields.Boolean(description='Whether more changes are waiting after the cursor'),
+    'changes': fields.List(fields.Nested(change_model), description='The orders that changed, oldest change first'),
+})
+
+# Request validators compiled from the models
+validate_item = compile_validator(item_create_model, "Order Item")
+validate_order = compile_validator(order_create_model, "Order")
+validate_order_update = compile_validator(order_core_model, "Order")
+validate_batch_get = compile_validator(batch_get_model, "Batch Get")
+validate_status_transition = compile_validator(status_transition_model, "Status Transition")
+
 # Query string arguments
-order_args = reqparse.RequestParser()
+view_args = reqparse.RequestParser()
+view_args.add_argument('fields', type=str, required=False,
+                       help=f"Comma separated fields to return, from {', '.join(ORDER_FIELDS)}")
+view_args.add_argument('embed', type=str, required=False, default='items', choices=('items', 'none'),
+                       help='Whether to return the items of the orders')
+
+change_args = reqparse.RequestParser()
+change_args.add_argument('since', type=int, required=False,
+                         help='Cursor to return the changes after, leave out to get the current cursor')
+change_args.add_argument('limit', type=int, required=False, default=100,
+                         help='Most changes to return')
+change_args.add_argument('timeout', type=float, required=False, default=0,
+                         help='Seconds to wait for a change if there are none yet')
+
+stream_args = reqparse.RequestParser()
+stream_args.add_argument('order_id', type=int, required=False, help='Follow the status of an order')
+stream_args.add_argument('customer_id', type=int, required=False, help='Follow the status of the orders of a customer')
+
+item_args = reqparse.RequestParser()
+item_args.add_argument('merge', type=inputs.boolean, required=False, default=False,
+                       help='Add the quantity to the item of the same product instead of adding another item')
+
+order_args = view_args.copy()
 order_args.add_argument('customer_id', type=int, required=False, help='List orders of a customer')
 order_args.add_argument('status', type=str, required=False, help='List orders by status')
 order_args.add_argument('product_id', type=int, required=False, help='List orders containing a particular product')
@@ -104,6 +212,16 @@ def health():
     return jsonify({"status": "OK"}), status.HTTP_200_OK
 
 
+######################################################################
+# METRICS ENDPOINT
+######################################################################
+@app.route('/metrics')
+def metrics():
+    """ Request metrics for Prometheus """
+    data, content_type = render_metrics()
+    return Response(data, status=status.HTTP_200_OK, content_type=content_type)
+
+
 ######################################################################
 #  PATH: /orders/{id}
 ######################################################################
@@ -124,7 +242,9 @@ class OrderResource(Resource):
     # ------------------------------------------------------------------
     @api.doc('get_orders')
     @api.response(404, 'Order not found')
-    @api.marshal_with(order_model)
+    @api.response(400, 'Invalid fields')
+    @api.expect(view_args, validate=True)
+    @api.response(200, 'Success', order_model)
     def get(self, order_id):
         """
         Retrieve a single Order
@@ -132,11 +252,20 @@ class OrderResource(Resource):
         This endpoint will return an Order based on its ID.
         """
         app.logger.info('Request for order with id: %s', order_id)
-        order = Order.find(order_id)
-        if not order:
+        order_fields, embed_items = projection_args(view_args.parse_args())
+
+        def load_order():
+            order = Order.find(order_id, Order.projection(order_fields, embed_items))
+            if not order:
+                remember_missing(order_id)
+                return None
+            return marshal_orders(order.serialize(order_fields, embed_items), embed_items)
+
+        result = None if known_missing(order_id) else cached_read(f"order:{order_id}", load_order)
+        if result is None:
             abort(status.HTTP_404_NOT_FOUND, f"Order with id '{order_id}' was not found.")
-        app.logger.info('Returning order: %s', order.id)
-        return order.serialize(), status.HTTP_200_OK
+        app.logger.info('Returning order: %s', order_id)
+        return result, status.HTTP_200_OK
 
     # ------------------------------------------------------------------
     # UPDATE AN EXISTING ORDER
@@ -157,10 +286,9 @@ class OrderResource(Resource):
         if not order:
             abort(status.HTTP_404_NOT_FOUND, f"Order with id '{order_id}' was not found.")
 
-        data = api.payload
-        if 'items' in data:
-            del data['items']
-        order.deserialize(data)
+        # Items are changed through their own endpoints and are left alone
+        data = validate_order_update(api.payload)
+        order.deserialize(data, validated=True)
         order.id = order_id
         order.update()
 
@@ -196,9 +324,9 @@ class OrderCollection(Resource):
     # LIST ALL ORDERS
     # ------------------------------------------------------------------
     @api.doc('list_orders')
-    @api.response(400, 'Invalid order status')
+    @api.response(400, 'Invalid order status or fields')
     @api.expect(order_args, validate=True)
-    @api.marshal_list_with(order_model)
+    @api.response(200, 'Success', [order_model])
     def get(self):
         """
         List all of the Orders
@@ -206,24 +334,11 @@ class OrderCollection(Resource):
         This endpoint will return all the orders matching the specified criteria.
         """
         app.logger.info('Request to list Orders...')
-        orders = []
         args = order_args.parse_args()
-        if args['customer_id']:
-            app.logger.info('Filtering by customer id: %s', args['customer_id'])
-            orders = Order.find_by_customer(args['customer_id'])
-        elif args['status']:
-            if args['status'] not in OrderStatus.__members__:
-                abort(status.HTTP_400_BAD_REQUEST, f"Invalid status '{args['status']}'.")
-            app.logger.info('Filtering by order status: %s', args['status'])
-            orders = Order.find_by_status(OrderStatus[args['status']])
-        elif args['product_id']:
-            app.logger.info('Filtering by product id: %s', args['product_id'])
-            orders = Order.find_by_product(args['product_id'])
-        else:
-            app.logger.info('Returning unfiltered list...')
-            orders = Order.all()
-
-        results = [order.serialize() for order in orders]
+        if args['status'] and args['status'] not in OrderStatus.__members__:
+            abort(status.HTTP_400_BAD_REQUEST, f"Invalid status '{args['status']}'.")
+        projection = projection_args(args)
+        results = cached_read(LIST_NAMESPACE, lambda: list_orders(args, *projection))
         app.logger.info('[%s] Orders returned', len(results))
         return results, status.HTTP_200_OK
 
@@ -232,7 +347,10 @@ class OrderCollection(Resource):
     # ------------------------------------------------------------------
     @api.doc('create_orders')
     @api.response(400, 'The posted data was not valid')
+    @api.response(409, 'The Idempotency-Key was used for another request or is in use, or a product is in two items')
+    @api.param(IDEMPOTENCY_HEADER, 'Replays the response of an earlier request with the same key', _in='header')
     @api.expect(order_create_model)
+    @idempotent
     @api.marshal_with(order_model, code=201)
     def post(self):
         """
@@ -242,13 +360,172 @@ class OrderCollection(Resource):
         """
         app.logger.info('Request to Create an Order')
         order = Order()
-        order.deserialize(api.payload)
-        order.create()
+        order.deserialize(validate_order(api.payload), validated=True)
+        try:
+            order.create()
+        except IntegrityError:
+            if not OrderItem.unique_products:
+                raise
+            db.session.rollback()
+            abort(status.HTTP_409_CONFLICT, "A product can only be in one item of an order.")
         location_url = api.url_for(OrderResource, order_id=order.id, _external=True)
         app.logger.info('Order with ID [%s] created.', order.id)
         return order.serialize(), status.HTTP_201_CREATED, {"Location": location_url}
 
 
+######################################################################
+#  PATH: /orders/batch-get
+######################################################################
+@api.route('/orders/batch-get')
+class OrderBatchGet(Resource):
+    """ Reads many Orders at once """
+    @api.doc('batch_get_orders')
+    @api.response(400, 'The posted ids were not valid')
+    @api.expect(batch_get_model)
+    @api.marshal_with(batch_get_result_model)
+    def post(self):
+        """
+        Retrieve many Orders
+
+        This endpoint will return the Orders with the posted ids, in the order of the ids,
+        together with the ids that were not found.
+        """
+        order_ids = validate_batch_get(api.payload)['ids']
+        app.logger.info('Request for %d orders', len(order_ids))
+        orders = Order.find_many(order_ids)
+        found = {order.id for order in orders}
+        missing = [order_id for order_id in dict.fromkeys(order_ids) if order_id not in found]
+        app.logger.info('Returning %d orders, %d missing', len(orders), len(missing))
+        return {'orders': [order.serialize() for order in orders], 'missing': missing}, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /orders/status-transitions
+######################################################################
+@api.route('/orders/status-transitions')
+class OrderStatusTransitions(Resource):
+    """ Moves many Orders to another status at once """
+    @api.doc('transition_orders')
+    @api.response(400, 'The posted data was not valid')
+    @api.expect(status_transition_model)
+    @api.marshal_with(status_transition_result_model)
+    def post(self):
+        """
+        Change the status of many Orders
+
+        This endpoint will move the Orders with the posted ids, or the Orders that match the
+        posted filter, to the target status with a single update. Orders whose status does
+        not allow the transition are left alone and reported as rejected.
+        """
+        data = validate_status_transition(api.payload)
+        if ('ids' in data) == ('filter' in data):
+            abort(status.HTTP_400_BAD_REQUEST, "Select the orders with either ids or a filter.")
+        target = OrderStatus[data['target']]
+        app.logger.info('Request to move orders to %s', target.name)
+        filters = data.get('filter', {})
+        if 'status' in filters:
+            filters['status'] = OrderStatus[filters['status']]
+        updated, rejected = Order.transition_many(target, data.get('ids'), **filters)
+        missing = []
+        if 'ids' in data:
+            known = set(updated).union(rejected)
+            missing = [order_id for order_id in dict.fromkeys(data['ids']) if order_id not in known]
+        app.logger.info('Moved %d orders to %s, %d rejected', len(updated), target.name, len(rejected))
+        return {
+            'target': target.name,
+            'updated': updated,
+            'rejected': [{'id': order_id, 'status': order_status.name} for order_id, order_status in rejected.items()],
+            'missing': missing,
+        }, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /orders/changes
+######################################################################
+@api.route('/orders/changes')
+class OrderChanges(Resource):
+    """ Feeds the changes of Orders to sync jobs """
+    @api.doc('list_order_changes')
+    @api.response(400, 'The limit or timeout was not valid')
+    @api.response(410, 'The changes after the cursor are no longer kept')
+    @api.expect(change_args, validate=True)
+    @api.marshal_with(change_feed_model)
+    def get(self):
+        """
+        List the Orders that changed after a cursor
+
+        This endpoint will return the orders that were created, updated or deleted after the
+        cursor in ?since=, and a new cursor to continue from. Deleted orders are returned as
+        tombstones. With ?timeout= the request waits for a change if there are none yet.
+        """
+        args = change_args.parse_args()
+        if args['since'] is None:
+            cursor = current_cursor(app.config['CHANGE_FEED_SAFETY_LAG_SECONDS'])
+            return {'cursor': cursor, 'has_more': False, 'changes': []}, status.HTTP_200_OK
+        if not 1 <= args['limit'] <= app.config['CHANGE_FEED_MAX_LIMIT']:
+            abort(status.HTTP_400_BAD_REQUEST, f"limit must be 1 to {app.config['CHANGE_FEED_MAX_LIMIT']}.")
+        if not 0 <= args['timeout'] <= app.config['CHANGE_FEED_MAX_WAIT_SECONDS']:
+            abort(status.HTTP_400_BAD_REQUEST,
+                  f"timeout must be 0 to {app.config['CHANGE_FEED_MAX_WAIT_SECONDS']:g} seconds.")
+        app.logger.info('Request for order changes after cursor %s', args['since'])
+        try:
+            feed = read_changes(
+                args['since'], args['limit'], args['timeout'],
+                app.config['CHANGE_FEED_POLL_SECONDS'], app.config['CHANGE_FEED_SAFETY_LAG_SECONDS'],
+            )
+        except StaleCursorError as error:
+            abort(status.HTTP_410_GONE, str(error))
+        app.logger.info('Returning %d order changes up to cursor %s', len(feed['changes']), feed['cursor'])
+        return feed, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /orders/status-stream
+######################################################################
+@api.route('/orders/status-stream')
+class OrderStatusStream(Resource):
+    """ Pushes the status changes of Orders to browsers """
+    @api.doc('stream_order_status', produces=['text/event-stream'])
+    @api.response(200, 'A text/event-stream of status events')
+    @api.response(400, 'Neither or both of order_id and customer_id were given')
+    @api.response(404, 'Order not found')
+    @api.response(503, 'The worker serves as many streams as it may, retry after Retry-After seconds')
+    @api.expect(stream_args, validate=True)
+    def get(self):
+        """
+        Stream the status changes of Orders
+
+        This endpoint will push a Server-Sent Event for every status change of the Order in
+        ?order_id=, or of the Orders of the customer in ?customer_id=. A stream of an Order
+        starts with its current status.
+        """
+        args = stream_args.parse_args()
+        order_id, customer_id = args['order_id'], args['customer_id']
+        if (order_id is None) == (customer_id is None):
+            abort(status.HTTP_400_BAD_REQUEST, "Follow either an order_id or a customer_id.")
+        broker = app.extensions['status_broker']
+        # Subscribe before reading the current status so that no change is missed
+        try:
+            subscription = broker.subscribe(order_id, customer_id)
+        except TooManyStreams as error:
+            app.logger.warning(str(error))
+            headers = {'Retry-After': str(RETRY_AFTER_SECONDS)}
+            return {'message': f'{error}, retry later.'}, status.HTTP_503_SERVICE_UNAVAILABLE, headers
+        first = []
+        if order_id is not None:
+            order = Order.find(order_id, Order.projection(ORDER_FIELDS, False))
+            if not order:
+                broker.unsubscribe(subscription)
+                abort(status.HTTP_404_NOT_FOUND, f"Order with id '{order_id}' was not found.")
+            first.append({'id': order.id, 'customer_id': order.customer_id, 'status': order.status.name})
+        app.logger.info('Streaming the status of order %s customer %s', order_id, customer_id)
+        events = broker.stream(
+            subscription, first, app.config['STATUS_STREAM_KEEPALIVE_SECONDS'], app.config['STATUS_STREAM_MAX_SECONDS']
+        )
+        headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        return Response(events, status=status.HTTP_200_OK, mimetype='text/event-stream', headers=headers)
+
+
 ######################################################################
 #  PATH: /orders/{id}/cancel
 ######################################################################
@@ -269,15 +546,15 @@ class CancelOrderResource(Resource):
         order = Order.find(order_id)
         if not order:
             abort(status.HTTP_404_NOT_FOUND, f"Order with id '{order_id}' was not found.")
-        # If order status passed Shipped, then we set to conflict
-        if order.status in (OrderStatus.SHIPPED, OrderStatus.DELIVERED):
-            abort(
-                status.HTTP_409_CONFLICT,
-                f"Order with id {order_id} is {order.status.name}, request conflicted.")
         if order.status == OrderStatus.CANCELLED:
             abort(
                 status.HTTP_409_CONFLICT,
                 f"Order with id {order_id} is already cancelled.")
+        # If order status passed Shipped, then we set to conflict
+        if order.status not in ALLOWED_TRANSITIONS[OrderStatus.CANCELLED]:
+            abort(
+                status.HTTP_409_CONFLICT,
+                f"Order with id {order_id} is {order.status.name}, request conflicted.")
         order.status = OrderStatus.CANCELLED
         order.update()
         app.logger.info('Order with id [%s] has been cancelled.', order.id)
@@ -313,13 +590,13 @@ class OrderItemResource(Resource):
         This endpoint will return an item from an order based on its ID.
         """
         app.logger.info('Request to retrieve an Item %s from Order with id: %s', item_id, order_id)
-        order = Order.find(order_id)
+        order = find_order(order_id)
         if not order:
             abort(
                 status.HTTP_404_NOT_FOUND,
                 f"Order with id '{order_id}' was not found.",
             )
-        item = OrderItem.find_by_order_and_item_id(order_id, item_id)
+        item = find_order_item(order_id, item_id)
         if not item:
             abort(
                 status.HTTP_404_NOT_FOUND,
@@ -334,6 +611,7 @@ class OrderItemResource(Resource):
     @api.doc('update_order_items')
     @api.response(404, 'Order Item not found')
     @api.response(400, 'The posted Order Item data was not valid')
+    @api.response(409, 'The product is in another item of the Order')
     @api.expect(item_model)
     @api.marshal_with(item_model)
     def put(self, order_id, item_id):
@@ -352,11 +630,17 @@ class OrderItemResource(Resource):
         if not item:
             abort(status.HTTP_404_NOT_FOUND, f"Item with id '{item_id}' was not found.")
 
-        data = api.payload
-        item.deserialize(data)
+        data = validate_item(api.payload)
+        item.deserialize(data, validated=True)
         item.id = item_id
         item.order_id = order_id
-        item.update()
+        try:
+            item.update()
+        except IntegrityError:
+            if not OrderItem.unique_products:
+                raise
+            db.session.rollback()
+            abort(status.HTTP_409_CONFLICT, f"Product {data['product_id']} is already in order {order_id}.")
 
         app.logger.info('Item with order_id [%s] and item_id [%s] updated.', order.id, item.id)
         return item.serialize(), status.HTTP_200_OK
@@ -404,7 +688,7 @@ class OrderItemCollection(Resource):
         This endpoint will return all the Items by Order ID.
         """
         app.logger.info('Request to list Items for Order with id: %s', order_id)
-        order = Order.find(order_id)
+        order = find_order(order_id)
         if not order:
             abort(status.HTTP_404_NOT_FOUND, f"Order with id '{order_id}' was not found.")
 
@@ -416,34 +700,153 @@ class OrderItemCollection(Resource):
     # ADD A NEW ITEM TO AN ORDER
     # ------------------------------------------------------------------
     @api.doc('create_order_items')
+    @api.response(200, 'The quantity was added to the item of the same product', item_model)
     @api.response(400, 'The posted data was not valid')
-    @api.expect(item_create_model)
+    @api.response(409, 'The product is already in the order, or the Idempotency-Key is in use')
+    @api.param(IDEMPOTENCY_HEADER, 'Replays the response of an earlier request with the same key', _in='header')
+    @api.expect(item_create_model, item_args)
+    @idempotent
     @api.marshal_with(item_model, code=201)
     def post(self, order_id):
         """
         Create an item on an order
 
-        This endpoint will add a new item to an order.
+        This endpoint will add a new item to an order. With ?merge=true the quantity is added
+        to the item of the same product instead, if the order has one.
         """
         app.logger.info('Request to create an Item for Order with id: %s', order_id)
+        merge = item_args.parse_args()['merge']
         order = Order.find(order_id)
         if not order:
             abort(status.HTTP_404_NOT_FOUND, f"Order with id '{order_id}' was not found.")
 
-        item = OrderItem()
-        item.deserialize(api.payload)
-        item.order_id = order_id
-        item.create()
+        data = validate_item(api.payload)
+        if merge:
+            item, created = OrderItem.merge(order_id, data)
+        else:
+            item, created = create_item(order_id, data), True
 
-        location_url = api.url_for(OrderItemResource, order_id=order.id, item_id=item.id, _external=True)
-        app.logger.info('Item with ID [%s] created for order: [%s].', item.id, order.id)
-        return item.serialize(), status.HTTP_201_CREATED, {"Location": location_url}
+        location_url = api.url_for(OrderItemResource, order_id=order_id, item_id=item.id, _external=True)
+        if created:
+            app.logger.info('Item with ID [%s] created for order: [%s].', item.id, order_id)
+            return item.serialize(), status.HTTP_201_CREATED, {"Location": location_url}
+        app.logger.info('Item with ID [%s] of order [%s] merged.', item.id, order_id)
+        return item.serialize(), status.HTTP_200_OK, {"Location": location_url}
 
 
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
+def projection_args(args) -> tuple:
+    """Returns the fields to return and whether to embed the items"""
+    order_fields = None
+    if args['fields']:
+        order_fields = tuple(dict.fromkeys(name.strip() for name in args['fields'].split(',') if name.strip()))
+        if not order_fields:
+            abort(status.HTTP_400_BAD_REQUEST, f"No fields selected, choose from {', '.join(ORDER_FIELDS)}.")
+        for name in order_fields:
+            if name not in ORDER_FIELDS:
+                abort(status.HTTP_400_BAD_REQUEST, f"Invalid field '{name}', choose from {', '.join(ORDER_FIELDS)}.")
+    return order_fields, args['embed'] == 'items'
+
+
+def list_orders(args, order_fields: tuple, embed_items: bool) -> list:
+    """Returns the marshaled orders that match the filters of a request"""
+    options = Order.projection(order_fields, embed_items)
+    if args['customer_id']:
+        app.logger.info('Filtering by customer id: %s', args['customer_id'])
+        orders = Order.find_by_customer(args['customer_id']).options(*options)
+    elif args['status']:
+        app.logger.info('Filtering by order status: %s', args['status'])
+        orders = Order.find_by_status(OrderStatus[args['status']]).options(*options)
+    elif args['product_id']:
+        app.logger.info('Filtering by product id: %s', args['product_id'])
+        orders = Order.find_by_product(args['product_id']).options(*options)
+    else:
+        app.logger.info('Returning unfiltered list...')
+        orders = Order.all(options)
+    return marshal_orders([order.serialize(order_fields, embed_items) for order in orders], embed_items)
+
+
+def cached_read(namespace: str, loader):
+    """Returns the result of loader() from the order cache if ORDER_CACHE is set
+
+    The result is cached under the path and the sorted query arguments of
+    the request, and dropped when the orders of the namespace change. With
+    READ_COALESCING, identical reads in progress at the same time share one.
+    """
+    key = request.path + "?" + urlencode(sorted(request.args.items(multi=True)))
+    cache = app.extensions.get('order_cache')
+    read = loader if cache is None else lambda: cache.get_or_load(namespace, key, loader)
+    flights = app.extensions.get('read_flights')
+    if flights is None:
+        return read()
+    return flights.do(key, read, endpoint_name())
+
+
+def find_order(order_id: int):
+    """Returns an Order, or None without a query if it is known to be missing"""
+    if known_missing(order_id):
+        return None
+    order = Order.find(order_id)
+    if order is None:
+        remember_missing(order_id)
+    return order
+
+
+def find_order_item(order_id: int, item_id: int):
+    """Returns an Order Item, or None without a query if it is known to be missing"""
+    if known_missing(order_id, item_id):
+        return None
+    item = OrderItem.find_by_order_and_item_id(order_id, item_id)
+    if item is None:
+        remember_missing(order_id, item_id)
+    return item
+
+
+def known_missing(order_id: int, item_id: int = None) -> bool:
+    """Returns whether MISSING_ID_CACHE knows that an Order or Order Item does not exist"""
+    missing_ids = app.extensions.get('missing_ids')
+    if missing_ids is None:
+        return False
+    if item_id is None:
+        return missing_ids.order_missing(order_id)
+    return missing_ids.item_missing(order_id, item_id)
+
+
+def remember_missing(order_id: int, item_id: int = None):
+    """Lets MISSING_ID_CACHE remember an Order or Order Item that a lookup did not find"""
+    missing_ids = app.extensions.get('missing_ids')
+    if missing_ids is not None:
+        missing_ids.remember(order_id, item_id)
+
+
+def create_item(order_id: int, data: dict) -> OrderItem:
+    """Creates an item, together with the items of other requests in group commit mode"""
+    item = OrderItem()
+    item.deserialize(data, validated=True)
+    item.order_id = order_id
+    committer = app.extensions.get('item_group_commit')
+    try:
+        if committer:
+            committer.create(item)
+        else:
+            item.create()
+    except IntegrityError:
+        if not OrderItem.unique_products:
+            raise
+        db.session.rollback()
+        abort(status.HTTP_409_CONFLICT,
+              f"Product {data['product_id']} is already in order {order_id}, add ?merge=true to add to its quantity.")
+    return item
+
+
+def marshal_orders(data, embed_items: bool):
+    """Marshals serialized orders, leaving out the fields that were not selected"""
+    return marshal(data, order_model if embed_items else order_summary_model, skip_none=True)
+
+
 def abort(error_code: int, message: str):
-    """Logs errors before aborting"""
-    app.logger.error(message)
+    """Logs errors before aborting, 404 Not Found at info level"""
+    app.logger.log(logging.INFO if error_code == status.HTTP_404_NOT_FOUND else logging.ERROR, message)
     api.abort(error_code, message)
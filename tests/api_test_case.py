@@ -0,0 +1,41 @@
+"""
+Base Test Case for the tests of the REST API
+"""
+from service import app
+from service.common import status  # HTTP Status Codes
+from tests.database_test_case import DatabaseTestCase
+from tests.factories import OrderFactory
+
+BASE_URL = "/api/orders"
+
+
+class ApiTestCase(DatabaseTestCase):
+    """Runs every test with a client of the app against empty tables"""
+
+    def setUp(self):
+        """ This runs before each test """
+        super().setUp()
+        self.app = app.test_client()
+
+    def _create_orders(self, count):
+        """Factory method to create orders in bulk"""
+        orders = []
+        for _ in range(count):
+            test_order = OrderFactory()
+            response = self.app.post(BASE_URL, json=test_order.serialize())
+            self.assertEqual(
+                response.status_code, status.HTTP_201_CREATED, "Could not create test order"
+            )
+            new_order = response.get_json()
+            test_order.id = new_order["id"]
+            orders.append(test_order)
+        return orders
+
+    def _create_orders_with_status(self, statuses, customer_id=7):
+        """Creates one order of the customer with each of the statuses"""
+        order_ids = []
+        for order_status in statuses:
+            resp = self.app.post(BASE_URL, json={"customer_id": customer_id, "status": order_status.name})
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+            order_ids.append(resp.get_json()["id"])
+        return order_ids
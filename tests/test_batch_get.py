@@ -0,0 +1,28 @@
+"""
+Test cases for getting many Orders at once
+"""
+from service import app
+from service.common import status  # HTTP Status Codes
+from tests.api_test_case import BASE_URL, ApiTestCase
+
+
+class TestBatchGet(ApiTestCase):
+    """Batch Get Tests"""
+
+    def test_batch_get_orders(self):
+        """It should Get many Orders in the order of the ids with two queries"""
+        orders = self._create_orders(3)
+        order_ids = [orders[2].id, 0, orders[0].id, orders[2].id, orders[2].id + 100]
+        resp = self.app.post(f"{BASE_URL}/batch-get", json={"ids": order_ids})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([order["id"] for order in data["orders"]], [orders[2].id, orders[0].id])
+        self.assertEqual(len(data["orders"][0]["items"]), len(orders[2].items))
+        self.assertEqual(data["missing"], [0, orders[2].id + 100])
+        self.assertIn('desc="2 queries"', resp.headers["Server-Timing"])
+
+    def test_batch_get_bad_ids(self):
+        """It should not Get many Orders with bad ids"""
+        for body in ({}, {"ids": []}, {"ids": [1, "2"]}, {"ids": list(range(app.config["BATCH_GET_MAX_IDS"] + 1))}):
+            resp = self.app.post(f"{BASE_URL}/batch-get", json=body)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,90 @@
+"""
+Test cases for the Order Cache
+"""
+import time
+import logging
+import threading
+from unittest import TestCase
+from service import app
+from service.common.cache import LRUCache, MemoryBackend, TieredCache, make_backend
+
+
+class FailingBackend(MemoryBackend):
+    """A shared tier that cannot be reached"""
+
+    def get_many(self, keys: list) -> list:
+        raise ConnectionError("cache is down")
+
+
+class TestOrderCache(TestCase):
+    """Order Cache Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """ This runs once before the entire test suite """
+        app.logger.setLevel(logging.CRITICAL)
+
+    def test_lru_eviction(self):
+        """It should evict the least recently used and the expired values"""
+        cache = LRUCache(max_entries=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        cache.ttl = -1
+        cache.set("d", 4)
+        self.assertIsNone(cache.get("d"))
+
+    def test_invalidate_across_workers(self):
+        """It should drop the values of changed orders in every worker"""
+        backend = MemoryBackend()
+        workers = [TieredCache(backend), TieredCache(backend)]
+        self.assertEqual(workers[0].get_or_load("order:1", "/orders/1", lambda: {"status": "CREATED"}),
+                         {"status": "CREATED"})
+        self.assertEqual(workers[1].get_or_load("order:1", "/orders/1", lambda: {"status": "STALE"}),
+                         {"status": "CREATED"})
+        self.assertEqual(workers[1].get_or_load("orders", "/orders", lambda: [1]), [1])
+        workers[1].invalidate({1})
+        for worker in workers:
+            self.assertEqual(worker.get_or_load("order:1", "/orders/1", lambda: {"status": "PLACED"}),
+                             {"status": "PLACED"})
+        self.assertEqual(workers[0].get_or_load("orders", "/orders", lambda: [2]), [2])
+        self.assertEqual(workers[0].get_or_load("order:2", "/orders/2", lambda: None), None)
+        self.assertEqual(workers[0].get_or_load("order:2", "/orders/2", lambda: {"id": 2}), {"id": 2})
+
+    def test_stampede(self):
+        """It should load a missing key once for concurrent readers"""
+        cache = TieredCache(MemoryBackend(), lock_wait=2.0)
+        calls = []
+        results = []
+        start = threading.Barrier(8)
+
+        def loader():
+            calls.append(1)
+            time.sleep(0.1)
+            return {"id": 1}
+
+        def read():
+            start.wait()
+            results.append(cache.get_or_load("order:1", "/orders/1", loader))
+
+        threads = [threading.Thread(target=read) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"id": 1}] * 8)
+
+    def test_backend_down(self):
+        """It should fall back to the loader when the shared tier fails"""
+        cache = TieredCache(FailingBackend())
+        with app.app_context():
+            self.assertEqual(cache.get_or_load("order:1", "/orders/1", lambda: {"id": 1}), {"id": 1})
+
+    def test_make_backend(self):
+        """It should only accept redis:// and memory:// URLs"""
+        self.assertIsInstance(make_backend("memory://"), MemoryBackend)
+        self.assertRaises(ValueError, make_backend, "ftp://cache")
@@ -0,0 +1,97 @@
+"""
+Test cases for the change feed of Orders
+"""
+import threading
+from datetime import datetime, timedelta
+from service import app
+from service.models import db, OrderStatus
+from service.outbox_events import OrderEvent
+from service.common import status  # HTTP Status Codes
+from tests.api_test_case import BASE_URL, ApiTestCase
+
+
+class TestChangeFeed(ApiTestCase):
+    """Change Feed Tests"""
+
+    def test_order_changes(self):
+        """It should return the Orders that changed after a cursor, with tombstones"""
+        cursor = self.app.get(f"{BASE_URL}/changes").get_json()["cursor"]
+        order_ids = self._create_orders_with_status([OrderStatus.CONFIRMED] * 3)
+        self.app.put(f"{BASE_URL}/{order_ids[0]}", json={"customer_id": 9, "status": "SHIPPED"})
+        self.app.delete(f"{BASE_URL}/{order_ids[1]}")
+        resp = self.app.get(f"{BASE_URL}/changes", query_string={"since": cursor})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertFalse(data["has_more"])
+        self.assertEqual([(change["id"], change["op"]) for change in data["changes"]], [
+            (order_ids[0], "upsert"), (order_ids[1], "delete"), (order_ids[2], "upsert"),
+        ])
+        self.assertEqual(data["changes"][0]["order"]["status"], "SHIPPED")
+        self.assertIsNone(data["changes"][1]["order"])
+        # The feed can be read in pages and is empty at the latest cursor
+        page = self.app.get(f"{BASE_URL}/changes", query_string={"since": cursor, "limit": 1}).get_json()
+        self.assertTrue(page["has_more"])
+        self.assertEqual([change["id"] for change in page["changes"]], [order_ids[0]])
+        latest = self.app.get(f"{BASE_URL}/changes", query_string={"since": data["cursor"]}).get_json()
+        self.assertEqual(latest, {"cursor": data["cursor"], "has_more": False, "changes": []})
+
+    def test_order_changes_long_poll(self):
+        """It should wait for the next change of an Order"""
+        cursor = self.app.get(f"{BASE_URL}/changes").get_json()["cursor"]
+        timer = threading.Timer(0.2, lambda: app.test_client().post(BASE_URL, json={"customer_id": 5}))
+        timer.start()
+        resp = self.app.get(f"{BASE_URL}/changes", query_string={"since": cursor, "timeout": 10})
+        timer.join()
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()["changes"]), 1)
+
+    def test_order_changes_after_purge(self):
+        """It should keep the cursor increasing after every event was purged"""
+        self._create_orders_with_status([OrderStatus.CONFIRMED] * 2)
+        self._age_events()
+        cursor = self.app.get(f"{BASE_URL}/changes").get_json()["cursor"]
+        self.assertEqual(cursor, 2)
+        self.assertEqual(OrderEvent.purge_written(datetime.utcnow()), 1)
+        self.assertEqual(self.app.get(f"{BASE_URL}/changes").get_json()["cursor"], cursor)
+        order_ids = self._create_orders_with_status([OrderStatus.CONFIRMED])
+        self._age_events()
+        data = self.app.get(f"{BASE_URL}/changes", query_string={"since": cursor}).get_json()
+        self.assertEqual([change["id"] for change in data["changes"]], order_ids)
+        self.assertEqual(data["cursor"], cursor + 1)
+
+    @staticmethod
+    def _age_events():
+        """Moves the events out of the safety lag of the change feed"""
+        for event in OrderEvent.query.all():
+            event.created_at -= timedelta(seconds=60)
+        db.session.commit()
+
+    def test_order_changes_bad_cursor(self):
+        """It should not return changes for bad arguments or purged cursors"""
+        for query in ({"since": 0, "limit": 0}, {"since": 0, "timeout": -1}, {"since": "x"}):
+            resp = self.app.get(f"{BASE_URL}/changes", query_string=query)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, query)
+        self._create_orders_with_status([OrderStatus.CONFIRMED] * 2)
+        OrderEvent.query.filter(OrderEvent.id == 1).delete()
+        db.session.commit()
+        resp = self.app.get(f"{BASE_URL}/changes", query_string={"since": 0})
+        self.assertEqual(resp.status_code, status.HTTP_410_GONE)
+        resp = self.app.get(f"{BASE_URL}/changes", query_string={"since": 1})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_order_changes_in_flight(self):
+        """It should not move past a missing change until it is older than the safety lag"""
+        order_ids = self._create_orders_with_status([OrderStatus.CONFIRMED] * 3)
+        event_ids = [event.id for event in OrderEvent.query.order_by(OrderEvent.id)]
+        self.assertEqual(self.app.get(f"{BASE_URL}/changes").get_json()["cursor"], event_ids[0] - 1)
+        OrderEvent.query.filter(OrderEvent.id == event_ids[1]).delete()
+        db.session.commit()
+        data = self.app.get(f"{BASE_URL}/changes", query_string={"since": event_ids[0] - 1}).get_json()
+        self.assertEqual([change["id"] for change in data["changes"]], [order_ids[0]])
+        self.assertEqual(data["cursor"], event_ids[0])
+        self.assertFalse(data["has_more"])
+        event = db.session.get(OrderEvent, event_ids[2])
+        event.created_at -= timedelta(minutes=1)
+        db.session.commit()
+        data = self.app.get(f"{BASE_URL}/changes", query_string={"since": event_ids[0]}).get_json()
+        self.assertEqual([change["id"] for change in data["changes"]], [order_ids[2]])
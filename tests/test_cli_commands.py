@@ -2,10 +2,14 @@
 CLI Command Extensions for Flask
 """
 import os
+import tempfile
 from unittest import TestCase
 from unittest.mock import patch, MagicMock
 from click.testing import CliRunner
-from service.common.cli_commands import db_create
+from service import app
+from service.models import Order, OrderItem, OrderStatus
+from service.common.cli_commands import db_create, db_init, orders_seed, outbox_publish
+from tests.database_test_case import DatabaseTestCase
 
 
 class TestFlaskCLI(TestCase):
@@ -21,3 +25,82 @@ class TestFlaskCLI(TestCase):
         with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
             result = self.runner.invoke(db_create)
             self.assertEqual(result.exit_code, 0)
+
+    @patch('service.common.cli_commands.create_indexes')
+    @patch('service.common.cli_commands.db')
+    def test_db_init(self, db_mock, create_indexes_mock):
+        """It should call the db-init command without dropping tables"""
+        with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
+            result = self.runner.invoke(db_init)
+            self.assertEqual(result.exit_code, 0)
+            db_mock.create_all.assert_called_once()
+            create_indexes_mock.assert_called_once()
+            db_mock.drop_all.assert_not_called()
+
+
+class TestSeedCommand(DatabaseTestCase):
+    """Test the orders-seed and outbox-publish commands against the database"""
+
+    def setUp(self):
+        """ This runs before each test """
+        super().setUp()
+        self.runner = CliRunner()
+
+    def test_orders_seed(self):
+        """It should generate orders and items in batches"""
+        result = self.runner.invoke(orders_seed, [
+            "--orders", "25", "--batch-size", "10", "--items", "1:1,3:1",
+            "--statuses", "SHIPPED:1,CANCELLED:1", "--seed", "7",
+        ])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Seeded 25 orders", result.output)
+        orders = Order.all()
+        self.assertEqual(len(orders), 25)
+        for order in orders:
+            self.assertIn(order.status, (OrderStatus.SHIPPED, OrderStatus.CANCELLED))
+            self.assertIn(len(order.items), (1, 3))
+        self.assertEqual(len(OrderItem.all()), sum(len(order.items) for order in orders))
+
+    def test_orders_seed_refuses_shards_and_memory(self):
+        """It should refuse to seed sharded or in-memory orders"""
+        for key, value in (("ORDER_SHARDS", "sqlite://"), ("ORDER_STORAGE", "memory")):
+            default = app.config.get(key)
+            app.config[key] = value
+            try:
+                result = self.runner.invoke(orders_seed, ["--orders", "5"])
+            finally:
+                app.config[key] = default
+            self.assertEqual(result.exit_code, 2, result.output)
+            self.assertIn(key, result.output)
+        self.assertEqual(Order.all(), [])
+
+    def test_orders_seed_keeps_ids_unique(self):
+        """It should keep existing data and let new orders be created"""
+        order = Order(customer_id=1, status=OrderStatus.CONFIRMED, items=[])
+        order.create()
+        result = self.runner.invoke(orders_seed, ["--orders", "5", "--seed", "1"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        order = Order(customer_id=2, status=OrderStatus.CONFIRMED, items=[])
+        order.create()
+        self.assertEqual(order.id, 7)
+        self.assertEqual(len(Order.all()), 7)
+
+    def test_orders_seed_bad_weights(self):
+        """It should reject an unknown status"""
+        result = self.runner.invoke(orders_seed, ["--statuses", "LOST:1"])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn("--statuses", result.output)
+
+    def test_outbox_publish(self):
+        """It should deliver the waiting order events to a sink"""
+        Order(customer_id=1, status=OrderStatus.CONFIRMED, items=[]).create()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "events.jsonl")
+            result = self.runner.invoke(outbox_publish, ["--sink", f"file://{path}", "--once"])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn("Published 1 events", result.output)
+            with open(path, encoding="utf-8") as events_file:
+                self.assertIn('"type":"order.created"', events_file.read())
+        result = self.runner.invoke(outbox_publish, ["--sink", "kafka://localhost", "--once"])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn("--sink", result.output)
@@ -0,0 +1,122 @@
+"""
+Test cases for the reads that are answered without querying the database
+"""
+import threading
+import time
+from unittest.mock import patch
+from service import app
+from service.models import db, Order, OrderItem, OrderStatus
+from service.repository import use_repository
+from service.common import status  # HTTP Status Codes
+from service.common.cache import init_cache
+from service.common.memory_store import MemoryRepository
+from service.common.missing_ids import init_missing_ids
+from tests.api_test_case import BASE_URL, ApiTestCase
+from tests.factories import OrderFactory, OrderItemFactory
+
+
+class TestFastReads(ApiTestCase):
+    """Cache, Coalescing, Missing Id and In-Memory Storage Tests"""
+
+    def test_cached_reads(self):
+        """It should serve repeated reads from the cache until the Order changes"""
+        order = self._create_orders(1)[0]
+        app.config["ORDER_CACHE"] = "memory://"
+        self.addCleanup(app.config.update, ORDER_CACHE="")
+        self.addCleanup(app.extensions.pop, "order_cache")
+        init_cache(app)
+        for url in (f"{BASE_URL}/{order.id}", f"{BASE_URL}?customer_id={order.customer_id}"):
+            first = self.app.get(url)
+            self.assertEqual(first.status_code, status.HTTP_200_OK)
+            second = self.app.get(url)
+            self.assertEqual(second.get_json(), first.get_json())
+            self.assertIn('desc="0 queries"', second.headers["Server-Timing"])
+        data = self.app.get(f"{BASE_URL}/{order.id}").get_json()
+        data["status"] = "DELIVERED"
+        self.assertEqual(self.app.put(f"{BASE_URL}/{order.id}", json=data).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.app.get(f"{BASE_URL}/{order.id}").get_json()["status"], "DELIVERED")
+        resp = self.app.get(BASE_URL, query_string={"customer_id": order.customer_id})
+        self.assertEqual(resp.get_json()[0]["status"], "DELIVERED")
+        self.assertEqual(self.app.delete(f"{BASE_URL}/{order.id}").status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.app.get(f"{BASE_URL}/{order.id}").status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_coalesced_reads(self):
+        """It should run one query for identical concurrent reads"""
+        order_id = self._create_orders(1)[0].id
+        find = Order.find
+        start = threading.Barrier(6)
+        responses = []
+
+        def slow_find(*args):
+            time.sleep(0.2)
+            return find(*args)
+
+        def read():
+            start.wait()
+            responses.append(app.test_client().get(f"{BASE_URL}/{order_id}"))
+
+        with patch.object(Order, "find", side_effect=slow_find) as mock_find:
+            threads = [threading.Thread(target=read) for _ in range(6)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual([resp.get_json()["id"] for resp in responses], [order_id] * 6)
+        self.assertLess(mock_find.call_count, 6)
+
+    def test_missing_ids(self):
+        """It should answer repeated requests for missing ids without queries"""
+        orders = self._create_orders(2)
+        self.app.delete(f"{BASE_URL}/{orders[0].id}")
+        app.config["MISSING_ID_CACHE"] = True
+        self.addCleanup(app.config.update, MISSING_ID_CACHE=False)
+        self.addCleanup(app.extensions.pop, "missing_ids")
+        missing_ids = init_missing_ids(app)
+        next_id = orders[1].id + 1
+        # An id above the highest one is only rejected right after that was read, and not remembered
+        self.assertEqual(self.app.get(f"{BASE_URL}/{next_id + 1}").status_code, status.HTTP_404_NOT_FOUND)
+        self.assertFalse(missing_ids.missing.get(next_id + 1, False))
+        self.assertFalse(missing_ids.order_missing(next_id + 1))
+        self.assertEqual(self.app.get(f"{BASE_URL}/{orders[0].id}").status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.get(f"{BASE_URL}/{orders[0].id}")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertIn('desc="0 queries"', resp.headers["Server-Timing"])
+        # An id above the highest one that is looked up in between is not remembered either
+        self.assertEqual(self.app.get(f"{BASE_URL}/{next_id}").status_code, status.HTTP_404_NOT_FOUND)
+        self.assertFalse(missing_ids.missing.get(next_id, False))
+        # Creating the missing id makes it visible right away
+        resp = self.app.post(BASE_URL, json=OrderFactory().serialize())
+        self.assertEqual(resp.get_json()["id"], next_id)
+        self.assertEqual(self.app.get(f"{BASE_URL}/{next_id}").status_code, status.HTTP_200_OK)
+        item_url = f"{BASE_URL}/{next_id}/items"
+        items = self.app.get(item_url).get_json()
+        next_item_id = max([item["id"] for item in items] + [OrderItem.max_id()]) + 1
+        self.assertEqual(self.app.get(f"{item_url}/{next_item_id}").status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.post(item_url, json=OrderItemFactory().serialize())
+        self.assertEqual(resp.get_json()["id"], next_item_id)
+        self.assertEqual(self.app.get(f"{item_url}/{next_item_id}").status_code, status.HTTP_200_OK)
+
+    def test_memory_storage(self):
+        """It should serve the Orders from memory without queries"""
+        self.addCleanup(use_repository, use_repository(MemoryRepository()))
+        orders = self._create_orders(3)
+        self.assertEqual(db.session.scalar(db.select(db.func.count(Order.id))), 0)
+        resp = self.app.post(f"{BASE_URL}/{orders[1].id}/items", json=OrderItemFactory(product_id=42).serialize())
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        item = resp.get_json()
+        resp = self.app.get(BASE_URL, query_string={"product_id": 42})
+        self.assertEqual([order["id"] for order in resp.get_json()], [orders[1].id])
+        self.assertIn('desc="0 queries"', resp.headers["Server-Timing"])
+        resp = self.app.get(BASE_URL, query_string={"customer_id": orders[2].customer_id})
+        self.assertEqual([order["id"] for order in resp.get_json()], [orders[2].id])
+        resp = self.app.put(f"{BASE_URL}/{orders[1].id}/items/{item['id']}", json=dict(item, quantity=9))
+        self.assertEqual(resp.get_json()["quantity"], 9)
+        order_id = self.app.post(BASE_URL, json=OrderFactory(status=OrderStatus.CONFIRMED).serialize()).get_json()["id"]
+        resp = self.app.put(f"{BASE_URL}/{order_id}/cancel")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get(BASE_URL, query_string={"status": "CANCELLED"})
+        self.assertIn(order_id, [order["id"] for order in resp.get_json()])
+        self.app.delete(f"{BASE_URL}/{orders[1].id}")
+        resp = self.app.get(f"{BASE_URL}/{orders[1].id}/items/{item['id']}")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(len(self.app.get(BASE_URL).get_json()), 3)
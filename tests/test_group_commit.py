@@ -0,0 +1,62 @@
+"""
+Test cases for the Group Commit of Order Items
+"""
+import threading
+from service import app
+from service.models import OrderItem
+from service.common.group_commit import GroupCommitter
+from tests.database_test_case import DatabaseTestCase
+from tests.factories import OrderFactory
+
+
+class TestGroupCommit(DatabaseTestCase):
+    """Group Commit Tests"""
+
+    def setUp(self):
+        """ This runs before each test """
+        super().setUp()
+        order = OrderFactory()
+        order.items = []
+        order.create()
+        self.order_id = order.id
+
+    def _item(self, **values):
+        """Returns a new item of the test order"""
+        item = OrderItem(product_id=1, quantity=1, price=9.5, order_id=self.order_id)
+        for key, value in values.items():
+            setattr(item, key, value)
+        return item
+
+    def test_create_batch(self):
+        """It should create many items with one commit, and each on its own if that fails"""
+        items = [self._item(product_id=product_id) for product_id in range(3)]
+        self.assertEqual(OrderItem.create_batch(items), {})
+        self.assertEqual([item.product_id for item in OrderItem.all()], [0, 1, 2])
+        self.assertTrue(all(item.id for item in items))
+        self.assertEqual(items[0].serialize()["order_id"], self.order_id)
+        items = [self._item(product_id=3), self._item(price=None), self._item(product_id=4)]
+        errors = OrderItem.create_batch(items)
+        self.assertEqual(list(errors), [1])
+        self.assertEqual(sorted(item.product_id for item in OrderItem.all()), [0, 1, 2, 3, 4])
+
+    def test_errors_reach_their_request(self):
+        """It should raise the error of an item only in the request that added it"""
+        committer = GroupCommitter(max_batch=2, max_wait=1)
+        errors = []
+
+        def add(item):
+            try:
+                with app.app_context():
+                    committer.create(item)
+            except Exception as error:  # pylint: disable=broad-except
+                errors.append(error)
+
+        good, bad = self._item(), self._item(price=None)
+        threads = [threading.Thread(target=add, args=(item,)) for item in (good, bad)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), 1)
+        self.assertIsNotNone(good.id)
+        self.assertEqual([item.id for item in OrderItem.all()], [good.id])
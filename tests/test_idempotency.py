@@ -0,0 +1,68 @@
+"""
+Test cases for the Idempotency-Key of POST requests
+"""
+from service import app
+from service.common import status  # HTTP Status Codes
+from tests.api_test_case import BASE_URL, ApiTestCase
+from tests.factories import OrderFactory, OrderItemFactory
+
+
+class TestIdempotency(ApiTestCase):
+    """Idempotency Key Tests"""
+
+    def test_create_order_idempotent(self):
+        """It should replay the response of a repeated Idempotency-Key"""
+        test_order = OrderFactory().serialize()
+        headers = {"Idempotency-Key": "order-1"}
+        first = self.app.post(BASE_URL, json=test_order, headers=headers)
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn("Idempotent-Replayed", first.headers)
+        retry = self.app.post(BASE_URL, json=test_order, headers=headers)
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(retry.headers["Location"], first.headers["Location"])
+        self.assertEqual(retry.get_json(), first.get_json())
+        self.assertEqual(len(self.app.get(BASE_URL).get_json()), 1)
+        # A new key creates a new order
+        other = self.app.post(BASE_URL, json=test_order, headers={"Idempotency-Key": "order-2"})
+        self.assertNotEqual(other.get_json()["id"], first.get_json()["id"])
+
+    def test_create_order_idempotency_conflict(self):
+        """It should not reuse an Idempotency-Key for a different request"""
+        headers = {"Idempotency-Key": "order-1"}
+        response = self.app.post(BASE_URL, json=OrderFactory().serialize(), headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.app.post(BASE_URL, json=OrderFactory().serialize(), headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        response = self.app.post(BASE_URL, json=OrderFactory().serialize(), headers={"Idempotency-Key": "x" * 256})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_create_order_idempotency_expired(self):
+        """It should process a request again once its Idempotency-Key expired"""
+        test_order = OrderFactory().serialize()
+        headers = {"Idempotency-Key": "order-1"}
+        app.config["IDEMPOTENCY_TTL_SECONDS"] = 0
+        try:
+            first = self.app.post(BASE_URL, json=test_order, headers=headers)
+            retry = self.app.post(BASE_URL, json=test_order, headers=headers)
+        finally:
+            app.config["IDEMPOTENCY_TTL_SECONDS"] = 86400
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn("Idempotent-Replayed", retry.headers)
+        self.assertNotEqual(retry.get_json()["id"], first.get_json()["id"])
+
+    def test_create_item_idempotent(self):
+        """It should replay the response of a repeated item with an Idempotency-Key"""
+        headers = {"Idempotency-Key": "item-1"}
+        test_item = OrderItemFactory().serialize()
+        # A failed request does not keep the key
+        response = self.app.post(f"{BASE_URL}/0/items", json=test_item, headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        order = self._create_orders(1)[0]
+        first = self.app.post(f"{BASE_URL}/{order.id}/items", json=test_item, headers=headers)
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        retry = self.app.post(f"{BASE_URL}/{order.id}/items", json=test_item, headers=headers)
+        self.assertEqual(retry.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(retry.get_json(), first.get_json())
+        items = self.app.get(f"{BASE_URL}/{order.id}/items").get_json()
+        self.assertEqual(len(items), len(order.items) + 1)
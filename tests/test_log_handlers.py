@@ -0,0 +1,86 @@
+"""
+Test cases for the Log Handlers
+"""
+import json
+import logging
+from unittest import TestCase
+from service import app
+from service.common.log_handlers import (
+    JsonFormatter, LogPipeline, RouteSampler, init_logging, parse_sampling
+)
+
+
+class ListHandler(logging.Handler):
+    """Collects the records it handles"""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestLogHandlers(TestCase):
+    """Log Handlers Tests"""
+
+    def test_parse_sampling(self):
+        """It should parse per route sample rates"""
+        rates = parse_sampling("GET order_resource=0.01, get order_collection=0.5,")
+        self.assertEqual(rates, {("GET", "order_resource"): 0.01, ("GET", "order_collection"): 0.5})
+        self.assertEqual(parse_sampling(""), {})
+
+    def test_pipeline(self):
+        """It should write out queued records on a background thread"""
+        handler = ListHandler()
+        pipeline = LogPipeline([handler])
+        logger = logging.getLogger("test_pipeline")
+        logger.propagate = False
+        logger.handlers = [pipeline.queue_handler]
+        pipeline.start()
+        logger.warning("Order %s was not found", 42)
+        pipeline.stop()
+        self.assertEqual(len(handler.records), 1)
+        self.assertEqual(handler.records[0].getMessage(), "Order 42 was not found")
+
+    def test_init_logging_queue(self):
+        """It should send the app logs through a queue when gunicorn has handlers"""
+        handler = ListHandler()
+        gunicorn_logger = logging.getLogger("test_gunicorn")
+        gunicorn_logger.handlers = [handler]
+        self.addCleanup(setattr, gunicorn_logger, "handlers", [])
+        self.addCleanup(app.logger.setLevel, app.logger.level)
+        self.addCleanup(setattr, app.logger, "propagate", app.logger.propagate)
+        self.addCleanup(setattr, app.logger, "handlers", app.logger.handlers)
+        pipeline = init_logging(app, "test_gunicorn")
+        self.addCleanup(pipeline.stop)
+        self.assertEqual(len(app.logger.handlers), 1)
+        self.assertIsNot(app.logger.handlers[0], handler)
+        self.assertTrue(pipeline.listener._thread.is_alive())  # pylint: disable=protected-access
+
+    def test_json_formatter(self):
+        """It should format records as JSON with the route"""
+        record = logging.LogRecord("service", logging.INFO, __file__, 1, "Returning order: %s", (7,), None)
+        record.method = "GET"
+        record.endpoint = "order_resource"
+        entry = json.loads(JsonFormatter().format(record))
+        self.assertEqual(entry["message"], "Returning order: 7")
+        self.assertEqual(entry["level"], "INFO")
+        self.assertEqual(entry["endpoint"], "order_resource")
+        self.assertNotIn("\n", JsonFormatter().format(record))
+
+    def test_route_sampler(self):
+        """It should drop the info logs of unsampled requests only"""
+        info = logging.LogRecord("service", logging.INFO, __file__, 1, "info", None, None)
+        error = logging.LogRecord("service", logging.ERROR, __file__, 1, "error", None, None)
+        never = RouteSampler({("GET", "order_resource"): 0.0})
+        always = RouteSampler({("GET", "order_resource"): 1.0})
+        self.assertTrue(never.filter(info))  # outside of a request
+        with app.test_request_context("/api/orders/1"):
+            self.assertFalse(never.filter(info))
+            self.assertTrue(never.filter(error))
+        with app.test_request_context("/api/orders/1"):
+            self.assertTrue(always.filter(info))
+            self.assertEqual(info.endpoint, "order_resource")
+        with app.test_request_context("/api/orders/1", method="DELETE"):
+            self.assertTrue(never.filter(info))
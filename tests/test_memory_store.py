@@ -0,0 +1,158 @@
+"""
+Test cases for the In-Memory Storage of Orders
+"""
+from unittest import TestCase
+from sqlalchemy.exc import IntegrityError
+from service import app
+from service.models import Order, OrderItem, OrderStatus, DataValidationError
+from service.outbox_events import on_status_committed
+from service.repository import use_repository
+from service.common.memory_store import MemoryRepository, init_storage
+from tests.factories import OrderFactory, OrderItemFactory
+
+
+class TestMemoryStore(TestCase):
+    """In-Memory Storage Tests"""
+
+    def setUp(self):
+        """ This runs before each test """
+        self.store = MemoryRepository()
+        self.previous = use_repository(self.store)
+
+    def tearDown(self):
+        """ This runs after each test """
+        use_repository(self.previous)
+
+    def _create_orders(self, count: int) -> list:
+        """Creates orders of 3 customers, each with an item of one of 2 products"""
+        orders = []
+        for index in range(count):
+            order = OrderFactory(customer_id=index % 3, status=OrderStatus.CONFIRMED if index % 2 else OrderStatus.SHIPPED)
+            order.items = [OrderItemFactory(product_id=index % 2)]
+            order.create()
+            orders.append(order)
+        return orders
+
+    def test_create_and_find(self):
+        """It should create an Order with its items and find copies of it"""
+        order = Order(customer_id=7, items=[OrderItem(product_id=3, quantity=2, price=1.5)])
+        order.create()
+        self.assertEqual(order.id, 1)
+        self.assertEqual(order.status, OrderStatus.CONFIRMED)
+        self.assertEqual(order.items[0].id, 1)
+        found = Order.find(order.id)
+        self.assertIsNot(found, order)
+        self.assertEqual(found.serialize(), order.serialize())
+        found.status = OrderStatus.SHIPPED  # not saved
+        self.assertEqual(Order.find(order.id).status, OrderStatus.CONFIRMED)
+        self.assertEqual(OrderItem.find_by_order_and_item_id(order.id, 1).quantity, 2)
+        self.assertIsNone(OrderItem.find_by_order_and_item_id(order.id + 1, 1))
+        self.assertIsNone(Order.find(2))
+        self.assertEqual((Order.max_id(), OrderItem.max_id()), (1, 1))
+
+    def test_filters(self):
+        """It should filter Orders by customer, status and product with the indexes"""
+        orders = self._create_orders(12)
+        self.assertEqual(Order.find_by_customer(1).count(), 4)
+        self.assertEqual([order.id for order in Order.find_by_customer(1)], [2, 5, 8, 11])
+        self.assertEqual(Order.find_by_status(OrderStatus.SHIPPED).count(), 6)
+        self.assertEqual([order.id for order in Order.find_by_product(1)], [order.id for order in orders[1::2]])
+        self.assertEqual(Order.find_by_customer(4).count(), 0)
+        self.assertEqual(Order.find_by_product(9).all(), [])
+        self.assertEqual(len(Order.all()), 12)
+        self.assertEqual(self.store.select(customer_id=0, status=OrderStatus.SHIPPED, product_id=0), [1, 7])
+
+    def test_pagination(self):
+        """It should limit and offset the Orders of a query"""
+        self._create_orders(12)
+        query = Order.find_by_status(OrderStatus.CONFIRMED)
+        self.assertEqual([order.id for order in query.limit(2)], [2, 4])
+        self.assertEqual([order.id for order in query.offset(2).limit(2)], [6, 8])
+        self.assertEqual(query.offset(4).count(), 2)
+        self.assertEqual(query.offset(2).limit(10).offset(3).count(), 1)
+        self.assertEqual(query.offset(5).first().id, 12)
+        self.assertIsNone(query.offset(6).first())
+
+    def test_update_and_delete(self):
+        """It should keep the indexes up to date when Orders and Order Items change"""
+        orders = self._create_orders(4)
+        order = Order.find(orders[0].id)
+        order.customer_id = 9
+        order.status = OrderStatus.DELIVERED
+        order.update()
+        OrderItem(order_id=order.id, product_id=5, quantity=1, price=2).create()
+        self.assertEqual([order.id for order in Order.find_by_customer(9)], [orders[0].id])
+        self.assertEqual(Order.find_by_status(OrderStatus.DELIVERED).count(), 1)
+        self.assertEqual(Order.find_by_product(5).count(), 1)
+        item = OrderItem.find_by_order_and_item_id(order.id, order.items[0].id)
+        item.product_id = 6
+        item.update()
+        self.assertEqual(Order.find_by_product(0).count(), 1)
+        self.assertEqual(Order.find_by_product(6).count(), 1)
+        item.delete()
+        self.assertEqual(Order.find_by_product(6).count(), 0)
+        Order.find(orders[1].id).delete()
+        self.assertIsNone(Order.find(orders[1].id))
+        self.assertEqual(len(OrderItem.all()), 3)
+        self.assertEqual(self.store.by_product, {0: {3: 1}, 1: {4: 1}, 5: {1: 1}})
+        self.assertEqual(self.store.by_customer, {9: {1}, 2: {3}, 0: {4}})
+
+    def test_items(self):
+        """It should create, batch and merge Order Items"""
+        order = self._create_orders(1)[0]
+        self.assertEqual(OrderItem.create_batch([
+            OrderItemFactory(order_id=order.id, product_id=4), OrderItemFactory(order_id=99)
+        ]).keys(), {1})
+        merged, created = OrderItem.merge(order.id, {"product_id": 4, "quantity": 3, "price": 1})
+        self.assertFalse(created)
+        self.assertEqual(merged.quantity, OrderItem.find(merged.id).quantity)
+        _, created = OrderItem.merge(order.id, {"product_id": 8, "quantity": 3, "price": 1})
+        self.assertTrue(created)
+        self.assertEqual([item.product_id for item in Order.find(order.id).items], [0, 4, 8])
+        OrderItem.unique_products = True
+        self.addCleanup(setattr, OrderItem, "unique_products", False)
+        item = OrderItem(order_id=order.id, product_id=8, quantity=1, price=1)
+        self.assertRaises(IntegrityError, item.create)
+
+    def test_failed_writes(self):
+        """It should leave nothing behind when an Order or its items cannot be stored"""
+        OrderItem.unique_products = True
+        self.addCleanup(setattr, OrderItem, "unique_products", False)
+        order = Order(customer_id=1, items=[OrderItem(product_id=3, quantity=1, price=1)])
+        order.items.append(OrderItem(product_id=3, quantity=2, price=1))
+        self.assertRaises(IntegrityError, order.create)
+        self.assertEqual((self.store.orders, self.store.items, self.store.by_product), ({}, {}, {}))
+
+    def test_update_keeps_items(self):
+        """It should keep the items that other requests changed while an Order was updated"""
+        order = self._create_orders(1)[0]
+        stale = Order.find(order.id)
+        OrderItem(order_id=order.id, product_id=4, quantity=1, price=1).create()
+        OrderItem.find(order.items[0].id).delete()
+        stale.status = OrderStatus.DELIVERED
+        stale.update()
+        found = Order.find(order.id)
+        self.assertEqual(found.status, OrderStatus.DELIVERED)
+        self.assertEqual([item.product_id for item in found.items], [4])
+        self.assertEqual(self.store.by_product, {4: {order.id: 1}})
+
+    def test_transition_many(self):
+        """It should move the allowed Orders to another status"""
+        orders = self._create_orders(6)
+        changes = []
+        on_status_committed(changes.extend)
+        changed, rejected = Order.transition_many(OrderStatus.IN_PROGRESS, [order.id for order in orders] + [99])
+        self.assertEqual(changed, [2, 4, 6])
+        self.assertEqual(rejected, {1: OrderStatus.SHIPPED, 3: OrderStatus.SHIPPED, 5: OrderStatus.SHIPPED})
+        self.assertEqual([change["id"] for change in changes], [2, 4, 6])
+        changed, rejected = Order.transition_many(OrderStatus.DELIVERED, customer_id=0)
+        self.assertEqual((changed, rejected), ([1], {4: OrderStatus.IN_PROGRESS}))
+        self.assertEqual(Order.find_by_status(OrderStatus.DELIVERED).count(), 1)
+        self.assertRaises(DataValidationError, Order.transition_many, OrderStatus.CANCELLED)
+
+    def test_init_storage(self):
+        """It should use the in-memory storage only with ORDER_STORAGE=memory"""
+        self.assertIsNone(init_storage(app))
+        app.config["ORDER_STORAGE"] = "disk"
+        self.addCleanup(app.config.update, ORDER_STORAGE="sql")
+        self.assertRaises(ValueError, init_storage, app)
@@ -0,0 +1,88 @@
+"""
+Test cases for the metrics, timing and profiling of requests
+"""
+import os
+import pstats
+import tempfile
+from service import app
+from service.models import db
+from service.common import status  # HTTP Status Codes
+from tests.api_test_case import BASE_URL, ApiTestCase
+
+
+class TestObservability(ApiTestCase):
+    """Observability Tests"""
+
+    def test_metrics(self):
+        """It should report request metrics in the Prometheus format"""
+        self.app.get(BASE_URL)
+        self.app.get(f"{BASE_URL}/0")
+        resp = self.app.get("/metrics")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.content_type.startswith("text/plain"))
+        text = resp.get_data(as_text=True)
+        self.assertIn('orders_http_requests_total{endpoint="order_collection",method="GET",status="200"}', text)
+        self.assertIn('orders_http_requests_total{endpoint="order_resource",method="GET",status="404"}', text)
+        self.assertIn('orders_http_request_duration_seconds_bucket{endpoint="order_resource"', text)
+        self.assertIn('orders_db_queries_per_request_count{endpoint="order_resource",method="GET"}', text)
+
+    def test_server_timing(self):
+        """It should report the database usage of a request"""
+        self._create_orders(2)
+        resp = self.app.get(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        timing = resp.headers.get("Server-Timing")
+        self.assertIsNotNone(timing)
+        self.assertTrue(timing.startswith("db;dur="))
+        self.assertRegex(timing, r'desc="[1-9][0-9]* queries"')
+
+    def test_failed_query_timing(self):
+        """It should not keep the start time of a statement that failed"""
+        with db.engine.connect() as connection:
+            self.assertRaises(Exception, connection.exec_driver_sql, "SELECT missing FROM nowhere")
+            self.assertEqual(connection.info["query_start_time"], [])
+
+    def test_slow_query_log(self):
+        """It should log slow queries without their parameters"""
+        app.config["SLOW_QUERY_MS"] = 0
+        try:
+            with self.assertLogs(app.logger, "WARNING") as logs:
+                self.app.get(BASE_URL, query_string="customer_id=12345")
+        finally:
+            app.config["SLOW_QUERY_MS"] = 200
+        self.assertTrue(any("Slow query" in line and "order_collection" in line for line in logs.output))
+        self.assertFalse(any("12345" in line for line in logs.output))
+
+    def test_profile_request(self):
+        """It should profile a request that sends the profiling secret"""
+        with tempfile.TemporaryDirectory() as profile_dir:
+            app.config.update(PROFILE_SECRET="letmein", PROFILE_DIR=profile_dir, PROFILE_MAX_FILES=2)
+            try:
+                resp = self.app.get(BASE_URL)
+                self.assertNotIn("X-Profile-Id", resp.headers)
+                resp = self.app.get(BASE_URL, headers={"X-Profile": "wrong"})
+                self.assertNotIn("X-Profile-Id", resp.headers)
+                resp = self.app.get(BASE_URL, headers={"X-Profile": "\u00e9"})
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                self.assertNotIn("X-Profile-Id", resp.headers)
+                for _ in range(3):
+                    resp = self.app.get(BASE_URL, headers={"X-Profile": "letmein"})
+                    self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                profile_id = resp.headers.get("X-Profile-Id")
+                self.assertIn("GET-order_collection", profile_id)
+                # only the newest profiles are kept
+                self.assertEqual(len(os.listdir(profile_dir)), 2)
+                stats = pstats.Stats(os.path.join(profile_dir, profile_id))
+                self.assertTrue(any(func[2] == "get" for func in stats.stats))
+            finally:
+                app.config["PROFILE_SECRET"] = ""
+
+    def test_profile_sample_rate(self):
+        """It should profile a sample of the requests"""
+        with tempfile.TemporaryDirectory() as profile_dir:
+            app.config.update(PROFILE_SAMPLE_RATE=1.0, PROFILE_DIR=profile_dir)
+            try:
+                resp = self.app.get(BASE_URL)
+                self.assertIn("X-Profile-Id", resp.headers)
+            finally:
+                app.config["PROFILE_SAMPLE_RATE"] = 0
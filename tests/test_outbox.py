@@ -0,0 +1,153 @@
+"""
+Test cases for the Order Event Outbox
+"""
+import os
+import json
+import socket
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from unittest.mock import Mock
+from service import app
+from service.models import db, Order, OrderStatus
+from service.outbox_events import OrderEvent, on_events_committed
+from service.common.outbox import EventRetention, FileSink, MemorySink, OutboxPublisher, SocketSink, make_sink
+from tests.database_test_case import DatabaseTestCase
+from tests.factories import OrderFactory, OrderItemFactory
+
+
+class TestOutbox(DatabaseTestCase):
+    """Order Event Outbox Tests"""
+
+    def _create_order(self, item_count=1):
+        """Creates an order with items and returns it"""
+        order = OrderFactory(status=OrderStatus.CONFIRMED)
+        order.items = [OrderItemFactory(order_id=None) for _ in range(item_count)]
+        order.create()
+        return order
+
+    def test_events_written_with_changes(self):
+        """It should write an event for every change in the same transaction"""
+        order = self._create_order(2)
+        first, second = [item.id for item in order.items]
+        order.customer_id += 1
+        order.update()
+        order.items[0].delete()
+        order.delete()
+        events = [(event.event_type, event.item_id) for event in OrderEvent.query.order_by(OrderEvent.id)]
+        self.assertEqual(events, [
+            ("order.created", None), ("item.created", first), ("item.created", second),
+            ("order.updated", None), ("item.deleted", first), ("order.deleted", None), ("item.deleted", second),
+        ])
+        created = OrderEvent.query.first().serialize()
+        self.assertEqual(created["payload"]["customer_id"], order.customer_id - 1)
+        self.assertNotIn("items", created["payload"])
+
+    def test_no_events_on_rollback(self):
+        """It should not keep the events of a transaction that was rolled back"""
+        order = OrderFactory()
+        db.session.add(order)
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(OrderEvent.query.count(), 0)
+
+    def test_commit_listeners(self):
+        """It should call the listeners after a commit that wrote events"""
+        calls = []
+        on_events_committed(lambda: calls.append(1))
+        self._create_order(0)
+        self.assertEqual(len(calls), 1)
+        Order.all()
+        db.session.commit()
+        self.assertEqual(len(calls), 1)
+
+    def test_publish_batches(self):
+        """It should deliver the events in batches and mark them as published"""
+        for _ in range(3):
+            self._create_order(1)
+        sink = MemorySink()
+        publisher = OutboxPublisher(app, sink, batch_size=4)
+        self.assertEqual(publisher.publish_batch(), 4)
+        self.assertEqual(publisher.drain(), 2)
+        self.assertEqual(publisher.drain(), 0)
+        self.assertEqual([message["id"] for message in sink.messages], list(range(1, 7)))
+        self.assertEqual(OrderEvent.query.filter(OrderEvent.published_at.is_(None)).count(), 0)
+
+    def test_publish_failure(self):
+        """It should keep the events of a batch that could not be delivered"""
+        self._create_order(1)
+        publisher = OutboxPublisher(app, Mock(**{"send.side_effect": ConnectionError("sink is down")}))
+        self.assertRaises(ConnectionError, publisher.publish_batch)
+        sink = MemorySink()
+        self.assertEqual(OutboxPublisher(app, sink).drain(), 2)
+        self.assertEqual(len(sink.messages), 2)
+
+    def test_purge(self):
+        """It should delete events that were published before the retention"""
+        self._create_order(1)
+        OutboxPublisher(app, MemorySink()).drain()
+        db.session.execute(db.update(OrderEvent).values(published_at=datetime.utcnow() - timedelta(days=8)))
+        db.session.commit()
+        self._create_order(0)
+        OutboxPublisher(app, MemorySink()).purge()
+        self.assertEqual([event.event_type for event in OrderEvent.query.all()], ["order.created"])
+
+    def test_retention_without_sink(self):
+        """It should delete old events, published or not, when no publisher runs"""
+        self._create_order(1)
+        db.session.execute(db.update(OrderEvent).values(created_at=datetime.utcnow() - timedelta(days=8)))
+        db.session.commit()
+        self._create_order(0)
+        self.assertEqual(EventRetention(app).purge(), 2)
+        self.assertEqual([event.event_type for event in OrderEvent.query.all()], ["order.created"])
+
+    def test_background_thread(self):
+        """It should deliver events soon after they were committed"""
+        sink = MemorySink()
+        publisher = OutboxPublisher(app, sink, poll_seconds=30)
+        on_events_committed(publisher.wake)
+        publisher.ensure_started()
+        try:
+            self._create_order(0)
+            for _ in range(100):
+                if sink.messages:
+                    break
+                threading.Event().wait(0.05)
+        finally:
+            publisher.stop()
+        self.assertEqual([message["type"] for message in sink.messages], ["order.created"])
+
+    def test_file_sink(self):
+        """It should append events to a file as JSON lines"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "events.jsonl")
+            sink = make_sink(f"file://{path}")
+            self.assertIsInstance(sink, FileSink)
+            sink.send([{"id": 1}, {"id": 2}])
+            sink.send([{"id": 3}])
+            with open(path, encoding="utf-8") as events_file:
+                self.assertEqual([json.loads(line)["id"] for line in events_file], [1, 2, 3])
+
+    def test_socket_sink(self):
+        """It should write events to a local socket"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "events.sock")
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(path)
+            server.listen(1)
+            sink = make_sink(f"unix://{path}")
+            self.assertIsInstance(sink, SocketSink)
+            sink.send([{"id": 1}, {"id": 2}])
+            connection, _ = server.accept()
+            data = b""
+            while data.count(b"\n") < 2:
+                data += connection.recv(1024)
+            self.assertEqual([json.loads(line)["id"] for line in data.splitlines()], [1, 2])
+            sink.close()
+            connection.close()
+            server.close()
+
+    def test_bad_sink(self):
+        """It should not make a sink for an unknown URL"""
+        self.assertRaises(ValueError, make_sink, "kafka://localhost")
+        self.assertIsInstance(make_sink("tcp://localhost:9000"), SocketSink)
@@ -0,0 +1,71 @@
+"""
+Test cases for Read Coalescing
+"""
+import time
+import threading
+from unittest import TestCase
+from service.common.single_flight import SingleFlight
+
+
+class TestSingleFlight(TestCase):
+    """Read Coalescing Tests"""
+
+    def setUp(self):
+        """ This runs before each test """
+        self.flights = SingleFlight()
+        self.calls = []
+        self.release = threading.Event()
+
+    def _read(self):
+        self.calls.append(1)
+        self.release.wait(5)
+        return {"id": len(self.calls)}
+
+    def _run(self, count: int, function) -> list:
+        """Starts count identical reads while the first one is in flight"""
+        results = []
+
+        def read():
+            try:
+                results.append(self.flights.do("/orders/1", function, "order_resource"))
+            except ValueError as error:
+                results.append(error)
+
+        threads = [threading.Thread(target=read) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_coalesce_reads(self):
+        """It should run identical concurrent reads once and share the result"""
+        results = self._run(8, self._read)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(results, [{"id": 1}] * 8)
+        # The next read runs again
+        self.assertEqual(self.flights.do("/orders/1", lambda: {"id": 2}), {"id": 2})
+        self.assertEqual(self.flights.flights, {})
+
+    def test_share_errors(self):
+        """It should raise the error of the read in flight in every request"""
+        def fail():
+            self.release.wait(5)
+            raise ValueError("database is down")
+
+        results = self._run(4, fail)
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+    def test_forget_after_commit(self):
+        """It should not let reads that start after a commit join an older read"""
+        thread = threading.Thread(target=self.flights.do, args=("/orders/1", self._read))
+        thread.start()
+        time.sleep(0.05)
+        self.flights.forget({1})
+        self.assertEqual(self.flights.do("/orders/1", lambda: {"id": "fresh"}), {"id": "fresh"})
+        self.release.set()
+        thread.join()
+        self.assertEqual(len(self.calls), 1)
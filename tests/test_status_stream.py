@@ -0,0 +1,57 @@
+"""
+Test cases for the Server-Sent Events of Order status changes
+"""
+from service import app
+from service.models import OrderStatus
+from service.common import status  # HTTP Status Codes
+from tests.api_test_case import BASE_URL, ApiTestCase
+
+
+class TestStatusStream(ApiTestCase):
+    """Status Stream Tests"""
+
+    def test_status_stream(self):
+        """It should push the status changes of an Order and of a customer as Server-Sent Events"""
+        order_ids = self._create_orders_with_status([OrderStatus.CONFIRMED] * 2, customer_id=4)
+        order_stream = self.app.get(f"{BASE_URL}/status-stream", query_string={"order_id": order_ids[0]}, buffered=False)
+        self.assertEqual(order_stream.status_code, status.HTTP_200_OK)
+        self.assertEqual(order_stream.mimetype, "text/event-stream")
+        customer_stream = self.app.get(f"{BASE_URL}/status-stream", query_string={"customer_id": 4}, buffered=False)
+        order_events, customer_events = iter(order_stream.response), iter(customer_stream.response)
+        self.assertEqual(next(order_events), b"retry: 3000\n\n")
+        self.assertIn(b'"status":"CONFIRMED"', next(order_events))
+        self.assertEqual(next(customer_events), b"retry: 3000\n\n")
+        self.app.put(f"{BASE_URL}/{order_ids[0]}/cancel")
+        self.app.post(f"{BASE_URL}/status-transitions", json={"target": "SHIPPED", "ids": order_ids})
+        self.assertIn(b'"status":"CANCELLED"', next(order_events))
+        self.assertIn(f'"id":{order_ids[0]},"customer_id":4,"status":"CANCELLED"'.encode(), next(customer_events))
+        self.assertIn(f'"id":{order_ids[1]},"customer_id":4,"status":"SHIPPED"'.encode(), next(customer_events))
+        order_stream.close()
+        customer_stream.close()
+        broker = app.extensions["status_broker"]
+        self.assertEqual((broker.by_order, broker.by_customer), ({}, {}))
+
+    def test_status_stream_limit(self):
+        """It should refuse more status streams than a worker may serve"""
+        order_ids = self._create_orders_with_status([OrderStatus.CONFIRMED])
+        broker = app.extensions["status_broker"]
+        self.addCleanup(setattr, broker, "max_streams", broker.max_streams)
+        broker.max_streams = 1
+        stream = self.app.get(f"{BASE_URL}/status-stream", query_string={"order_id": order_ids[0]}, buffered=False)
+        self.assertEqual(stream.status_code, status.HTTP_200_OK)
+        resp = self.app.get(f"{BASE_URL}/status-stream", query_string={"customer_id": 1})
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(resp.headers["Retry-After"], "10")
+        stream.close()
+        resp = self.app.get(f"{BASE_URL}/status-stream", query_string={"order_id": 0})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(broker.streams, 0)
+
+    def test_status_stream_bad_args(self):
+        """It should not stream without exactly one existing order or customer"""
+        for query in ({}, {"order_id": 1, "customer_id": 1}):
+            resp = self.app.get(f"{BASE_URL}/status-stream", query_string=query)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, query)
+        resp = self.app.get(f"{BASE_URL}/status-stream", query_string={"order_id": 0})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(app.extensions["status_broker"].by_order, {})
@@ -0,0 +1,57 @@
+"""
+Test cases for moving many Orders to another status
+"""
+from service.common import status  # HTTP Status Codes
+from service.models import OrderStatus
+from tests.api_test_case import BASE_URL, ApiTestCase
+
+
+class TestStatusTransitions(ApiTestCase):
+    """Status Transition Tests"""
+
+    def test_status_transition_by_ids(self):
+        """It should move the Orders that allow it to another status with one update"""
+        statuses = [OrderStatus.CONFIRMED, OrderStatus.IN_PROGRESS, OrderStatus.DELIVERED, OrderStatus.SHIPPED]
+        order_ids = self._create_orders_with_status(statuses)
+        body = {"target": "SHIPPED", "ids": order_ids + [order_ids[-1] + 100]}
+        resp = self.app.post(f"{BASE_URL}/status-transitions", json=body)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["target"], "SHIPPED")
+        self.assertEqual(data["updated"], order_ids[:2])
+        self.assertEqual(data["rejected"], [
+            {"id": order_ids[2], "status": "DELIVERED"}, {"id": order_ids[3], "status": "SHIPPED"},
+        ])
+        self.assertEqual(data["missing"], [order_ids[-1] + 100])
+        for order_id, expected in zip(order_ids, ["SHIPPED", "SHIPPED", "DELIVERED", "SHIPPED"]):
+            self.assertEqual(self.app.get(f"{BASE_URL}/{order_id}").get_json()["status"], expected)
+
+    def test_status_transition_by_filter(self):
+        """It should move the Orders selected by a filter to another status"""
+        order_ids = self._create_orders_with_status([OrderStatus.SHIPPED, OrderStatus.CONFIRMED, OrderStatus.SHIPPED])
+        other_ids = self._create_orders_with_status([OrderStatus.SHIPPED], customer_id=8)
+        body = {"target": "DELIVERED", "filter": {"customer_id": 7, "status": "SHIPPED"}}
+        resp = self.app.post(f"{BASE_URL}/status-transitions", json=body)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["updated"], [order_ids[0], order_ids[2]])
+        self.assertEqual(data["rejected"], [])
+        self.assertEqual(data["missing"], [])
+        self.assertEqual(self.app.get(f"{BASE_URL}/{other_ids[0]}").get_json()["status"], "SHIPPED")
+        # Cancelling follows the same rules as the cancel action
+        body = {"target": "CANCELLED", "filter": {"customer_id": 7}}
+        data = self.app.post(f"{BASE_URL}/status-transitions", json=body).get_json()
+        self.assertEqual(data["updated"], [order_ids[1]])
+        self.assertEqual([order["id"] for order in data["rejected"]], [order_ids[0], order_ids[2]])
+
+    def test_status_transition_bad_data(self):
+        """It should not move Orders without a valid target and selection"""
+        for body in (
+            {"target": "SHIPPED"},
+            {"target": "SHIPPED", "ids": [1], "filter": {"customer_id": 1}},
+            {"target": "SHIPPED", "filter": {}},
+            {"target": "CONFIRMED", "ids": [1]},
+            {"target": "SHIPPED", "filter": {"status": "LOST"}},
+        ):
+            resp = self.app.post(f"{BASE_URL}/status-transitions", json=body)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, body)
@@ -0,0 +1,100 @@
+"""
+Test cases for the compiled Request Validators
+"""
+from unittest import TestCase
+from flask_restx import Model, fields
+from service.models import DataValidationError
+from service.common.validation import compile_validator
+from service.routes import item_create_model, order_create_model
+
+PART = Model("Part", {
+    "name": fields.String(required=True),
+    "weight": fields.Float(min=0, max=100),
+    "fragile": fields.Boolean(),
+})
+
+
+class TestValidation(TestCase):
+    """Request Validator Tests"""
+
+    def setUp(self):
+        self.validate_order = compile_validator(order_create_model, "Order")
+        self.validate_item = compile_validator(item_create_model, "Order Item")
+
+    def test_valid_order(self):
+        """It should return only the fields of the model"""
+        data = {
+            "customer_id": 3,
+            "status": "SHIPPED",
+            "items": [{"product_id": 0, "quantity": 1, "price": 2, "id": 7}],
+            "created_on": "2023-01-01",
+        }
+        self.assertEqual(self.validate_order(data), {
+            "customer_id": 3,
+            "status": "SHIPPED",
+            "items": [{"product_id": 0, "quantity": 1, "price": 2}],
+        })
+
+    def test_optional_fields(self):
+        """It should not require the optional fields"""
+        self.assertEqual(self.validate_order({"customer_id": 0}), {"customer_id": 0})
+
+    def test_collect_errors(self):
+        """It should collect every error with its path"""
+        data = {"customer_id": "1", "status": "created", "items": [{"product_id": 1, "quantity": 1, "price": 1}, 5]}
+        with self.assertRaises(DataValidationError) as context:
+            self.validate_order(data)
+        self.assertEqual(context.exception.errors, [
+            "items[1]: must be an object",
+            "customer_id: must be an integer",
+            "status: must be one of CONFIRMED, IN_PROGRESS, SHIPPED, DELIVERED, CANCELLED",
+        ])
+        self.assertTrue(str(context.exception).startswith("Invalid Order: 3 errors - "))
+
+    def test_bad_types(self):
+        """It should not accept booleans, non finite numbers or a list of items that is not a list"""
+        for data in (
+            {"product_id": True, "quantity": 1, "price": 1.0},
+            {"product_id": 1, "quantity": 1.0, "price": 1.0},
+            {"product_id": 1, "quantity": 1, "price": float("nan")},
+            {"product_id": 1, "quantity": 1, "price": "1.0"},
+        ):
+            self.assertRaises(DataValidationError, self.validate_item, data)
+        self.assertRaises(DataValidationError, self.validate_order, {"customer_id": 1, "items": {}})
+
+    def test_not_an_object(self):
+        """It should not accept a body that is not an object"""
+        for data in (None, [], "order"):
+            with self.assertRaises(DataValidationError) as context:
+                self.validate_item(data)
+            self.assertEqual(context.exception.errors, ["body: must be an object"])
+
+    def test_other_fields(self):
+        """It should check strings, booleans and maximums"""
+        validate = compile_validator(PART)
+        self.assertEqual(validate({"name": "bolt", "fragile": False}), {"name": "bolt", "fragile": False})
+        with self.assertRaises(DataValidationError) as context:
+            validate({"name": 1, "weight": 101, "fragile": "no"})
+        self.assertEqual(context.exception.errors, [
+            "name: must be a string", "weight: must be at most 100", "fragile: must be a boolean",
+        ])
+
+    def test_unsupported_field(self):
+        """It should not compile a model with fields it cannot check"""
+        self.assertRaises(TypeError, compile_validator, Model("Bad", {"when": fields.Date()}))
+        self.assertRaises(TypeError, compile_validator, Model("Bad", {"tags": fields.List(fields.Raw)}))
+
+    def test_list_of_values(self):
+        """It should check the length and every element of a list of values"""
+        validate = compile_validator(Model("Ids", {
+            "ids": fields.List(fields.Integer(min=1), required=True, min_items=1, max_items=3),
+        }))
+        self.assertEqual(validate({"ids": [3, 1]}), {"ids": [3, 1]})
+        for data, errors in (
+            ({"ids": []}, ["ids: must have at least 1 item"]),
+            ({"ids": [1, 2, 3, 4]}, ["ids: must have at most 3 items"]),
+            ({"ids": [1, "2", 0]}, ["ids[1]: must be an integer", "ids[2]: must be at least 1"]),
+        ):
+            with self.assertRaises(DataValidationError) as context:
+                validate(data)
+            self.assertEqual(context.exception.errors, errors)